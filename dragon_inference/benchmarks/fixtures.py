@@ -0,0 +1,64 @@
+import torch
+import torch.nn as nn
+import numpy as np
+from astropy.io import fits
+from pathlib import Path
+import logging
+
+from dragon_inference import DRAGON
+from utils import center_square
+
+# The cutouts that ship with the repository, one directory above this one.
+BUNDLED_FITS_DIR = Path(__file__).resolve().parent.parent
+
+
+def bundled_fits_paths():
+    """
+    The FITS cutouts bundled with the repository (J001113.76+002032.3.fits etc.).
+    """
+    paths = sorted(BUNDLED_FITS_DIR.glob('*.fits'))
+    if not paths:
+        raise OSError(f"No bundled FITS files found in {BUNDLED_FITS_DIR}.")
+
+    return paths
+
+
+def load_bundled_cutouts(extension: int = 1):
+    """
+    Read the image data of every bundled cutout without going through Streamlit's cache.
+    The cutouts are not all the same shape (some are 96x97), so they are center-cropped
+    to a common square and can be stacked into batches.
+
+    :return: A list of float32 numpy arrays of the same square shape.
+    """
+    images = [fits.getdata(path, ext=extension).astype(np.float32) for path in bundled_fits_paths()]
+    size = min(min(image.shape) for image in images)
+
+    return [np.ascontiguousarray(center_square(image, size)) for image in images]
+
+
+def write_random_checkpoints(model_dir, num_voters: int = 7, seed: int = 0):
+    """
+    Write randomly initialized DRAGON checkpoints that DRAGONEnsemble can load,
+    so that benchmarks never need the real Congress weights (or the network).
+
+    :param model_dir: The directory to write the .pt files into.
+    :param num_voters: The number of Congress members to create.
+    :param seed: Seed for the weight initialization, for reproducibility.
+    :return: The list of checkpoint paths.
+    """
+    model_dir = Path(model_dir)
+    model_dir.mkdir(parents=True, exist_ok=True)
+
+    logging.info(f"Writing {num_voters} random checkpoints to {model_dir}...")
+    paths = []
+    for i in range(num_voters):
+        torch.manual_seed(seed + i)
+
+        # DRAGONModel wraps the network in DataParallel before loading, so the keys need the same prefix.
+        model = nn.DataParallel(DRAGON())
+        path = model_dir / f"dragon_random_{i}.pt"
+        torch.save(model.state_dict(), path)
+        paths.append(path)
+
+    return paths
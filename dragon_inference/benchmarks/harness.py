@@ -0,0 +1,75 @@
+import platform
+import time
+import json
+import os
+
+import numpy as np
+
+
+def measure(func, repeats: int = 10, warmup: int = 1, items: int = 1):
+    """
+    Time repeated calls of a function.
+
+    :param func: A zero-argument callable.
+    :param repeats: Number of timed calls.
+    :param warmup: Number of untimed calls beforehand.
+    :param items: How many items (images, rows, ...) one call processes, for throughput.
+    :return: A dictionary of latency statistics in milliseconds, plus items per second.
+    """
+    for _ in range(warmup):
+        func()
+
+    timings = np.empty(repeats)
+    for i in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings[i] = time.perf_counter() - start
+
+    return {
+        "repeats": repeats,
+        "items": items,
+        "median_ms": float(np.median(timings) * 1e3),
+        "mean_ms": float(timings.mean() * 1e3),
+        "p95_ms": float(np.percentile(timings, 95) * 1e3),
+        "min_ms": float(timings.min() * 1e3),
+        "throughput_per_s": float(items / np.median(timings)),
+    }
+
+
+def system_info():
+    """The environment a result was measured in, so results are only compared like for like."""
+    import torch
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "numpy": np.__version__,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def write_results(results: dict, path):
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+
+
+def compare_results(current: dict, baseline: dict, tolerance: float = 0.2):
+    """
+    Flag every benchmark whose median latency got slower than the baseline by more than the tolerance.
+
+    :return: A list of (benchmark name, baseline ms, current ms) regressions.
+    """
+    regressions = []
+    for name, result in current['benchmarks'].items():
+        previous = baseline.get('benchmarks', {}).get(name)
+        if previous is None:
+            continue
+
+        if result['median_ms'] > previous['median_ms'] * (1 + tolerance):
+            regressions.append((name, previous['median_ms'], result['median_ms']))
+
+    return regressions
@@ -0,0 +1,106 @@
+"""
+Import-time budget for the entry points of the app. Each entry point is imported in a
+fresh interpreter under `python -X importtime`, and the report lists the total import
+time and the heaviest modules. It fails (exit code 1) when an entry point exceeds its
+time budget, or when it eagerly imports a heavy dependency that should be deferred
+until the page that needs it.
+
+Run from the dragon_inference directory:
+
+    python -m benchmarks.import_budget
+    python -m benchmarks.import_budget --scale 2.0 --output import_times.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+PACKAGE_DIR = Path(__file__).resolve().parent.parent
+
+# Entry point -> (budget in milliseconds, heavy top-level modules it must not import)
+ENTRY_POINTS = {
+    # What the Streamlit app imports before it can draw the Login page
+    'dragon_display': (1500, ('torch', 'astroquery', 'photutils', 'mpld3', 'matplotlib', 'requests')),
+    'utils': (1000, ('torch', 'astroquery', 'photutils', 'mpld3', 'matplotlib')),
+    'hsc_downloader': (1000, ('torch', 'astroquery', 'photutils', 'requests')),
+    'dragon_analysis': (500, ('torch', 'astroquery', 'photutils', 'mpld3')),
+    # Only the torch-free parts of the model package (aggregation, prediction store)
+    'dragon_inference': (500, ('torch', 'astroquery', 'photutils')),
+}
+
+
+def measure_import(module: str):
+    """
+    Import a module in a clean interpreter with -X importtime.
+
+    :return: (total milliseconds, {top-level package: cumulative milliseconds})
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([str(PACKAGE_DIR), str(PACKAGE_DIR / 'frontend'), env.get('PYTHONPATH', '')])
+
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=PACKAGE_DIR, env=env, capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{completed.stderr}")
+
+    total_us = 0
+    packages = dict()
+    for line in completed.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        total_us += int(self_us)
+
+        # Un-indented names are imported directly, so their cumulative time is their full cost
+        if not name.startswith('  ', 1):
+            top_level = name.strip().split('.')[0]
+            packages[top_level] = packages.get(top_level, 0) + int(cumulative_us) / 1e3
+
+    return total_us / 1e3, packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import-time budget of each entry point.")
+    parser.add_argument('--scale', type=float, default=1.0, help="Multiply every budget, for slow machines.")
+    parser.add_argument('--top', type=int, default=8, help="How many of the heaviest imports to list.")
+    parser.add_argument('--output', default=None, help="Optionally write the report as JSON.")
+    args = parser.parse_args()
+
+    report, failures = dict(), []
+    for module, (budget_ms, forbidden) in ENTRY_POINTS.items():
+        total_ms, packages = measure_import(module)
+        budget_ms *= args.scale
+
+        eager = sorted(set(forbidden) & set(packages))
+        heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:args.top]
+        report[module] = {"total_ms": total_ms, "budget_ms": budget_ms, "eager_heavy_imports": eager,
+                          "heaviest": dict(heaviest)}
+
+        status = "ok" if total_ms <= budget_ms and not eager else "FAIL"
+        print(f"{module:<18} {total_ms:>9.1f} ms / {budget_ms:>7.0f} ms  {status}")
+        for name, ms in heaviest:
+            print(f"    {name:<24} {ms:>9.1f} ms")
+
+        if total_ms > budget_ms:
+            failures.append(f"{module} took {total_ms:.1f} ms (budget {budget_ms:.0f} ms)")
+        if eager:
+            failures.append(f"{module} eagerly imports {', '.join(eager)}")
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    for failure in failures:
+        print(f"BUDGET EXCEEDED: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
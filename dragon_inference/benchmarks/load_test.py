@@ -0,0 +1,350 @@
+"""
+Concurrent-session load test of the Streamlit app. Every simulated analyst is its own
+Streamlit session (driven through streamlit.testing's AppTest, in its own thread, as
+the server would run it) and walks through Login -> Cutout -> Image -> Inference. HSC
+and SDSS are replayed (see hsc_downloader.Transport) from an archive of the bundled
+cutouts and synthetic spectra, with an optional simulated latency and bandwidth, and
+the Congress is made of random checkpoints unless a model directory is given.
+
+Each concurrency level runs in a fresh process, so the peak RSS it reports is that of
+one server process with that many concurrent sessions.
+
+Run from the dragon_inference directory:
+
+    python -m benchmarks.load_test --sessions 1 2 4 8 --flows 3 --output load.json
+    python -m benchmarks.load_test --sessions 4 --unique-objects --network-latency 0.5
+    python -m benchmarks.load_test --sessions 1 2 4 8 --output new.json --baseline load.json
+"""
+import os
+
+# CPU only, regardless of the machine the test runs on. This has to happen before torch is imported.
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+import argparse
+import json
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+PACKAGE_DIR = Path(__file__).resolve().parent.parent
+
+# The stages of one analyst's visit, in order.
+STEPS = ('login', 'cutout', 'image', 'centroids', 'inference', 'slider')
+
+# Two clicks on the cutout, where the analyst would mark the centroids.
+CENTROIDS = [{"x": 40, "y": 44}, {"x": 54, "y": 50}]
+
+
+def _synthetic_spectrum(seed: int):
+    """An SDSS-like spectrum HDUList with a double-peaked [OIII] line, for the Inference page."""
+    from astropy.io import fits
+
+    rng = np.random.default_rng(seed)
+    loglam = np.arange(3.56, 3.96, 1e-4, dtype=np.float32)
+    wavelength = 10 ** loglam
+    flux = 5 + rng.normal(0, 0.5, len(loglam))
+    for center in (5008.24 * 1.1 * (1 - 5e-4), 5008.24 * 1.1 * (1 + 5e-4)):
+        flux += 20 * np.exp(-0.5 * ((wavelength - center) / 2.0) ** 2)
+
+    coadd = fits.BinTableHDU.from_columns([
+        fits.Column(name='loglam', format='E', array=loglam),
+        fits.Column(name='flux', format='E', array=flux.astype(np.float32)),
+        fits.Column(name='ivar', format='E', array=np.full(len(loglam), 4.0, dtype=np.float32)),
+    ])
+    specobj = fits.BinTableHDU.from_columns([fits.Column(name='Z', format='E', array=np.array([0.1]))])
+    return fits.HDUList([fits.PrimaryHDU(), coadd, specobj])
+
+
+def visit_names(sessions: int, flows: int, unique_objects: bool):
+    """:return: The object every analyst looks at on every visit, [sessions][flows]."""
+    from .fixtures import bundled_fits_paths
+
+    bundled = [path.stem for path in bundled_fits_paths()]
+    if unique_objects:
+        return [[f"LOAD{index:03d}x{flow:03d}" for flow in range(flows)] for index in range(sessions)]
+
+    return [[bundled[(index + flow) % len(bundled)] for flow in range(flows)] for index in range(sessions)]
+
+
+def build_replay_archive(archive, names, unique_objects: bool):
+    """
+    Record, without any network, what HSC and SDSS would answer for every object of the
+    load test: names are mapped onto the bundled cutouts, and every object gets a
+    synthetic spectrum. With unique_objects, every name also gets its own position and
+    noise realization, so no two sessions ever share a download or an election.
+    """
+    from astropy.io import fits
+    from hsc_downloader import HSCDownloader, Transport
+    from .fixtures import bundled_fits_paths
+
+    bundled = bundled_fits_paths()
+    transport = Transport(mode='record', archive=archive)
+    staging = Path(archive) / 'staging.fits'
+    staging.parent.mkdir(parents=True, exist_ok=True)
+
+    for i, name in enumerate(sorted(set(names))):
+        with fits.open(bundled[i % len(bundled)]) as hdul:
+            hdul = fits.HDUList([hdu.copy() for hdu in hdul])
+
+        header = hdul[1].header
+        ra, dec = float(header.get('CRVAL1', 0.0)) + i * 1e-3, float(header.get('CRVAL2', 0.0))
+        if unique_objects:
+            rng = np.random.default_rng(i)
+            hdul[1].data = hdul[1].data + rng.normal(0, 1e-3, hdul[1].data.shape).astype(hdul[1].data.dtype)
+
+        hdul.writeto(staging, overwrite=True)
+        transport.archive_name(name, (ra, dec))
+        transport.archive_file('cutout', HSCDownloader.cutout_request(ra=ra, dec=dec), staging)
+        transport.archive_spectrum({'ra': ra, 'dec': dec, 'radius': '8asec'}, _synthetic_spectrum(i))
+
+    staging.unlink()
+
+
+def _run(app, timeout: float):
+    app.run(timeout=timeout)
+    if len(app.exception):
+        raise RuntimeError(f"The app raised: {app.exception[0].message}")
+
+
+def _click(app, label: str, timeout: float):
+    for button in app.button:
+        if button.label == label:
+            button.click()
+            return _run(app, timeout)
+
+    raise RuntimeError(f"No '{label}' button on the {app.session_state['page']} page.")
+
+
+def _wait_for_page(app, page: str, poll_interval: float, timeout: float):
+    """Poll like the job progress fragment does, until the background job moved the session on."""
+    deadline = time.perf_counter() + timeout
+    while app.session_state['page'] != page:
+        if time.perf_counter() > deadline:
+            raise RuntimeError(f"Timed out waiting for the {page} page.")
+
+        time.sleep(poll_interval)
+        _run(app, timeout)
+
+
+def simulate_session(object_name: str, poll_interval: float, timeout: float):
+    """
+    Walk one analyst through the whole app.
+
+    :return: Seconds spent on every step of STEPS.
+    """
+    from streamlit.testing.v1 import AppTest
+
+    timings = dict()
+    app = AppTest.from_file(str(PACKAGE_DIR / 'frontend' / 'frontend.py'), default_timeout=timeout)
+
+    start = time.perf_counter()
+    _run(app, timeout)
+    _click(app, 'Submit', timeout)
+    timings['login'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    app.text_input[0].set_value(object_name)
+    _click(app, 'Submit', timeout)
+    _wait_for_page(app, 'Image', poll_interval, timeout)
+    timings['cutout'] = time.perf_counter() - start
+
+    # Submitting the Image page lands on the centroid detector once the election is done
+    start = time.perf_counter()
+    _click(app, 'Submit', timeout)
+    _wait_for_page(app, 'Inference', poll_interval, timeout)
+    timings['image'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _run(app, timeout)
+    timings['centroids'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _click(app, 'Finalize Centroids!', timeout)
+    timings['inference'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    slider = next(slider for slider in app.slider if slider.label.startswith('Radius of Centroid 1'))
+    slider.set_value(7)
+    _run(app, timeout)
+    timings['slider'] = time.perf_counter() - start
+
+    return timings
+
+
+def percentiles(samples):
+    samples = np.asarray(samples) * 1e3
+    return {
+        "count": len(samples),
+        "median_ms": float(np.percentile(samples, 50)) if len(samples) else None,
+        "p95_ms": float(np.percentile(samples, 95)) if len(samples) else None,
+        "p99_ms": float(np.percentile(samples, 99)) if len(samples) else None,
+    }
+
+
+def run_level(names, poll_interval: float, timeout: float):
+    """
+    Run one concurrent analyst per row of `names`, visiting each of its objects in turn.
+
+    :return: Latency percentiles per step, throughput and peak RSS of this process.
+    """
+    samples = {step: [] for step in STEPS}
+    errors, lock = [], threading.Lock()
+
+    def analyst(index):
+        for name in names[index]:
+            try:
+                timings = simulate_session(name, poll_interval, timeout)
+            except Exception as e:
+                with lock:
+                    errors.append(f"{name}: {e}")
+                continue
+
+            with lock:
+                for step, seconds in timings.items():
+                    samples[step].append(seconds)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=analyst, args=(i,)) for i in range(len(names))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    completed = len(samples['slider'])
+    return {
+        "sessions": len(names),
+        "flows_completed": completed,
+        "errors": errors,
+        "wall_s": wall,
+        "throughput_flows_per_min": completed / wall * 60,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "steps": {step: percentiles(values) for step, values in samples.items()},
+    }
+
+
+def worker(args):
+    """One concurrency level, in its own working directory and process."""
+    import logging
+    import matplotlib
+
+    matplotlib.use('Agg')
+    logging.basicConfig(level=logging.WARNING)
+
+    workdir = Path(tempfile.mkdtemp(prefix='dragon_load_'))
+    try:
+        # The app reads frontend/labels.csv and models/ relative to the working directory,
+        # and downloads into it.
+        (workdir / 'frontend').symlink_to(PACKAGE_DIR / 'frontend')
+        if args.model_dir is not None:
+            (workdir / 'models').symlink_to(Path(args.model_dir).resolve())
+        os.chdir(workdir)
+        sys.path[:0] = [str(PACKAGE_DIR), str(PACKAGE_DIR / 'frontend')]
+
+        if args.model_dir is None:
+            from .fixtures import write_random_checkpoints
+            write_random_checkpoints(workdir / 'models', num_voters=args.voters)
+
+        # HSC and SDSS are replayed from a local archive. The downloader is only imported
+        # now, so its default download directory is this working directory.
+        from hsc_downloader import Transport, set_transport
+
+        names = visit_names(args.sessions, args.flows, args.unique_objects)
+        build_replay_archive(workdir / 'archive', [name for row in names for name in row], args.unique_objects)
+        set_transport(Transport(mode='replay', archive=workdir / 'archive',
+                                latency=args.network_latency, bandwidth=args.bandwidth))
+
+        # There is no browser to click on the cutout, so every session gets the same two centroids
+        import dragon_display
+        dragon_display.bridge = lambda key, default=None: CENTROIDS
+
+        result = run_level(names, args.poll_interval, args.timeout)
+    finally:
+        os.chdir(PACKAGE_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the Streamlit app with concurrent simulated sessions.")
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 2, 4, 8], help="Concurrency levels.")
+    parser.add_argument('--flows', type=int, default=3, help="Visits per simulated analyst.")
+    parser.add_argument('--model-dir', default=None, help="Real checkpoints; random ones by default.")
+    parser.add_argument('--voters', type=int, default=7)
+    parser.add_argument('--unique-objects', action='store_true',
+                        help="Every visit looks at a different object (no shared downloads or elections).")
+    parser.add_argument('--network-latency', type=float, default=0.0, help="Simulated seconds per HSC/SDSS call.")
+    parser.add_argument('--bandwidth', type=float, default=None, help="Simulated download speed in bytes per second.")
+    parser.add_argument('--poll-interval', type=float, default=0.1)
+    parser.add_argument('--timeout', type=float, default=300.0)
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--baseline', default=None, help="Fail if the median of any step regressed.")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        args.sessions = args.sessions[0]
+        return worker(args)
+
+    from .harness import write_results, compare_results
+
+    levels = []
+    for sessions in args.sessions:
+        command = [sys.executable, '-m', 'benchmarks.load_test', '--worker', '--sessions', str(sessions),
+                   '--flows', str(args.flows), '--voters', str(args.voters),
+                   '--network-latency', str(args.network_latency), '--poll-interval', str(args.poll_interval),
+                   '--timeout', str(args.timeout)]
+        if args.model_dir is not None:
+            command += ['--model-dir', str(Path(args.model_dir).resolve())]
+        if args.bandwidth is not None:
+            command += ['--bandwidth', str(args.bandwidth)]
+        if args.unique_objects:
+            command.append('--unique-objects')
+
+        completed = subprocess.run(command, cwd=PACKAGE_DIR, capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f"The load test with {sessions} sessions failed:\n{completed.stderr}")
+
+        level = json.loads(completed.stdout.strip().splitlines()[-1])
+        levels.append(level)
+
+        print(f"{sessions:>3} sessions: {level['flows_completed']} visits in {level['wall_s']:.1f} s "
+              f"({level['throughput_flows_per_min']:.1f}/min), peak RSS {level['peak_rss_mb']:.0f} MB, "
+              f"{len(level['errors'])} errors")
+        for step, stats in level['steps'].items():
+            if stats['count']:
+                print(f"    {step:<10} p50 {stats['median_ms']:>9.1f} ms  p95 {stats['p95_ms']:>9.1f} ms  "
+                      f"p99 {stats['p99_ms']:>9.1f} ms")
+        for error in level['errors'][:5]:
+            print(f"    ERROR {error}")
+
+    # Flattened so the usual regression check applies to every step of every level
+    results = {
+        "levels": levels,
+        "benchmarks": {f"sessions_{level['sessions']}/{step}": stats
+                       for level in levels for step, stats in level['steps'].items() if stats['count']},
+    }
+    if args.output is not None:
+        write_results(results, args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            regressions = compare_results(results, json.load(file), tolerance=args.tolerance)
+
+        for name, before, after in regressions:
+            print(f"REGRESSION {name}: {before:.1f} ms -> {after:.1f} ms")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
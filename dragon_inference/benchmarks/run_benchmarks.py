@@ -0,0 +1,159 @@
+"""
+Reproducible, CPU-only benchmark suite for the DRAGON pipeline. It only uses the
+bundled FITS cutouts and randomly initialized checkpoints, so it never touches
+the network.
+
+Run from the dragon_inference directory:
+
+    python -m benchmarks.run_benchmarks --output bench.json
+    python -m benchmarks.run_benchmarks --output new.json --baseline bench.json
+"""
+import os
+
+# CPU only, regardless of the machine the suite runs on. This has to happen before torch is imported.
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+import argparse
+import io
+import json
+import logging
+import sys
+import tempfile
+
+import numpy as np
+import torch
+import matplotlib
+
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from dragon_inference import DRAGONEnsemble
+from dragon_analysis import DRAGONAnalysis
+from utils import load_fits, implot
+from .fixtures import bundled_fits_paths, load_bundled_cutouts, write_random_checkpoints
+from .harness import measure, system_info, write_results, compare_results
+
+
+def bench_ensemble_load(model_dir, repeats):
+    return measure(lambda: DRAGONEnsemble(model_dir=model_dir), repeats=repeats, warmup=1)
+
+
+def bench_elections(ensemble, images, batch_sizes, repeats):
+    results = {
+        "election_single": measure(lambda: ensemble.run_election(image=images[0]), repeats=repeats),
+        "election_single_tta": measure(lambda: ensemble.run_election(image=images[0], tta=True), repeats=repeats),
+    }
+
+    for batch_size in batch_sizes:
+        # Tile the bundled cutouts up to the batch size
+        batch = np.stack([images[i % len(images)] for i in range(batch_size)])
+        results[f"election_batch_{batch_size}"] = measure(
+            lambda: ensemble.run_batch_election(images=batch), repeats=repeats, items=batch_size
+        )
+
+    return results
+
+
+def bench_load_fits(path, repeats):
+    def cold():
+        load_fits.clear()
+        load_fits(file_path=str(path), extension=1)
+
+    load_fits(file_path=str(path), extension=1)
+    return {
+        "load_fits_cold": measure(cold, repeats=repeats, warmup=0),
+        "load_fits_warm": measure(lambda: load_fits(file_path=str(path), extension=1), repeats=repeats),
+    }
+
+
+def bench_implot(path, repeats):
+    header, data = load_fits(file_path=str(path), extension=1)
+
+    def render():
+        fig, ax = implot(image=data, figsize=(8, 8), wcs=header, grid=True)
+        fig.savefig(io.BytesIO(), format='png')
+        plt.close(fig)
+
+    return {"implot_render": measure(render, repeats=repeats)}
+
+
+def bench_photometry(image, repeats):
+    height, width = image.shape
+    centers = [(width / 2 - 3, height / 2), (width / 2 + 3, height / 2)]
+
+    return {"photometry": measure(lambda: DRAGONAnalysis.calculate_magnitudes(
+        image=image, center_coords=centers, radii=[5, 5], fluxmag_0=63095734448.0
+    ), repeats=repeats)}
+
+
+def bench_separation(catalog_sizes, repeats, seed=0):
+    rng = np.random.default_rng(seed)
+
+    results = dict()
+    for size in catalog_sizes:
+        ra1, ra2 = rng.uniform(0, 360, size), rng.uniform(0, 360, size)
+        dec1, dec2 = rng.uniform(-90, 90, size), rng.uniform(-90, 90, size)
+
+        results[f"separation_{size}"] = measure(
+            lambda: DRAGONAnalysis.angular_separation(ra1, dec1, ra2, dec2), repeats=repeats, items=size
+        )
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the DRAGON benchmark suite.")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', default=None, help="A previous result file to check for regressions.")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative slowdown.")
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--voters', type=int, default=7)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32, 128])
+    parser.add_argument('--catalog-sizes', type=int, nargs='+', default=[10_000, 1_000_000])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    torch.manual_seed(args.seed)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    paths = bundled_fits_paths()
+    images = load_bundled_cutouts()
+
+    benchmarks = dict()
+    with tempfile.TemporaryDirectory() as model_dir:
+        write_random_checkpoints(model_dir, num_voters=args.voters, seed=args.seed)
+
+        benchmarks["ensemble_load"] = bench_ensemble_load(model_dir, repeats=max(args.repeats // 5, 1))
+        ensemble = DRAGONEnsemble(model_dir=model_dir)
+        benchmarks.update(bench_elections(ensemble, images, args.batch_sizes, repeats=args.repeats))
+
+    benchmarks.update(bench_load_fits(paths[0], repeats=args.repeats))
+    benchmarks.update(bench_implot(paths[0], repeats=args.repeats))
+    benchmarks.update(bench_photometry(images[0], repeats=args.repeats))
+    benchmarks.update(bench_separation(args.catalog_sizes, repeats=args.repeats, seed=args.seed))
+
+    results = {
+        "system": system_info(),
+        "config": {"voters": args.voters, "repeats": args.repeats, "seed": args.seed},
+        "benchmarks": benchmarks,
+    }
+    write_results(results, args.output)
+
+    for name, result in benchmarks.items():
+        print(f"{name:<28} {result['median_ms']:>10.3f} ms  {result['throughput_per_s']:>12.1f} /s")
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            regressions = compare_results(results, json.load(file), tolerance=args.tolerance)
+
+        for name, before, after in regressions:
+            print(f"REGRESSION {name}: {before:.3f} ms -> {after:.3f} ms")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
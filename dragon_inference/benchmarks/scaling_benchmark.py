@@ -0,0 +1,75 @@
+"""
+Throughput of sharded batch classification as the number of worker processes grows.
+Every worker runs a single intra-op thread, so ideal scaling is linear in the worker count.
+
+Run from the dragon_inference directory:
+
+    python -m benchmarks.scaling_benchmark --catalog-size 512 --output scaling.json
+"""
+import os
+
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+import argparse
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from dragon_inference import classify_catalog
+from .fixtures import bundled_fits_paths, write_random_checkpoints
+from .harness import system_info, write_results
+
+
+def build_catalog(catalog_dir, size):
+    """Replicate the bundled cutouts into a synthetic catalog of the requested size."""
+    sources = bundled_fits_paths()
+    paths = []
+    for i in range(size):
+        path = Path(catalog_dir) / f"object_{i:06d}.fits"
+        shutil.copyfile(sources[i % len(sources)], path)
+        paths.append(path)
+
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark multi-process scaling of batch classification.")
+    parser.add_argument('--catalog-size', type=int, default=512)
+    parser.add_argument('--workers', type=int, nargs='+', default=None)
+    parser.add_argument('--voters', type=int, default=7)
+    parser.add_argument('--output', default='scaling_results.json')
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({1, 2, 4, 8, 16, cores} & set(range(1, cores + 1)))
+
+    results = dict()
+    with tempfile.TemporaryDirectory() as model_dir, tempfile.TemporaryDirectory() as catalog_dir:
+        write_random_checkpoints(model_dir, num_voters=args.voters)
+        paths = build_catalog(catalog_dir, args.catalog_size)
+
+        for workers in worker_counts:
+            start = time.perf_counter()
+            classified = sum(len(chunk) for chunk in classify_catalog(
+                paths, model_dir=model_dir, workers=workers, threads_per_worker=1
+            ))
+            elapsed = time.perf_counter() - start
+
+            results[workers] = {"seconds": elapsed, "throughput_per_s": classified / elapsed}
+            print(f"{workers:>3} workers: {classified / elapsed:>9.1f} cutouts/s")
+
+    baseline = results[worker_counts[0]]['throughput_per_s'] / worker_counts[0]
+    for workers, result in results.items():
+        result["speedup"] = result['throughput_per_s'] / baseline
+        result["efficiency"] = result["speedup"] / workers
+
+    write_results({
+        "system": system_info(),
+        "config": {"catalog_size": args.catalog_size, "voters": args.voters},
+        "scaling": {str(workers): result for workers, result in results.items()},
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Compares the fully-convolutional scan of a patch against classifying the same windows
+one cutout at a time with run_batch_election, for both speed and agreement. The
+windowed network zero-pads every cutout at its own border, while the scan sees the
+real neighbouring pixels there, so the two are not expected to agree exactly; this
+measures by how much they differ.
+
+Run from the dragon_inference directory:
+
+    python -m benchmarks.scan_benchmark --size 1024 --repeats 3
+"""
+import argparse
+import tempfile
+import json
+
+import numpy as np
+import torch
+
+from dragon_inference import DRAGONEnsemble, DRAGONScanner
+from .fixtures import load_bundled_cutouts, write_random_checkpoints
+from .harness import measure
+
+
+def synthetic_patch(size: int):
+    """A size x size patch tiled from the bundled cutouts, so it has real sources and noise."""
+    images = load_bundled_cutouts()
+    row = np.concatenate(images, axis=1)
+    reps = (-(-size // row.shape[0]), -(-size // row.shape[1]))
+    return np.ascontiguousarray(np.tile(row, reps)[:size, :size])
+
+
+def scan_windows(patch, window: int, stride: int):
+    """The windows of the scan grid as a batch, in row-major cell order."""
+    rows = (patch.shape[0] - window) // stride + 1
+    cols = (patch.shape[1] - window) // stride + 1
+    windows = np.stack([
+        patch[i * stride:i * stride + window, j * stride:j * stride + window]
+        for i in range(rows) for j in range(cols)
+    ])
+    return windows, rows, cols
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the scan against windowed elections.")
+    parser.add_argument('--size', type=int, default=1024, help="Side of the synthetic patch in pixels.")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--voters', type=int, default=7)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    patch = synthetic_patch(args.size)
+    with tempfile.TemporaryDirectory() as model_dir:
+        write_random_checkpoints(model_dir, num_voters=args.voters)
+        scanner = DRAGONScanner(model_dir=model_dir)
+        ensemble = DRAGONEnsemble(model_dir=model_dir)
+
+        windows, rows, cols = scan_windows(patch, scanner.window, scanner.stride)
+        scanned = scanner.scan(patch)
+        elected = ensemble.run_batch_election(images=windows)
+
+        scan_timing = measure(lambda: scanner.scan(patch), repeats=args.repeats, items=len(windows))
+        window_timing = measure(lambda: ensemble.run_batch_election(images=windows),
+                                repeats=args.repeats, items=len(windows))
+
+    probabilities = np.stack([np.asarray(result['votes']).mean(axis=0) for result in elected])
+    probabilities = probabilities.reshape(rows, cols, -1).transpose(2, 0, 1)
+    voted_class = np.array([result['voted_class'] for result in elected]).reshape(rows, cols)
+    difference = np.abs(scanned['probabilities'] - probabilities)
+
+    results = {
+        "voters": args.voters,
+        "windows": len(windows),
+        "scan": scan_timing,
+        "windowed": window_timing,
+        "speedup": window_timing['median_ms'] / scan_timing['median_ms'],
+        "voted_class_agreement": float((scanned['voted_class'] == voted_class).mean()),
+        "probability_max_abs_diff": float(difference.max()),
+        "probability_mean_abs_diff": float(difference.mean()),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Compares the latency of a plain election against an election with test-time
+augmentation (all 8 dihedral views in one batched forward pass per voter).
+
+Run from the dragon_inference directory:
+
+    python -m benchmarks.tta_benchmark --repeats 20
+"""
+import argparse
+import tempfile
+import json
+
+import torch
+
+from dragon_inference import DRAGONEnsemble
+from .fixtures import load_bundled_cutouts, write_random_checkpoints
+from .harness import measure
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark test-time augmentation overhead.")
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--voters', type=int, default=7)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    images = load_bundled_cutouts()
+    with tempfile.TemporaryDirectory() as model_dir:
+        write_random_checkpoints(model_dir, num_voters=args.voters)
+        ensemble = DRAGONEnsemble(model_dir=model_dir)
+
+        base = measure(lambda: [ensemble.run_election(image=image) for image in images],
+                       repeats=args.repeats, items=len(images))
+        tta = measure(lambda: [ensemble.run_election(image=image, tta=True) for image in images],
+                      repeats=args.repeats, items=len(images))
+
+    results = {
+        "voters": args.voters,
+        "base": base,
+        "tta": tta,
+        "tta_overhead_ratio": tta['median_ms'] / base['median_ms'],
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
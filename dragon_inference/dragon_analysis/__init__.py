@@ -1,2 +1,7 @@
 from .inference import *
-from .centroid_point import *
\ No newline at end of file
+from .centroid_point import *
+from .catalog_index import *
+from .fitting import *
+from .spectral_lines import *
+from .psf_photometry import *
+from .uncertainty import *
\ No newline at end of file
@@ -0,0 +1,170 @@
+from pathlib import Path
+import logging
+import json
+
+import numpy as np
+
+from utils import unit_vectors
+
+META_FILE = 'catalog.json'
+ARCSEC_PER_RADIAN = 180 / np.pi * 3600
+
+
+def _chord(arcsec):
+    """Angular separation -> straight-line distance between unit vectors."""
+    return 2 * np.sin(np.asarray(arcsec) / ARCSEC_PER_RADIAN / 2)
+
+
+def _arcsec(chord):
+    """Straight-line distance between unit vectors -> angular separation."""
+    return 2 * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1)) * ARCSEC_PER_RADIAN
+
+
+class CatalogIndex:
+    def __init__(self, directory):
+        """
+        A local catalog of DRAGON results for cross-matching. Every column is a .npy file
+        that is memory-mapped on open, so even a catalog of millions of objects loads
+        instantly; the KD-tree over unit vectors is only built on the first spatial query.
+
+        :param directory: A directory written by CatalogIndex.build.
+        """
+        self.directory = Path(directory)
+        meta_path = self.directory / META_FILE
+        if not meta_path.is_file():
+            raise RuntimeError(f"No catalog found in {self.directory}.")
+
+        with meta_path.open() as file:
+            self.meta = json.load(file)
+
+        self.columns = {
+            name: np.load(self.directory / f"{name}.npy", mmap_mode='r')
+            for name in self.meta['columns']
+        }
+        self._xyz = np.load(self.directory / "xyz.npy", mmap_mode='r')
+        self._tree = None
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    @staticmethod
+    def build(directory, ra, dec, **columns):
+        """
+        Write a catalog as columnar arrays.
+
+        :param ra: Right ascensions in degrees.
+        :param dec: Declinations in degrees.
+        :param columns: Any further per-object columns (voted_class, average_confidence, name, ...).
+        :return: The opened CatalogIndex.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        ra, dec = np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64)
+        columns = {"ra": ra, "dec": dec, **{name: np.asarray(values) for name, values in columns.items()}}
+        for name, values in columns.items():
+            if len(values) != len(ra):
+                raise RuntimeError(f"Column {name} has {len(values)} rows instead of {len(ra)}.")
+            np.save(directory / f"{name}.npy", values)
+
+        np.save(directory / "xyz.npy", unit_vectors(ra, dec))
+        with (directory / META_FILE).open('w') as file:
+            json.dump({"rows": len(ra), "columns": list(columns)}, file, indent=2)
+
+        logging.info(f"Wrote a catalog of {len(ra)} objects to {directory}.")
+        return CatalogIndex(directory)
+
+    @staticmethod
+    def from_results(directory, results, ra, dec, names=None):
+        """
+        Build a catalog from DRAGON election results (e.g. the output of classify_catalog).
+
+        :param results: A list of Congressional aggregates, aligned with ra/dec. Entries
+        without a vote (e.g. the {"path", "error"} entries of failed cutouts) are left out.
+        Elections that stopped early (num_voters and average_confidence of None) are
+        stored with -1 voters and a NaN confidence.
+        :param names: Optional object names.
+        """
+        voted = np.array(['voted_class' in result for result in results], dtype=bool)
+        if not voted.all():
+            logging.warning(f"Leaving {int((~voted).sum())} results without a vote out of the catalog.")
+
+        results = [result for result, keep in zip(results, voted) if keep]
+        ra, dec = np.asarray(ra)[voted], np.asarray(dec)[voted]
+
+        columns = {
+            "voted_class": np.array([result['voted_class'] for result in results], dtype=np.int16),
+            "num_voters": np.array([-1 if result['num_voters'] is None else result['num_voters']
+                                    for result in results], dtype=np.int16),
+            "average_confidence": np.array([np.nan if result['average_confidence'] is None
+                                            else result['average_confidence'] for result in results],
+                                           dtype=np.float32),
+        }
+        if names is not None:
+            columns["name"] = np.array(names, dtype=str)[voted]
+
+        return CatalogIndex.build(directory, ra, dec, **columns)
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+
+            self._tree = cKDTree(self._xyz)
+
+        return self._tree
+
+    def cone_search(self, ra, dec, radius_arcsec: float):
+        """
+        Vectorized cone search around one or many positions.
+
+        :return: For every position, the array of catalog rows within the radius.
+        """
+        centers = unit_vectors(np.atleast_1d(ra), np.atleast_1d(dec))
+        matches = self.tree.query_ball_point(centers, r=_chord(radius_arcsec), return_sorted=True)
+        return [np.asarray(rows, dtype=np.int64) for rows in matches]
+
+    def nearest(self, ra, dec, k: int = 1, max_arcsec: float = np.inf):
+        """
+        k nearest catalog neighbours of one or many positions.
+
+        :return: (separations in arcsec, catalog rows), each of shape [M, k]. Neighbours
+        beyond max_arcsec have an infinite separation and row len(self).
+        """
+        centers = unit_vectors(np.atleast_1d(ra), np.atleast_1d(dec))
+        upper = _chord(max_arcsec) if np.isfinite(max_arcsec) else np.inf
+        distances, rows = self.tree.query(centers, k=k, distance_upper_bound=upper)
+
+        distances = np.asarray(distances).reshape(len(centers), k)
+        rows = np.asarray(rows).reshape(len(centers), k)
+
+        separations = np.full(distances.shape, np.inf)
+        found = np.isfinite(distances)
+        separations[found] = _arcsec(distances[found])
+        return separations, rows
+
+    def crossmatch(self, ra, dec, radius_arcsec: float):
+        """
+        Join external positions (e.g. SDSS objects with spectra) to the catalog.
+
+        :return: (catalog row of the nearest match or -1, separation in arcsec or inf), each of shape [M].
+        """
+        separations, rows = self.nearest(ra, dec, k=1, max_arcsec=radius_arcsec)
+        rows, separations = rows[:, 0], separations[:, 0]
+        return np.where(np.isfinite(separations), rows, -1), separations
+
+    def self_match(self, radius_arcsec: float):
+        """
+        Every pair of catalog objects within the radius of each other, for close pairs and repeats.
+
+        :return: (rows of shape [P, 2] with i < j, separations in arcsec of shape [P])
+        """
+        pairs = self.tree.query_pairs(r=_chord(radius_arcsec), output_type='ndarray')
+        if not len(pairs):
+            return np.empty((0, 2), dtype=np.int64), np.empty(0)
+
+        separations = _arcsec(np.linalg.norm(self._xyz[pairs[:, 0]] - self._xyz[pairs[:, 1]], axis=1))
+        return pairs, separations
@@ -1,5 +1,3 @@
-from astropy.wcs import WCS
-
 class CentroidPoint:
     def __init__(self, point_dict):
         if 'x' not in point_dict or 'y' not in point_dict:
@@ -31,6 +29,8 @@ class CentroidPoint:
         """
         Convenience method to help with conversion to WCS.
         """
+        from astropy.wcs import WCS
+
         if not (w := WCS(wcs_header)): # I decided to use a walrus statement because why not?
             raise RuntimeError("Invalid WCS header provided")
 
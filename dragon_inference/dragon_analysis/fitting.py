@@ -0,0 +1,72 @@
+"""
+Fitting helpers shared by the analysis modules: a batched Levenberg-Marquardt for many
+independent least-squares problems at once, and a robust sky noise estimate.
+"""
+import numpy as np
+
+
+def sky_noise(image):
+    """A robust estimate of the per-pixel noise, from the median absolute deviation of the image."""
+    image = np.asarray(image, dtype=np.float64)
+    image = image[np.isfinite(image)]
+    return 1.4826 * np.median(np.abs(image - np.median(image)))
+
+
+def _project(params, amplitudes, sigmas, sigma_bounds):
+    """Keep amplitudes non-negative and widths within bounds."""
+    params[:, amplitudes] = np.maximum(params[:, amplitudes], 0)
+    if sigmas:
+        params[:, sigmas] = np.clip(params[:, sigmas], *sigma_bounds)
+    return params
+
+
+def levenberg_marquardt(model_fn, params, x, y, weights, iterations: int = 50,
+                        amplitudes=(), sigmas=(), damping: float = 1e-3, sigma_bounds=None):
+    """
+    Levenberg-Marquardt for a batch of independent least-squares problems that share
+    their abscissae. Every problem keeps its own damping, and only accepts steps that
+    lower its own chi-square.
+
+    :param model_fn: (params [N, P], x [W]) -> (model [N, W], Jacobian [N, W, P]).
+    :param params: Starting parameters, [N, P].
+    :param y: Data, [N, W].
+    :param weights: Inverse variances, [N, W].
+    :param amplitudes: Indices of parameters that must stay non-negative.
+    :param sigmas: Indices of the Gaussian widths, kept within sigma_bounds.
+    :param sigma_bounds: (min, max) of the widths, in the units of the model; required with sigmas.
+    :return: (params [N, P], chi-square [N], parameter covariance [N, P, P])
+    """
+    if sigmas and sigma_bounds is None:
+        raise RuntimeError("Fitting Gaussian widths needs their sigma_bounds.")
+
+    params = _project(np.array(params, dtype=np.float64), list(amplitudes), list(sigmas), sigma_bounds)
+    y, weights = np.asarray(y, dtype=np.float64), np.asarray(weights, dtype=np.float64)
+    lambdas = np.full(len(params), damping)
+    identity = np.eye(params.shape[1])
+
+    model, jacobian = model_fn(params, x)
+    chi2 = (weights * (y - model) ** 2).sum(axis=1)
+
+    for _ in range(iterations):
+        residual = y - model
+        jtw = jacobian.transpose(0, 2, 1) * weights[:, np.newaxis, :]
+        jtj = jtw @ jacobian
+        gradient = (jtw @ residual[..., np.newaxis])[..., 0]
+
+        # Marquardt's scaling of the damping by the diagonal, plus a floor for flat directions
+        diagonal = np.einsum('npp->np', jtj)
+        damped = jtj + lambdas[:, np.newaxis, np.newaxis] * (diagonal[:, np.newaxis, :] * identity + 1e-12 * identity)
+        step = np.linalg.solve(damped, gradient[..., np.newaxis])[..., 0]
+
+        trial = _project(params + step, list(amplitudes), list(sigmas), sigma_bounds)
+        trial_model, trial_jacobian = model_fn(trial, x)
+        trial_chi2 = (weights * (y - trial_model) ** 2).sum(axis=1)
+
+        better = trial_chi2 < chi2
+        params[better], model[better], jacobian[better], chi2[better] = \
+            trial[better], trial_model[better], trial_jacobian[better], trial_chi2[better]
+        lambdas = np.where(better, lambdas / 10, lambdas * 10).clip(1e-9, 1e9)
+
+    jtj = (jacobian.transpose(0, 2, 1) * weights[:, np.newaxis, :]) @ jacobian
+    covariance = np.linalg.pinv(jtj)
+    return params, chi2, covariance
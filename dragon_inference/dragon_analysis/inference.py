@@ -1,18 +1,28 @@
-from dragon_inference import DRAGONEnsemble
-from photutils import CircularAperture, CircularAnnulus, aperture_photometry
+from dragon_inference import image_content_hash, model_dir_fingerprint
 from .centroid_point import CentroidPoint
 from typing import List
 
 import numpy as np
 import logging
+import os
+
+from utils import timed
 
 class DRAGONAnalysis:
-    def __init__(self, model_dir='models'):
+    def __init__(self, model_dir='models', tta=False, aggregation='hard', store=None):
         """
         Interface to run DRAGON.
+
+        :param model_dir: The directory containing the Congress checkpoints.
+        :param tta: Whether to use test-time augmentation over the dihedral views of the image.
+        :param aggregation: How the Congress' votes are aggregated (hard, soft, weighted or temperature).
+        :param store: An optional PredictionStore that remembers every election across sessions.
         """
+        # torch is only imported once the Congress is actually assembled
+        from dragon_inference import DRAGONEnsemble
+
         logging.info("Initializing DRAGON models...")
-        self.ensemble = DRAGONEnsemble(model_dir=model_dir)
+        self.ensemble = DRAGONEnsemble(model_dir=model_dir, tta=tta, aggregation=aggregation, store=store)
 
     def run(self, image):
         # Using the ensemble!
@@ -20,11 +30,57 @@ class DRAGONAnalysis:
         return classification
 
     @staticmethod
+    def lookup(image, store, model_dir='models', tta=False, aggregation='hard'):
+        """
+        Check the prediction store for a previous election on this exact cutout by the
+        current model set, without loading any of the models. The stored votes are
+        re-certified, so a changed aggregation policy or a refit calibration.json is
+        followed just like DRAGONEnsemble does.
+
+        :return: The classification, or None if DRAGON has to run.
+        """
+        from dragon_inference import aggregate, CongressCalibration
+
+        stored = store.get(
+            image_content_hash(image),
+            fingerprint=model_dir_fingerprint(model_dir),
+            tta=tta
+        )
+        if stored is None:
+            return None
+
+        temperatures, weights = None, None
+        if aggregation in ('weighted', 'temperature'):
+            # A missing or stale calibration is the ensemble's to report
+            calibration = CongressCalibration.load(model_dir)
+            if calibration is None:
+                return None
+            try:
+                temperatures, weights = calibration.for_voters(
+                    sorted(path for path in os.listdir(model_dir) if path.endswith('.pt'))
+                )
+            except RuntimeError:
+                return None
+
+        votes = np.asarray(stored['votes'], dtype=np.float32)
+        certified = aggregate(votes[np.newaxis], mode=aggregation, weights=weights, temperatures=temperatures)
+        return {
+            **stored,
+            "voted_class": int(certified["voted_class"][0]),
+            "num_voters": int(certified["num_voters"][0]),
+            "average_confidence": float(certified["average_confidence"][0]),
+            "aggregation": aggregation,
+        }
+
+    @staticmethod
+    @timed('photometry')
     def calculate_magnitudes(
             image: np.ndarray,
             center_coords: List[CentroidPoint],
             radii: List[float],
-            fluxmag_0: float
+            fluxmag_0: float,
+            realizations: int = None,
+            variance: np.ndarray = None
     ):
         """
         This is an adaptation of Isaac's magnitude calculation code done over the summer
@@ -33,8 +89,14 @@ class DRAGONAnalysis:
         :param image:
         :param center_coords:
         :param radii:
+        :param realizations: If given, also estimate the errors ("<key>_err") from this
+        many Monte Carlo noise realizations of the image.
+        :param variance: The variance plane of the cutout for the noise realizations; by
+        default the sky noise is estimated from the image.
         :return:
         """
+        from photutils import CircularAperture, aperture_photometry
+
         adu_mag_conv = lambda flux, fluxMag_0: 2.5 * np.log10(fluxMag_0 / flux)
 
         logging.info("Calculating magnitudes...")
@@ -62,7 +124,7 @@ class DRAGONAnalysis:
         mag_difference = np.abs(inst_mag_1 - inst_mag_2)
 
         # Final output as a dictionary
-        return {
+        magnitudes = {
             "magnitude_1": inst_mag_1,
             "magnitude_2": inst_mag_2,
             "flux_ratio": flux_ratio,
@@ -71,6 +133,36 @@ class DRAGONAnalysis:
             "aperture2": aperture_2
         }
 
+        if realizations:
+            from .uncertainty import magnitude_uncertainties
+
+            magnitudes.update(magnitude_uncertainties(
+                image, center_coords, radii, fluxmag_0=fluxmag_0, k=realizations, variance=variance
+            ))
+
+        return magnitudes
+
+    @staticmethod
+    @timed('psf_photometry')
+    def calculate_psf_magnitudes(
+            image: np.ndarray,
+            center_coords: List[CentroidPoint],
+            fluxmag_0: float,
+            variance: np.ndarray = None
+    ):
+        """
+        Like calculate_magnitudes, but the two sources are deblended by fitting two PSFs
+        jointly instead of summing apertures, which overlap for close pairs. The result
+        has the same keys, plus errors and the fitted separation.
+
+        :param center_coords: Starting positions of both sources.
+        :param variance: The variance plane of the cutout, if there is one.
+        """
+        from .psf_photometry import psf_magnitudes
+
+        logging.info("Fitting PSF magnitudes...")
+        return psf_magnitudes(image, center_coords, fluxmag_0=fluxmag_0, variance=variance)
+
     @staticmethod
     def angular_separation(ra1, dec1, ra2, dec2):
         ra1 = np.radians(ra1)
@@ -93,4 +185,16 @@ class DRAGONAnalysis:
         if p1.ra is None or p2.ra is None:
             raise RuntimeError("P1 and P2 must have an associated RA and Dec.")
 
-        return DRAGONAnalysis.angular_separation(ra1=p1.ra, ra2=p2.ra, dec1=p1.dec, dec2=p2.dec)
\ No newline at end of file
+        return DRAGONAnalysis.angular_separation(ra1=p1.ra, ra2=p2.ra, dec1=p1.dec, dec2=p2.dec)
+
+    @staticmethod
+    @timed('separation_uncertainty')
+    def separation_uncertainty(p1: CentroidPoint, p2: CentroidPoint, wcs_header, realizations: int = 1000):
+        """
+        Monte Carlo error of the separation, from jittering both centroids by half a pixel.
+
+        :return: {"separation_arcsec": ..., "separation_arcsec_err": ...}
+        """
+        from .uncertainty import separation_uncertainty
+
+        return separation_uncertainty(p1, p2, wcs_header, k=realizations)
\ No newline at end of file
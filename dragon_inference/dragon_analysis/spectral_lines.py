@@ -0,0 +1,348 @@
+"""
+Batched narrow-line measurements for dual AGN vetting. All spectra are resampled onto
+one rest-frame log-wavelength grid, so every line window is the same pixels for every
+object, and single- and double-Gaussian profiles are fit to all of them at once with a
+batched Levenberg-Marquardt.
+
+Run from the dragon_inference directory:
+
+    python -m dragon_analysis.spectral_lines --store spectrum_store --ingest spectra --output lines.npz
+"""
+import argparse
+import warnings
+import logging
+
+import numpy as np
+
+from .fitting import levenberg_marquardt
+
+SPEED_OF_LIGHT = 299792.458  # km/s
+
+# SDSS spectra are sampled every 1e-4 in log10(wavelength), i.e. ~69 km/s per pixel.
+LOGLAM_STEP = 1e-4
+REST_GRID = (np.log10(3600.0), np.log10(7000.0))
+
+# Line -> (rest vacuum wavelength in Angstrom, half width of the fit window in km/s).
+LINES = {
+    'OIII_5007': (5008.24, 1500.0),
+    'Hbeta': (4862.68, 1200.0),
+    'Halpha': (6564.61, 1500.0),
+}
+
+# Line -> a doublet blended into its window, fit along with it: the doublet's rest vacuum
+# wavelengths and their flux ratio, with one shared velocity and width. [NII] 6548 and
+# 6583 sit at -674 and +943 km/s from H-alpha, so no window wide enough for H-alpha avoids
+# them; left out, [NII] 6548 would pass for a blue H-alpha component.
+DOUBLETS = {
+    'Halpha': ((6549.86, 6585.27), (1.0, 3.0)),
+}
+
+# Pixels this close (km/s) to a doublet line are left out of the starting guesses.
+_DOUBLET_EXCLUSION = 400.0
+
+# Bounds of the Gaussian widths (km/s), and the starting guesses of a double-peaked profile.
+_SIGMA_BOUNDS = (20.0, 1000.0)
+_DOUBLE_PEAK_GUESS = 150.0
+
+
+def rest_frame_grid(bounds=REST_GRID, step: float = LOGLAM_STEP):
+    return np.arange(bounds[0], bounds[1], step)
+
+
+def resample(offsets, loglam, flux, ivar, redshifts, grid=None):
+    """
+    Shift every spectrum to its rest frame and linearly interpolate it onto a common
+    log-wavelength grid, for all spectra at once. This relies on the spectra being
+    uniformly sampled in log-wavelength, as SDSS spectra are, so every grid point's
+    position in a spectrum is one subtraction and one division away.
+
+    :param offsets: Spectrum i occupies offsets[i]:offsets[i + 1] of the flat columns (see SpectrumStore).
+    :param loglam: Flat log10(wavelength) column.
+    :param flux: Flat flux column.
+    :param ivar: Flat inverse variance column.
+    :param redshifts: The redshift of every spectrum.
+    :param grid: The rest-frame log10(wavelength) grid; see rest_frame_grid.
+    :return: (flux, ivar), each of shape [N, G]. Grid points outside a spectrum's
+    coverage, or next to a masked pixel, have zero inverse variance.
+    """
+    grid = rest_frame_grid() if grid is None else np.asarray(grid)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    starts, lengths = offsets[:-1], np.diff(offsets)
+
+    # Observed-frame log-wavelength of every grid point, and its fractional pixel in each spectrum.
+    # The step comes from the whole spectrum: two neighbouring float32 samples are too coarse
+    # for it, and the error grows into pixels (hundreds of km/s) toward the red end.
+    first = np.asarray(loglam[starts], dtype=np.float64)
+    last = np.asarray(loglam[starts + np.maximum(lengths - 1, 0)], dtype=np.float64)
+    step = np.where(lengths > 1, (last - first) / np.maximum(lengths - 1, 1), LOGLAM_STEP)
+    observed = grid[np.newaxis, :] + np.log10(1 + np.asarray(redshifts, dtype=np.float64))[:, np.newaxis]
+    position = (observed - first[:, np.newaxis]) / step[:, np.newaxis]
+
+    left = np.floor(position).astype(np.int64)
+    inside = (left >= 0) & (left + 1 < lengths[:, np.newaxis])
+    left = np.clip(left, 0, np.maximum(lengths - 2, 0)[:, np.newaxis])
+    fraction = (position - left).astype(np.float32)
+
+    index = starts[:, np.newaxis] + left
+    flux_left, flux_right = np.asarray(flux[index]), np.asarray(flux[index + 1])
+    ivar_left, ivar_right = np.asarray(ivar[index]), np.asarray(ivar[index + 1])
+
+    resampled_flux = (1 - fraction) * flux_left + fraction * flux_right
+
+    # Variances interpolate like the flux; a masked neighbour masks the grid point
+    valid = inside & (ivar_left > 0) & (ivar_right > 0)
+    variance = (1 - fraction) ** 2 / np.where(valid, ivar_left, 1) + fraction ** 2 / np.where(valid, ivar_right, 1)
+    resampled_ivar = np.where(valid, 1 / variance, 0).astype(np.float32)
+
+    return np.where(valid, resampled_flux, 0).astype(np.float32), resampled_ivar
+
+
+def _single_gaussian(params, x):
+    """
+    Linear continuum plus one Gaussian in velocity, and its Jacobian.
+
+    :param params: [N, 5]: continuum level, continuum slope, amplitude, center, sigma.
+    :param x: Velocities of the window pixels, shape [W].
+    :return: (model [N, W], Jacobian [N, W, 5])
+    """
+    c0, c1, amplitude, center, sigma = (params[:, k, np.newaxis] for k in range(5))
+    u = (x - center) / sigma
+    gauss = np.exp(-0.5 * u ** 2)
+
+    model = c0 + c1 * x + amplitude * gauss
+    jacobian = np.stack([
+        np.ones_like(model), np.broadcast_to(x, model.shape), gauss,
+        amplitude * gauss * u / sigma, amplitude * gauss * u ** 2 / sigma,
+    ], axis=-1)
+    return model, jacobian
+
+
+def _double_gaussian(params, x):
+    """
+    Linear continuum plus two Gaussians in velocity, and its Jacobian.
+
+    :param params: [N, 8]: continuum level, continuum slope, then amplitude, center and
+    sigma of the blue and the red component.
+    """
+    continuum = params[:, 0, np.newaxis] + params[:, 1, np.newaxis] * x
+    blue, blue_jacobian = _single_gaussian(np.concatenate([np.zeros_like(params[:, :2]), params[:, 2:5]], axis=1), x)
+    red, red_jacobian = _single_gaussian(np.concatenate([np.zeros_like(params[:, :2]), params[:, 5:8]], axis=1), x)
+
+    jacobian = np.concatenate([blue_jacobian[..., :2], blue_jacobian[..., 2:], red_jacobian[..., 2:]], axis=-1)
+    return continuum + blue + red, jacobian
+
+
+def _with_doublet(model_fn, offsets, ratios):
+    """
+    Add a fixed-ratio doublet to a line model.
+
+    :param model_fn: The model of the line itself, e.g. _single_gaussian.
+    :param offsets: Velocities of the doublet lines relative to the line, shape [2].
+    :param ratios: Peak amplitudes of the doublet lines relative to the amplitude parameter.
+    :return: A model taking three more parameters: the doublet's amplitude, velocity shift and sigma.
+    """
+    def model(params, x):
+        line, line_jacobian = model_fn(params[:, :-3], x)
+        amplitude, center, sigma = (params[:, k, np.newaxis] for k in range(-3, 0))
+
+        doublet = np.zeros_like(line)
+        jacobian = np.zeros(line.shape + (3,))
+        for offset, ratio in zip(offsets, ratios):
+            u = (x - offset - center) / sigma
+            gauss = ratio * np.exp(-0.5 * u ** 2)
+
+            doublet += amplitude * gauss
+            jacobian[..., 0] += gauss
+            jacobian[..., 1] += amplitude * gauss * u / sigma
+            jacobian[..., 2] += amplitude * gauss * u ** 2 / sigma
+
+        return line + doublet, np.concatenate([line_jacobian, jacobian], axis=-1)
+
+    return model
+
+
+def _line_flux(amplitude, sigma, covariance, amplitude_index, sigma_index, wavelength):
+    """Integrated Gaussian flux (flux density x Angstrom) and its error, from the velocity parameters."""
+    scale = np.sqrt(2 * np.pi) * wavelength / SPEED_OF_LIGHT
+    flux = scale * amplitude * sigma
+
+    variance = scale ** 2 * (
+            sigma ** 2 * covariance[:, amplitude_index, amplitude_index]
+            + amplitude ** 2 * covariance[:, sigma_index, sigma_index]
+            + 2 * amplitude * sigma * covariance[:, amplitude_index, sigma_index]
+    )
+    return flux, np.sqrt(np.maximum(variance, 0))
+
+
+def measure_line(flux, ivar, grid, line: str, iterations: int = 50):
+    """
+    Fit a single and a double Gaussian to one line in every resampled spectrum.
+
+    :param flux: Resampled fluxes, [N, G].
+    :param ivar: Resampled inverse variances, [N, G].
+    :param grid: The rest-frame log-wavelength grid they are sampled on.
+    :param line: One of LINES.
+    :return: A dictionary of arrays of shape [N]: the fluxes (and errors), velocities and
+    widths of both components, their velocity separation, both chi-squares and the BIC
+    improvement of the double-peaked model (positive favours two components). Lines with
+    a blended doublet (see DOUBLETS) fit it in both models, so it is never taken for a
+    component of the line.
+    """
+    wavelength, half_width = LINES[line]
+    velocity = (grid - np.log10(wavelength)) * np.log(10) * SPEED_OF_LIGHT
+    window = np.abs(velocity) <= half_width
+    x, y, w = velocity[window], flux[:, window].astype(np.float64), ivar[:, window].astype(np.float64)
+
+    single_model, double_model, offsets = _single_gaussian, _double_gaussian, np.empty(0)
+    if line in DOUBLETS:
+        doublet_wavelengths, doublet_fluxes = DOUBLETS[line]
+        offsets = np.log(np.asarray(doublet_wavelengths) / wavelength) * SPEED_OF_LIGHT
+
+        # Equal widths in velocity, so peak amplitudes go as flux / wavelength; the strongest line is 1
+        ratios = np.asarray(doublet_fluxes) / np.asarray(doublet_wavelengths)
+        ratios = ratios / ratios.max()
+
+        single_model = _with_doublet(_single_gaussian, offsets, ratios)
+        double_model = _with_doublet(_double_gaussian, offsets, ratios)
+
+    # Starting guesses from the window itself: continuum from its edges, amplitude from its
+    # peak, both away from the doublet
+    near_doublet = (np.abs(x[:, np.newaxis] - offsets) <= _DOUBLET_EXCLUSION).any(axis=1)
+    edges = (np.abs(x) > 0.6 * half_width) & ~near_doublet & (w > 0)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # Spectra without usable edges
+        continuum = np.nan_to_num(np.nanmedian(np.where(edges, y, np.nan), axis=1))
+    peak = np.maximum(np.where(~near_doublet & (w > 0), y, -np.inf).max(axis=1) - continuum, 0)
+    peak = np.where(np.isfinite(peak), peak, 0)
+    zeros = np.zeros(len(y))
+
+    # The doublet's amplitude, shift and width come last; it starts at a third of the line, at rest
+    blended = line in DOUBLETS
+    doublet = [peak / 3, zeros, np.full(len(y), 150.0)] if blended else []
+
+    single = np.stack([continuum, zeros, peak, zeros, np.full(len(y), 150.0), *doublet], axis=1)
+    single, chi2_single, _ = levenberg_marquardt(
+        single_model, single, x, y, w, iterations,
+        amplitudes=(2, 5) if blended else (2,), sigmas=(4, 7) if blended else (4,), sigma_bounds=_SIGMA_BOUNDS
+    )
+
+    double = np.stack([
+        continuum, zeros,
+        peak / 2, np.full(len(y), -_DOUBLE_PEAK_GUESS), np.full(len(y), 100.0),
+        peak / 2, np.full(len(y), _DOUBLE_PEAK_GUESS), np.full(len(y), 100.0),
+        *doublet,
+    ], axis=1)
+    double, chi2_double, covariance = levenberg_marquardt(
+        double_model, double, x, y, w, iterations,
+        amplitudes=(2, 5, 8) if blended else (2, 5), sigmas=(4, 7, 10) if blended else (4, 7),
+        sigma_bounds=_SIGMA_BOUNDS
+    )
+
+    # Name the components by velocity, so "blue" is always the one on the blue side
+    swap = double[:, 3] > double[:, 6]
+    order = np.where(swap[:, np.newaxis], [0, 1, 5, 6, 7, 2, 3, 4, *range(8, double.shape[1])],
+                     np.arange(double.shape[1]))
+    double = np.take_along_axis(double, order, axis=1)
+    covariance = np.take_along_axis(np.take_along_axis(covariance, order[:, :, np.newaxis], axis=1),
+                                    order[:, np.newaxis, :], axis=2)
+
+    blue_flux, blue_error = _line_flux(double[:, 2], double[:, 4], covariance, 2, 4, wavelength)
+    red_flux, red_error = _line_flux(double[:, 5], double[:, 7], covariance, 5, 7, wavelength)
+
+    pixels = w.astype(bool).sum(axis=1)
+    delta_bic = ((chi2_single + single.shape[1] * np.log(np.maximum(pixels, 1)))
+                 - (chi2_double + double.shape[1] * np.log(np.maximum(pixels, 1))))
+
+    return {
+        "blue_flux": blue_flux,
+        "blue_flux_err": blue_error,
+        "blue_velocity": double[:, 3],
+        "blue_sigma": double[:, 4],
+        "red_flux": red_flux,
+        "red_flux_err": red_error,
+        "red_velocity": double[:, 6],
+        "red_sigma": double[:, 7],
+        "separation": double[:, 6] - double[:, 3],
+        "single_velocity": single[:, 3],
+        "single_sigma": single[:, 4],
+        "chi2_single": chi2_single,
+        "chi2_double": chi2_double,
+        "delta_bic": delta_bic,
+        "pixels": pixels,
+    }
+
+
+def measure_lines(store, names=None, lines=tuple(LINES), grid=None, batch_size: int = 1024, iterations: int = 50):
+    """
+    Measure the narrow lines of every spectrum in a SpectrumStore (or the given subset),
+    batch by batch.
+
+    :return: (names, columns), where columns maps "<line>_<quantity>" to an array aligned
+    with names, ready to be added as CatalogIndex columns next to the DRAGON votes.
+    """
+    grid = rest_frame_grid() if grid is None else grid
+    names = store.names if names is None else list(names)
+    rows = np.array([store.row(name) for name in names], dtype=np.int64)
+
+    offsets, redshifts = store.offsets, store.redshifts
+    columns = dict()
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        batch_offsets = np.concatenate([[0], np.cumsum(offsets[batch + 1] - offsets[batch])])
+        pixels = np.concatenate([np.arange(offsets[row], offsets[row + 1]) for row in batch])
+
+        flux, ivar = resample(
+            batch_offsets, store.columns['loglam'][pixels], store.columns['flux'][pixels],
+            store.columns['ivar'][pixels], redshifts[batch], grid=grid
+        )
+
+        for line in lines:
+            for quantity, values in measure_line(flux, ivar, grid, line, iterations=iterations).items():
+                columns.setdefault(f"{line}_{quantity}", []).append(values)
+
+        logging.info(f"Measured {min(start + batch_size, len(rows))}/{len(rows)} spectra.")
+
+    return names, {name: np.concatenate(values) for name, values in columns.items()}
+
+
+def double_peaked_candidates(columns, line: str = 'OIII_5007', min_delta_bic: float = 10.0,
+                             min_snr: float = 3.0, min_separation: float = 150.0):
+    """
+    Flag double-peaked narrow lines: two components clearly preferred over one, both
+    detected, and separated by more than a resolution element or two.
+
+    :param columns: The columns of measure_lines.
+    :return: A boolean array aligned with them.
+    """
+    snr = lambda side: columns[f"{line}_{side}_flux"] / np.maximum(columns[f"{line}_{side}_flux_err"], 1e-30)
+
+    return ((columns[f"{line}_delta_bic"] > min_delta_bic)
+            & (snr('blue') > min_snr) & (snr('red') > min_snr)
+            & (columns[f"{line}_separation"] > min_separation))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure narrow emission lines across a spectrum store.")
+    parser.add_argument('--store', required=True, help="SpectrumStore directory.")
+    parser.add_argument('--ingest', default=None, help="Import a directory of per-object SDSS spectra first.")
+    parser.add_argument('--output', default='lines.npz')
+    parser.add_argument('--batch-size', type=int, default=1024)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    from hsc_downloader import SpectrumStore
+
+    store = SpectrumStore(args.store)
+    if args.ingest is not None:
+        store.ingest_directory(args.ingest)
+
+    names, columns = measure_lines(store, batch_size=args.batch_size)
+    flags = double_peaked_candidates(columns)
+    logging.info(f"{flags.sum()}/{len(names)} spectra have a double-peaked [OIII] 5007.")
+
+    np.savez(args.output, names=np.array(names), double_peaked=flags, **columns)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,39 @@
-from .congress import *
-from .model import *
-from .cnn import *
\ No newline at end of file
+import importlib
+
+# The vote aggregation, the prediction store and the embedding index only need NumPy, so they load eagerly.
+from .aggregation import *
+from .result_store import *
+from .embeddings import *
+
+# Everything that pulls in torch is imported on first use, so that pages which never
+# run an election (and tools that only read stored votes) don't pay for it.
+_LAZY_ATTRIBUTES = {
+    'DRAGONEnsemble': '.congress',
+    'DRAGONModel': '.model',
+    'DRAGON': '.cnn',
+    'CongressCalibration': '.calibration',
+    'fit_calibration': '.calibration',
+    'fit_temperatures': '.calibration',
+    'load_labeled_cutouts': '.calibration',
+    'classify_catalog': '.batch',
+    'DRAGONScanner': '.scan',
+    'ConvolutionalDRAGON': '.scan',
+    'find_peaks': '.scan',
+    'build_shards': '.train',
+    'train_congress': '.train',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+__all__ = [
+    *(name for name in globals() if not name.startswith('_') and name != 'importlib'),
+    *_LAZY_ATTRIBUTES,
+]
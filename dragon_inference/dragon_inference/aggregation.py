@@ -0,0 +1,175 @@
+import numpy as np
+
+# Supported ways of turning the Congress' votes into a certified result.
+AGGREGATION_MODES = ('hard', 'soft', 'weighted', 'temperature')
+
+# Under soft voting, an election is too close to call when the two leading
+# averaged probabilities are within this margin of each other.
+SOFT_TIE_MARGIN = 0.05
+
+
+def _as_batch(votes):
+    """Promote a single election's votes of shape [V, C] to a batch of shape [1, V, C]."""
+    votes = np.asarray(votes, dtype=np.float32)
+    if votes.ndim == 2:
+        votes = votes[np.newaxis]
+    if votes.ndim != 3:
+        raise RuntimeError("Votes must be of shape [voters, classes] or [batch, voters, classes].")
+
+    return votes
+
+
+def temperature_scale(votes, temperatures):
+    """
+    Rescale each voter's softmax vector by its own temperature. Since we only keep
+    probabilities, the logits are recovered as log-probabilities, which only differ
+    from the original logits by a per-row constant that the softmax cancels out.
+
+    :param votes: The votes of shape [B, V, C] (or [V, C]).
+    :param temperatures: One temperature per voter, shape [V].
+    :return: The rescaled votes of shape [B, V, C].
+    """
+    votes = _as_batch(votes)
+    temperatures = np.asarray(temperatures, dtype=np.float32).reshape(1, -1, 1)
+
+    logits = np.log(np.clip(votes, 1e-12, None)) / temperatures
+    logits -= logits.max(axis=-1, keepdims=True)
+    scaled = np.exp(logits)
+    return (scaled / scaled.sum(axis=-1, keepdims=True)).astype(np.float32)
+
+
+def _count_outcome(counts):
+    """
+    The hard voting rule on per-class vote counts of shape [..., C].
+
+    :return: (majority class, its vote count, whether the election is too close to call)
+    """
+    ranked = np.sort(counts, axis=-1)
+    maj_count, second_count = ranked[..., -1], ranked[..., -2]
+    majority = counts.argmax(axis=-1)
+
+    # A runner-up only exists if some other class received a vote at all
+    tie = (second_count > 0) & (maj_count - 1 <= second_count)
+    return majority, maj_count, tie
+
+
+def hard_vote_decided(counts, remaining: int):
+    """
+    Whether hard elections are already decided before every voter has cast its vote,
+    i.e. no way of casting the remaining votes can change the voted class or the tie status.
+
+    A class gains the most ground when every remaining vote goes to it, so it suffices to
+    check the C completions where all remaining votes go to one class: the election is
+    decided exactly when all of them end the same way.
+
+    :param counts: Per-class vote counts so far, shape [B, C].
+    :param remaining: Number of voters that have not voted yet.
+    :return: A boolean array of shape [B].
+    """
+    counts = np.asarray(counts)
+    if remaining == 0:
+        return np.ones(len(counts), dtype=bool)
+
+    # [B, C (class receiving the remaining votes), C]
+    completions = counts[:, np.newaxis, :] + remaining * np.eye(counts.shape[-1], dtype=counts.dtype)
+    majority, _, tie = _count_outcome(completions)
+    outcome = np.where(tie, -1, majority)
+
+    return (outcome == outcome[:, :1]).all(axis=1)
+
+
+def hard_vote(votes):
+    """
+    The original Congress rule: every voter casts its top-1 class, and the election
+    is too close to call if the runner-up is within one vote of the majority.
+
+    :param votes: The votes of shape [B, V, C] (or [V, C]).
+    :return: A dictionary of arrays of shape [B] with the voted class (-1 for a tie),
+    the number of voters behind it and their average confidence.
+    """
+    votes = _as_batch(votes)
+    batch_size, _, num_classes = votes.shape
+
+    top_class = votes.argmax(axis=-1)
+    top_conf = votes.max(axis=-1).astype(np.float64)
+
+    # Per-election vote counts and summed confidences per class, shape [B, C]
+    one_hot = top_class[..., np.newaxis] == np.arange(num_classes)
+    counts = one_hot.sum(axis=1)
+    conf_sums = (one_hot * top_conf[..., np.newaxis]).sum(axis=1)
+
+    majority, maj_count, tie = _count_outcome(counts)
+
+    rows = np.arange(batch_size)
+    average_confidence = np.where(tie, 0.0, conf_sums[rows, majority] / np.maximum(maj_count, 1))
+
+    return {
+        "voted_class": np.where(tie, -1, majority),
+        "num_voters": np.where(tie, 0, maj_count),
+        "average_confidence": average_confidence,
+    }
+
+
+def soft_vote(votes, weights=None, tie_margin=SOFT_TIE_MARGIN):
+    """
+    Average the full probability vectors across the Congress (optionally weighting
+    each voter) and elect the class with the highest averaged probability.
+
+    :param votes: The votes of shape [B, V, C] (or [V, C]).
+    :param weights: Optional non-negative weight per voter, shape [V].
+    :param tie_margin: The election is too close to call when the two leading
+    averaged probabilities differ by less than this.
+    :return: A dictionary of arrays of shape [B], like hard_vote. The confidence is
+    the averaged probability of the elected class.
+    """
+    votes = _as_batch(votes)
+    num_voters = votes.shape[1]
+
+    weights = np.ones(num_voters) if weights is None else np.asarray(weights, dtype=np.float64)
+    if weights.shape != (num_voters,) or np.any(weights < 0) or not weights.sum():
+        raise RuntimeError("Voter weights must be non-negative, non-zero and given for every voter.")
+
+    # [B, V, C] x [V] -> [B, C]
+    averaged = np.einsum('bvc,v->bc', votes, weights / weights.sum())
+
+    ranked = np.sort(averaged, axis=-1)
+    winner = averaged.argmax(axis=-1)
+    tie = (ranked[:, -1] - ranked[:, -2]) < tie_margin
+
+    supporters = (votes.argmax(axis=-1) == winner[:, np.newaxis]).sum(axis=1)
+
+    return {
+        "voted_class": np.where(tie, -1, winner),
+        "num_voters": np.where(tie, 0, supporters),
+        "average_confidence": np.where(tie, 0.0, ranked[:, -1]),
+    }
+
+
+def aggregate(votes, mode='hard', weights=None, temperatures=None, tie_margin=SOFT_TIE_MARGIN):
+    """
+    Certify a batch of elections under one of the aggregation policies. Because this only
+    needs the stored probability vectors, the policy can be changed without re-running inference.
+
+    :param votes: The votes of shape [B, V, C] (or [V, C]).
+    :param mode: One of 'hard' (the original majority rule), 'soft' (averaged probabilities),
+    'weighted' (averaged with per-voter weights) or 'temperature' (per-voter temperature
+    scaling followed by weighted soft voting, if weights are given).
+    :param weights: Per-voter weights, required for 'weighted'.
+    :param temperatures: Per-voter temperatures, required for 'temperature'.
+    :param tie_margin: See soft_vote.
+    :return: A dictionary of arrays of shape [B].
+    """
+    if mode == 'hard':
+        return hard_vote(votes)
+    elif mode == 'soft':
+        return soft_vote(votes, tie_margin=tie_margin)
+    elif mode == 'weighted':
+        if weights is None:
+            raise RuntimeError("Weighted voting requires per-voter weights (fit a calibration first).")
+        return soft_vote(votes, weights=weights, tie_margin=tie_margin)
+    elif mode == 'temperature':
+        if temperatures is None:
+            raise RuntimeError("Temperature scaling requires per-voter temperatures (fit a calibration first).")
+        return soft_vote(temperature_scale(votes, temperatures), weights=weights, tie_margin=tie_margin)
+
+    raise RuntimeError(f"Unknown aggregation mode '{mode}'. Expected one of {AGGREGATION_MODES}.")
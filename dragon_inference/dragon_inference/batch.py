@@ -0,0 +1,213 @@
+"""
+Sharded, multi-process batch classification of a catalog of cutouts.
+
+Run from the dragon_inference directory:
+
+    python -m dragon_inference.batch --model-dir models --workers 8 --output results.jsonl cutouts/
+
+With --embeddings, the voters' penultimate-layer features are kept in a memory-mapped
+EmbeddingStore, and an IVF index is built over them for similarity search.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import torch.multiprocessing as mp
+from astropy.io import fits
+
+from utils import configure_threads
+from .congress import DRAGONEnsemble
+from .result_store import PredictionStore
+from .embeddings import EmbeddingStore, IVFIndex, IVF_INDEX_FILE, EMBEDDING_MODES
+
+# The Congress of this process. In the parent it is loaded once before forking, so
+# every worker shares the same weight pages copy-on-write instead of loading its own.
+_ensemble = None
+
+
+def _init_worker(model_dir, tta, aggregation, threads, store_path, core_counter, pin_cores, early_exit):
+    global _ensemble
+
+    # Pin each worker to its own cores, and size its intra-op pool to match
+    if pin_cores and core_counter is not None and hasattr(os, 'sched_setaffinity'):
+        with core_counter.get_lock():
+            index = core_counter.value
+            core_counter.value += 1
+
+        available = sorted(os.sched_getaffinity(0))
+        cores = {available[(index * threads + i) % len(available)] for i in range(threads)}
+        os.sched_setaffinity(0, cores)
+
+    configure_threads(threads)
+
+    if _ensemble is None:
+        # Spawned workers don't inherit anything, so they load the Congress themselves.
+        _ensemble = DRAGONEnsemble(model_dir=model_dir, tta=tta, aggregation=aggregation, early_exit=early_exit)
+
+    # SQLite connections must not cross a fork, so every worker opens its own.
+    _ensemble.store = PredictionStore(store_path) if store_path is not None else None
+
+
+def _classify_shard(paths, extension, batch_size, embed=None):
+    """
+    Classify one shard of the catalog inside a worker.
+
+    :return: A list of result dictionaries, each with the path of its cutout.
+    """
+    results, images = [], dict()
+    for path in paths:
+        try:
+            images[path] = fits.getdata(path, ext=extension).astype(np.float32)
+        except Exception as e:
+            results.append({"path": str(path), "error": str(e)})
+
+    # Cutouts at the edge of the survey can differ in size, so batch them by shape.
+    by_shape = dict()
+    for path, image in images.items():
+        by_shape.setdefault(image.shape, []).append(path)
+
+    for shape_paths in by_shape.values():
+        for i in range(0, len(shape_paths), batch_size):
+            batch_paths = shape_paths[i:i + batch_size]
+            batch = np.stack([images[path] for path in batch_paths])
+
+            for path, result in zip(batch_paths, _ensemble.run_batch_election(images=batch, embed=embed)):
+                results.append({"path": str(path), **result})
+
+    return results
+
+
+def classify_catalog(
+        paths,
+        model_dir='models',
+        workers: int = None,
+        threads_per_worker: int = 1,
+        shard_size: int = 64,
+        batch_size: int = 32,
+        extension: int = 1,
+        tta: bool = False,
+        aggregation: str = 'hard',
+        store_path=None,
+        pin_cores: bool = True,
+        embed: str = None,
+        early_exit: bool = False,
+):
+    """
+    Classify a catalog of FITS cutouts across a pool of worker processes. The catalog
+    is cut into shards, every worker holds one copy of the Congress and pins its
+    intra-op threads, and results stream back shard by shard as soon as they finish
+    (so not necessarily in input order).
+
+    :param paths: The FITS files to classify.
+    :param model_dir: The directory containing the Congress checkpoints.
+    :param workers: Number of worker processes; defaults to one per threads_per_worker cores.
+    :param threads_per_worker: PyTorch intra-op threads in every worker.
+    :param shard_size: Number of cutouts handed to a worker at a time.
+    :param batch_size: Number of cutouts per forward pass inside a worker.
+    :param store_path: Optional PredictionStore database; cutouts already in it are not re-classified.
+    :param pin_cores: Pin every worker to its own set of cores (Linux only).
+    :param embed: One of EMBEDDING_MODES to add every object's "embedding" to its result.
+    :param early_exit: Stop every hard election once its outcome is decided (see
+    DRAGONEnsemble.run_adaptive_election), which saves most forward passes on clear-cut objects.
+    :return: A generator of lists of result dictionaries, one list per shard.
+    """
+    global _ensemble
+
+    paths = [str(path) for path in paths]
+    workers = workers or max((os.cpu_count() or 1) // threads_per_worker, 1)
+
+    # With fork, load the weights once in the parent and let every worker share them.
+    context = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+    if context.get_start_method() == 'fork':
+        _ensemble = DRAGONEnsemble(model_dir=model_dir, tta=tta, aggregation=aggregation, early_exit=early_exit)
+        if store_path is not None:
+            # Hash the checkpoints once, before forking, rather than once per worker
+            logging.info(f"Model set fingerprint: {_ensemble.fingerprint[:12]}")
+
+    core_counter = context.Value('i', 0)
+    logging.info(f"Classifying {len(paths)} cutouts on {workers} workers x {threads_per_worker} threads...")
+
+    shards = [paths[i:i + shard_size] for i in range(0, len(paths), shard_size)]
+    try:
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(model_dir, tta, aggregation, threads_per_worker, store_path, core_counter, pin_cores,
+                          early_exit)
+        ) as pool:
+            futures = [pool.submit(_classify_shard, shard, extension, batch_size, embed) for shard in shards]
+            for future in as_completed(futures):
+                yield future.result()
+    finally:
+        _ensemble = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify a directory of FITS cutouts with the Congress.")
+    parser.add_argument('inputs', nargs='+', help="FITS files or directories containing them.")
+    parser.add_argument('--model-dir', default='models')
+    parser.add_argument('--output', default='results.jsonl')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--threads-per-worker', type=int, default=1)
+    parser.add_argument('--shard-size', type=int, default=64)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--tta', action='store_true')
+    parser.add_argument('--aggregation', default='hard')
+    parser.add_argument('--early-exit', action='store_true', help="Stop hard elections once decided.")
+    parser.add_argument('--store', default=None, help="PredictionStore database to reuse and fill.")
+    parser.add_argument('--embeddings', default=None, help="Directory to write an EmbeddingStore and its index to.")
+    parser.add_argument('--embed', default='mean', choices=EMBEDDING_MODES)
+    parser.add_argument('--pq-subspaces', type=int, default=None, help="Product-quantize the index.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    paths = []
+    for item in map(Path, args.inputs):
+        paths.extend(sorted(item.glob('**/*.fits')) if item.is_dir() else [item])
+
+    start, done = time.perf_counter(), 0
+    embeddings = None
+    with open(args.output, 'w') as file:
+        for chunk in classify_catalog(
+                paths, model_dir=args.model_dir, workers=args.workers,
+                threads_per_worker=args.threads_per_worker, shard_size=args.shard_size,
+                batch_size=args.batch_size, tta=args.tta, aggregation=args.aggregation,
+                store_path=args.store, embed=args.embed if args.embeddings else None,
+                early_exit=args.early_exit
+        ):
+            for result in chunk:
+                if 'embedding' in result:
+                    # The embedding's length is only known once the first one arrives (concat)
+                    if embeddings is None:
+                        embeddings = EmbeddingStore.create(
+                            args.embeddings, names=[str(path) for path in paths],
+                            dim=len(result['embedding']), embed=args.embed
+                        )
+                    embeddings.write([result['path']], result.pop('embedding')[np.newaxis])
+
+                if 'votes' in result:
+                    # Voters an early-exit election never asked are NaN, which JSON has no token for
+                    result['votes'] = [[None if vote != vote else vote for vote in row]
+                                       for row in np.asarray(result['votes']).tolist()]
+                file.write(json.dumps(result) + "\n")
+
+            done += len(chunk)
+            logging.info(f"{done}/{len(paths)} cutouts classified "
+                         f"({done / (time.perf_counter() - start):.1f} cutouts/s).")
+
+    if embeddings is not None:
+        embeddings.flush()
+        index = IVFIndex.build(embeddings.embeddings, rows=np.flatnonzero(embeddings.filled),
+                               pq_subspaces=args.pq_subspaces)
+        index.save(Path(args.embeddings) / IVF_INDEX_FILE)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+Offline calibration of the Congress. Fits one temperature and one weight per voter
+from labeled cutouts and stores them next to the checkpoints, where DRAGONEnsemble
+picks them up for the 'weighted' and 'temperature' aggregation modes.
+
+Run from the dragon_inference directory:
+
+    python -m dragon_inference.calibration --model-dir models --labels labeled_cutouts.csv
+"""
+import argparse
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+
+from .aggregation import temperature_scale
+
+CALIBRATION_FILE = 'calibration.json'
+
+# Bounds of the temperature search, in log space.
+_LOG_T_BOUNDS = (np.log(0.05), np.log(20.0))
+_GOLDEN = (np.sqrt(5) - 1) / 2
+
+
+class CongressCalibration:
+    def __init__(self, temperatures: dict, weights: dict):
+        """
+        Per-voter temperatures and weights, keyed by checkpoint file name so that
+        the calibration survives moving the model directory.
+
+        :param temperatures: Checkpoint name -> softmax temperature.
+        :param weights: Checkpoint name -> voting weight.
+        """
+        self.temperatures = temperatures
+        self.weights = weights
+
+    def for_voters(self, voters):
+        """
+        :param voters: The ordered voter paths of a DRAGONEnsemble.
+        :return: The temperatures and weights as arrays aligned with the voters.
+        """
+        names = [os.path.basename(voter) for voter in voters]
+        missing = [name for name in names if name not in self.temperatures or name not in self.weights]
+        if missing:
+            raise RuntimeError(f"Calibration is missing voters {missing}; please refit it.")
+
+        temperatures = np.array([self.temperatures[name] for name in names], dtype=np.float32)
+        weights = np.array([self.weights[name] for name in names], dtype=np.float64)
+        return temperatures, weights
+
+    def save(self, model_dir):
+        path = Path(model_dir) / CALIBRATION_FILE
+        with path.open('w') as file:
+            json.dump({"temperatures": self.temperatures, "weights": self.weights}, file, indent=2)
+
+        return path
+
+    @staticmethod
+    def load(model_dir):
+        """
+        :return: The calibration stored in the model directory, or None if it has not been fit.
+        """
+        path = Path(model_dir) / CALIBRATION_FILE
+        if not path.is_file():
+            return None
+
+        with path.open() as file:
+            stored = json.load(file)
+
+        return CongressCalibration(temperatures=stored['temperatures'], weights=stored['weights'])
+
+
+def _negative_log_likelihood(votes, labels, temperatures):
+    """
+    :param votes: [B, V, C] probabilities.
+    :param labels: [B] true classes.
+    :param temperatures: [V] temperatures.
+    :return: [V] mean negative log-likelihood of the true class for every voter.
+    """
+    scaled = temperature_scale(votes, temperatures)
+    true_probs = scaled[np.arange(len(labels)), :, labels]
+    return -np.log(np.clip(true_probs, 1e-12, None)).mean(axis=0)
+
+
+def fit_temperatures(votes, labels, iterations: int = 60):
+    """
+    Fit one temperature per voter by minimizing the negative log-likelihood of the
+    true labels. A golden-section search over log(T) runs for all voters at once.
+
+    :param votes: [B, V, C] probabilities from DRAGONEnsemble.collect_votes.
+    :param labels: [B] true classes.
+    :return: ([V] temperatures, [V] negative log-likelihoods at those temperatures)
+    """
+    votes = np.asarray(votes, dtype=np.float32)
+    labels = np.asarray(labels, dtype=np.int64)
+    num_voters = votes.shape[1]
+
+    lo = np.full(num_voters, _LOG_T_BOUNDS[0])
+    hi = np.full(num_voters, _LOG_T_BOUNDS[1])
+    for _ in range(iterations):
+        left = hi - _GOLDEN * (hi - lo)
+        right = lo + _GOLDEN * (hi - lo)
+
+        left_better = (_negative_log_likelihood(votes, labels, np.exp(left))
+                       < _negative_log_likelihood(votes, labels, np.exp(right)))
+        hi = np.where(left_better, right, hi)
+        lo = np.where(left_better, lo, left)
+
+    temperatures = np.exp((lo + hi) / 2)
+    return temperatures, _negative_log_likelihood(votes, labels, temperatures)
+
+
+def fit_calibration(ensemble, images, labels, batch_size: int = 64):
+    """
+    Run the Congress once over labeled cutouts and fit the per-voter calibration.
+    Each voter's weight is the geometric mean probability it assigns to the true
+    class after temperature scaling, so sharper and more accurate voters count more.
+
+    :param ensemble: A DRAGONEnsemble.
+    :param images: A sequence of cutouts with the same shape.
+    :param labels: The true class of every cutout.
+    :return: A CongressCalibration.
+    """
+    logging.info(f"Collecting votes on {len(images)} labeled cutouts...")
+    votes = np.concatenate([
+        ensemble.collect_votes(np.stack(images[i:i + batch_size]))
+        for i in range(0, len(images), batch_size)
+    ])
+
+    temperatures, nll = fit_temperatures(votes, labels)
+    weights = np.exp(-nll)
+
+    names = [os.path.basename(voter) for voter in ensemble.voters]
+    return CongressCalibration(
+        temperatures={name: float(t) for name, t in zip(names, temperatures)},
+        weights={name: float(w / weights.sum()) for name, w in zip(names, weights)},
+    )
+
+
+def load_labeled_cutouts(csv_path, extension: int = 1):
+    """
+    Load labeled cutouts from a header-less CSV of `path,label` rows, in the same
+    style as frontend/labels.csv. Relative paths are resolved against the CSV's directory.
+
+    :return: (list of images, numpy array of labels)
+    """
+    csv_path = Path(csv_path)
+    labeled_df = pd.read_csv(csv_path, header=None)
+
+    images, labels = [], []
+    for path, label in zip(labeled_df[0], labeled_df[1]):
+        path = Path(path)
+        if not path.is_absolute():
+            path = csv_path.parent / path
+
+        images.append(fits.getdata(path, ext=extension).astype(np.float32))
+        labels.append(int(label))
+
+    return images, np.array(labels)
+
+
+def main():
+    from .congress import DRAGONEnsemble
+
+    parser = argparse.ArgumentParser(description="Fit per-voter temperatures and weights for the Congress.")
+    parser.add_argument('--model-dir', default='models')
+    parser.add_argument('--labels', required=True, help="Header-less CSV of `path,label` rows.")
+    parser.add_argument('--tta', action='store_true', help="Calibrate the test-time augmented votes.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    images, labels = load_labeled_cutouts(args.labels)
+    ensemble = DRAGONEnsemble(model_dir=args.model_dir, tta=args.tta)
+
+    calibration = fit_calibration(ensemble, images, labels)
+    path = calibration.save(args.model_dir)
+    logging.info(f"Calibration written to {path}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -79,7 +79,10 @@ class DRAGON(nn.Module):
         self.drop = nn.Dropout(0.5)
         self.fc2 = nn.Linear(1024, num_classes)
 
-    def forward(self, x):
+    def features(self, x):
+        """
+        The penultimate (fc1) activations, a 1024-d embedding of every image.
+        """
         # Forward pass through the layers
         out = self.layer1(x)
         out = self.layer2(out)
@@ -93,9 +96,15 @@ class DRAGON(nn.Module):
         # Flatten the output tensor
         out = out.view(out.size(0), -1)
 
+        return self.fc1(out)
+
+    def forward(self, x, return_features=False):
         # Fully connected layers
-        out = self.fc1(out)
-        out = self.drop(out)
+        features = self.features(x)
+        out = self.drop(features)
         out = self.fc2(out)
 
+        if return_features:
+            return out, features
+
         return out
@@ -1,13 +1,16 @@
-import pandas as pd
 import numpy as np
-from collections import Counter
 import logging
 import os
 
 from .model import DRAGONModel
+from utils import timed, report_progress
+from .aggregation import aggregate, hard_vote, hard_vote_decided, AGGREGATION_MODES
+from .calibration import CongressCalibration
+from .result_store import image_content_hash, model_set_fingerprint
+from .embeddings import pool_embeddings, EMBEDDING_MODES
 
 class DRAGONEnsemble:
-    def __init__(self, model_dir):
+    def __init__(self, model_dir, tta=False, aggregation='hard', store=None, early_exit=False):
         """
         This is a helper class that helps to initialize our hard voting
         ensemble of DRAGON models by only specifying the model directory.
@@ -15,13 +18,32 @@ class DRAGONEnsemble:
         :param model_dir: A string representing a directory which should contain
         .pt files of all of the DRAGON models the client wishes to use to make
         their prediction.
+        :param tta: Default for whether each voter averages its prediction over the
+        8 dihedral views (rotations and flips) of the image.
+        :param aggregation: Default aggregation mode, one of AGGREGATION_MODES. The
+        'weighted' and 'temperature' modes need a calibration.json in the model
+        directory (see dragon_inference/calibration.py).
+        :param store: An optional PredictionStore. Elections on cutouts this model set has
+        already seen are then served from the store instead of re-running inference.
+        :param early_exit: Default for whether hard elections stop asking voters once the
+        outcome can no longer change (see run_adaptive_election).
         """
         if not os.path.isdir(model_dir):
             raise RuntimeError("Invalid model directory specified.")
+        if aggregation not in AGGREGATION_MODES:
+            raise RuntimeError(f"Invalid aggregation mode specified. Expected one of {AGGREGATION_MODES}.")
 
         # Extract only the model paths
-        self.model_paths = [f"{model_dir}/{path}" for path in os.listdir(model_dir) if path.endswith('.pt')]
+        self.model_paths = sorted(f"{model_dir}/{path}" for path in os.listdir(model_dir) if path.endswith('.pt'))
         self.model_dict = dict()
+        self.tta = tta
+        self.aggregation = aggregation
+        self.store = store
+        self.early_exit = early_exit
+        self._fingerprint = None
+
+        # Per-voter temperatures and weights, if they have been fit offline
+        self.calibration = CongressCalibration.load(model_dir)
 
         # Register voterss
         self._register_voters()
@@ -31,7 +53,57 @@ class DRAGONEnsemble:
         for model_path in self.model_paths:
             self.model_dict[model_path] = DRAGONModel(model_path=model_path)
 
-    def run_election(self, image):
+    @property
+    def voters(self):
+        """The voter keys (checkpoint paths), in the order their votes are stacked."""
+        return list(self.model_dict.keys())
+
+    @property
+    def num_classes(self):
+        # DRAGONModel wraps every network in DataParallel
+        return next(iter(self.model_dict.values())).model.module.num_classes
+
+    @property
+    def fingerprint(self):
+        """The hash of the model set, computed from the checkpoint files on first use."""
+        if self._fingerprint is None:
+            self._fingerprint = model_set_fingerprint(self.model_paths)
+
+        return self._fingerprint
+
+    def collect_votes(self, images, tta=None, return_features=False):
+        """
+        Ask every member of the Congress for its full softmax vector.
+
+        :param images: A single image of shape [H, W] or a batch of shape [B, H, W].
+        :param tta: Overrides the ensemble's test-time augmentation setting.
+        :param return_features: Also collect every voter's penultimate-layer embedding.
+        :return: A compact float32 array of shape [B, N_voters, num_classes], and with
+        return_features the embeddings as a float32 array of shape [B, N_voters, 1024].
+        """
+        tta = self.tta if tta is None else tta
+        images = np.asarray(images)
+        if images.ndim == 2:
+            images = images[np.newaxis]
+
+        votes, features = [], []
+        for model in self.model_dict.values():
+            if return_features:
+                proba, embedding = model.predict_proba(datum=images, tta=tta, return_features=True)
+                features.append(embedding)
+            else:
+                proba = model.predict_proba(datum=images, tta=tta)
+
+            votes.append(proba)
+            report_progress(len(votes) / len(self.model_dict), f"{len(votes)}/{len(self.model_dict)} voters done")
+
+        votes = np.stack(votes, axis=1).astype(np.float32)
+        if return_features:
+            return votes, np.stack(features, axis=1).astype(np.float32)
+
+        return votes
+
+    def run_election(self, image, tta=None, aggregation=None):
         """
         Outside of the funny naming convention, running the election
         is equivalent to a hard voting system. We adapted this from
@@ -40,96 +112,234 @@ class DRAGONEnsemble:
 
         :param image: a NumPy ndarray that contains the image data
         of the FITS file previously downloaded.
+        :param tta: Overrides the ensemble's test-time augmentation setting for this election.
+        Galaxy orientation is arbitrary, so averaging each voter over all orientations
+        helps to stabilize borderline elections.
+        :param aggregation: Overrides the ensemble's aggregation mode (see AGGREGATION_MODES).
         :return: The Congressional aggregate data as a dictionary.
         """
+        return self.run_batch_election(images=np.asarray(image)[np.newaxis], tta=tta, aggregation=aggregation)[0]
+
+    def run_batch_election(self, images, tta=None, aggregation=None, embed=None, early_exit=None):
+        """
+        Run one election per image, with every voter classifying the whole batch
+        in a single forward pass.
+
+        :param images: A batch of images of shape [B, H, W].
+        :param embed: One of EMBEDDING_MODES to also return the voters' penultimate-layer
+        embeddings, averaged ('mean') or concatenated ('concat') across voters, as the
+        "embedding" of every aggregate.
+        :param early_exit: Overrides the ensemble's early exit setting. Only hard elections
+        without embeddings can stop early; everything else runs the full Congress.
+        :return: A list of Congressional aggregates, one per image. With a prediction
+        store attached, only the images it has not seen are classified.
+        """
+        if embed is not None and embed not in EMBEDDING_MODES:
+            raise RuntimeError(f"Invalid embedding mode specified. Expected one of {EMBEDDING_MODES}.")
+
+        early_exit = self.early_exit if early_exit is None else early_exit
+        if early_exit and embed is None and (aggregation or self.aggregation) == 'hard' and self.model_dict:
+            return self.run_adaptive_election(images, tta=tta)
+
         logging.info("Beginning election...")
+        if not self.model_dict:
+            logging.warning("No votes were cast.")
+            return [{
+                "voted_class": -1,
+                "num_voters": 0,
+                "total_voters": 0,
+                "average_confidence": 0.0,
+            } for _ in range(len(images))]
 
-        records = []
-        for key, model in self.model_dict.items():
-            pred_label, pred_conf, second_pred_label, second_pred_conf = model.predict(datum=image)
+        if self.store is None and embed is None:
+            votes = self.collect_votes(images, tta=tta)
 
-            # These are numpy arrays, so extract scalar values
-            records.append({
-                "voter": key,
-                "pred_class": int(pred_label[0]),
-                "pred_conf": float(pred_conf[0]),
-                "second_pred_class": int(second_pred_label[0]),
-                "second_pred_conf": float(second_pred_conf[0])
-            })
+            # Running the ensemble phase.
+            return self._certify_congress(votes, aggregation=aggregation)
 
-        total_predictions = pd.DataFrame(records)
+        tta = self.tta if tta is None else tta
+        images = np.asarray(images)
+        hashes, stored = None, dict()
+        if self.store is not None:
+            hashes = [image_content_hash(image) for image in images]
 
-        # Running the ensemble phase.
-        return self._certify_congress(total_predictions)
+            # The store keeps votes but not embeddings, so embedding runs every voter again
+            if embed is None:
+                stored = self.store.get_many(hashes, fingerprint=self.fingerprint, tta=tta)
+                logging.info(f"{len(stored)}/{len(images)} elections found in the prediction store.")
 
-    def _certify_congress(self, total_predictions):
+        # Only the cutouts we have never seen go through the voters
+        missing = [i for i in range(len(images)) if hashes is None or hashes[i] not in stored]
+
+        votes = np.empty((len(images), len(self.model_dict), self.num_classes), dtype=np.float32)
+        for i, image_hash in enumerate(hashes or []):
+            if image_hash in stored:
+                votes[i] = stored[image_hash]['votes']
+
+        features = None
+        if missing and embed is not None:
+            votes[missing], features = self.collect_votes(images[missing], tta=tta, return_features=True)
+        elif missing:
+            votes[missing] = self.collect_votes(images[missing], tta=tta)
+
+        # Re-certifying the stored votes is cheap, and follows any change of aggregation policy.
+        results = self._certify_congress(votes, aggregation=aggregation)
+        if self.store is not None:
+            self.store.put_many(((hashes[i], results[i]) for i in missing), fingerprint=self.fingerprint, tta=tta)
+
+        if features is not None:
+            for result, embedding in zip(results, pool_embeddings(features, mode=embed)):
+                result['embedding'] = embedding
+
+        return results
+
+    def _voter_order(self):
+        """
+        The order voters are asked in during an adaptive election. They all cost the same,
+        so the most trusted voters (by calibrated weight) go first, as they are the most
+        likely to settle the election early.
+        """
+        if self.calibration is None:
+            return np.arange(len(self.model_dict))
+
+        try:
+            _, weights = self.calibration.for_voters(self.voters)
+        except RuntimeError:
+            # A stale calibration only costs the ordering; hard elections don't need it
+            return np.arange(len(self.model_dict))
+
+        return np.argsort(-np.asarray(weights), kind='stable')
+
+    @timed('run_adaptive_election')
+    def run_adaptive_election(self, images, tta=None):
+        """
+        A hard election that stops asking voters once no remaining vote can change the
+        voted class or the tie status, so it certifies exactly the same class (or tie)
+        as the full election. Over a batch, every image stops on its own, and only the
+        images that are still undecided are re-batched for the next voter.
+
+        The vote count and confidence of the winning class depend on the voters that were
+        never asked, so an election that stopped early reports "num_voters" and
+        "average_confidence" as None; elections that heard every voter report the same
+        values as the full election. Each aggregate records how many voters were heard in
+        "voters_evaluated", and the votes of voters that were never asked are NaN (which
+        certify rejects). Only elections that heard every voter are written to the
+        prediction store; stored ones are used either way.
+
+        :param images: A batch of images of shape [B, H, W].
+        :return: A list of Congressional aggregates, one per image.
+        """
+        tta = self.tta if tta is None else tta
+        images = np.asarray(images)
+        num_voters, num_classes = len(self.model_dict), self.num_classes
+
+        results = [None] * len(images)
+        pending = np.arange(len(images))
+
+        if self.store is not None:
+            hashes = [image_content_hash(image) for image in images]
+            stored = self.store.get_many(hashes, fingerprint=self.fingerprint, tta=tta)
+            if stored:
+                hits = [i for i, image_hash in enumerate(hashes) if image_hash in stored]
+                certified = self._certify_congress(np.stack([stored[hashes[i]]['votes'] for i in hits]),
+                                                   aggregation='hard')
+                for i, result in zip(hits, certified):
+                    results[i] = result
+                pending = np.array([i for i in range(len(images)) if results[i] is None], dtype=np.int64)
+
+        votes = np.full((len(images), num_voters, num_classes), np.nan, dtype=np.float32)
+        counts = np.zeros((len(images), num_classes), dtype=np.int64)
+        evaluated = np.zeros(len(images), dtype=np.int64)
+
+        models = list(self.model_dict.values())
+        undecided = pending
+        for n, voter in enumerate(self._voter_order()):
+            if not len(undecided):
+                break
+
+            votes[undecided, voter] = models[voter].predict_proba(datum=images[undecided], tta=tta)
+            counts[undecided, votes[undecided, voter].argmax(axis=-1)] += 1
+            evaluated[undecided] = n + 1
+
+            undecided = undecided[~hard_vote_decided(counts[undecided], remaining=num_voters - n - 1)]
+            report_progress((n + 1) / num_voters, f"{n + 1}/{num_voters} voters done, {len(undecided)} undecided")
+
+        logging.info(f"Adaptive election: {evaluated[pending].sum()}/{len(pending) * num_voters} forward passes.")
+
+        # Certify every group of images that stopped after the same voters together
+        order = self._voter_order()
+        for n in np.unique(evaluated[pending]):
+            group = pending[evaluated[pending] == n]
+            certified = hard_vote(votes[group][:, order[:n]])
+
+            complete = n == num_voters
+            for j, i in enumerate(group):
+                results[i] = {
+                    "voted_class": int(certified["voted_class"][j]),
+                    "num_voters": int(certified["num_voters"][j]) if complete else None,
+                    "total_voters": num_voters,
+                    "average_confidence": float(certified["average_confidence"][j]) if complete else None,
+                    "aggregation": 'hard',
+                    "votes": votes[i],
+                    "voters_evaluated": int(n),
+                }
+
+        if self.store is not None:
+            heard = pending[evaluated[pending] == num_voters]
+            self.store.put_many(((hashes[i], results[i]) for i in heard), fingerprint=self.fingerprint, tta=tta)
+
+        return results
+
+    def certify(self, votes, aggregation=None):
+        """
+        Re-certify stored votes under a (possibly different) aggregation policy
+        without running any inference.
+
+        :param votes: The "votes" array of a previous election, [N_voters, num_classes],
+        or a stack of them, [B, N_voters, num_classes].
+        :return: A Congressional aggregate, or a list of them for a stack of votes.
+        """
+        votes = np.asarray(votes, dtype=np.float32)
+        results = self._certify_congress(votes if votes.ndim == 3 else votes[np.newaxis], aggregation=aggregation)
+        return results if votes.ndim == 3 else results[0]
+
+    @timed('_certify_congress')
+    def _certify_congress(self, votes, aggregation=None):
         """
         The Certify Congress method was originally created for the
-        DRAGON module, but relied upon a formatting suitable
-        for batch prediction. This time, we only need to certify for
-        one example. Notably, this means that we do not include an
-        optimism score.
+        DRAGON module, and relied upon a formatting suitable
+        for batch prediction. It is vectorized over the batch again, so
+        certifying one example or a whole catalog is the same call.
+        Notably, we still do not include an optimism score.
 
-        :param total_predictions: A DataFrame that contains the predictions of
-        the congressional DRAGON models on a singular image.
-        :return: The Congressional Aggregate in the form of a dictionary.
+        :param votes: A float32 array of shape [B, N_voters, num_classes] that
+        contains the softmax vectors of the congressional DRAGON models.
+        :param aggregation: One of AGGREGATION_MODES; defaults to the ensemble's mode.
+        'hard' is the original rule: too close to call when the runner-up is
+        within one vote of the majority.
+        :return: A list of Congressional Aggregates in the form of dictionaries.
         """
         logging.info("Certifying Congressional results...")
+        aggregation = self.aggregation if aggregation is None else aggregation
 
-        # Number of voters
-        num_voters = len(self.model_dict)
-        labels = pd.unique(
-            pd.concat([
-                total_predictions["pred_class"],
-                total_predictions["second_pred_class"]
-            ])
-        )
-
-        # Ensure labels are integers (in case of numpy objects)
-        labels = [int(label) for label in labels]
-
-        # First round: count votes and store confidences
-        voter_vals = Counter()
-        confidences = {label: [] for label in labels}
-
-        logging.info("Aggregating counts and confidences...")
-        for _, row in total_predictions.iterrows():
-            voted_class = int(row['pred_class'])
-            confidence = float(row['pred_conf'])
-            voter_vals[voted_class] += 1
-            confidences[voted_class].append(confidence)
-
-        if not voter_vals:
-            logging.warning("No votes were cast.")
-            return {
-                "voted_class": -1,
-                "num_voters": 0,
-                "total_voters": num_voters,
-                "average_confidence": 0.0,
-            }
-
-        # Second round: check for close call / tie
-        majority, maj_count = voter_vals.most_common(1)[0]
-        voted_class = majority
+        # NaN votes come from voters an adaptive election never asked; argmax would count them as class 0
+        if np.isnan(votes).any():
+            raise RuntimeError("Cannot certify votes of voters that were never asked (NaN); "
+                               "run the full election instead.")
 
-        if len(voter_vals) > 1:
-            second, second_count = voter_vals.most_common(2)[1]
-            if (maj_count - 1) <= second_count <= maj_count:
-                logging.info("Too close to call — tie detected.")
-                voted_class = -1
+        # Only the calibrated modes need (and validate) the calibration, so a stale one never breaks 'hard'
+        temperatures, weights = None, None
+        if self.calibration is not None and aggregation in ('weighted', 'temperature'):
+            temperatures, weights = self.calibration.for_voters(self.voters)
 
-        # Avoid division by zero
-        if voted_class != -1 and confidences[voted_class]:
-            avg_confidence = sum(confidences[voted_class]) / len(confidences[voted_class])
-        else:
-            avg_confidence = 0.0
+        certified = aggregate(votes, mode=aggregation, weights=weights, temperatures=temperatures)
 
         logging.info("Congressional voting completed...")
-        output = {
-            "voted_class": voted_class,
-            "num_voters": maj_count if voted_class != -1 else 0,
-            "total_voters": num_voters,
-            "average_confidence": avg_confidence,
-        }
-
-        return output
\ No newline at end of file
+        return [{
+            "voted_class": int(certified["voted_class"][i]),
+            "num_voters": int(certified["num_voters"][i]),
+            "total_voters": votes.shape[1],
+            "average_confidence": float(certified["average_confidence"][i]),
+            "aggregation": aggregation,
+            "votes": votes[i],
+        } for i in range(len(votes))]
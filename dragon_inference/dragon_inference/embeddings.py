@@ -0,0 +1,298 @@
+from pathlib import Path
+import logging
+import json
+
+import numpy as np
+
+# How the voters' penultimate-layer features are combined into one embedding per image.
+EMBEDDING_MODES = ('mean', 'concat')
+
+EMBEDDINGS_META_FILE = 'embeddings.json'
+IVF_INDEX_FILE = 'ivf.npz'
+
+# Rows are scored in blocks, so neither building nor searching ever materializes the whole matrix.
+_BLOCK = 8192
+
+
+def pool_embeddings(features, mode: str = 'mean'):
+    """
+    :param features: The voters' embeddings, of shape [B, N_voters, D].
+    :param mode: 'mean' averages across voters ([B, D]); 'concat' keeps every voter's ([B, N_voters * D]).
+    """
+    features = np.asarray(features, dtype=np.float32)
+    if mode == 'mean':
+        return features.mean(axis=1)
+    if mode == 'concat':
+        return features.reshape(len(features), -1)
+
+    raise RuntimeError(f"Invalid embedding mode specified. Expected one of {EMBEDDING_MODES}.")
+
+
+def _normalized(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class EmbeddingStore:
+    def __init__(self, directory, mode: str = 'r'):
+        """
+        A compact, memory-mapped matrix of DRAGON embeddings, one float16 row per object.
+        Opening it is instant whatever the size of the catalog; rows are only paged in
+        when they are read.
+
+        :param directory: A directory written by EmbeddingStore.create.
+        :param mode: 'r' to read, 'r+' to fill in rows.
+        """
+        self.directory = Path(directory)
+        meta_path = self.directory / EMBEDDINGS_META_FILE
+        if not meta_path.is_file():
+            raise RuntimeError(f"No embeddings found in {self.directory}.")
+
+        with meta_path.open() as file:
+            self.meta = json.load(file)
+
+        self.embeddings = np.load(self.directory / "embeddings.npy", mmap_mode=mode)
+        self.filled = np.load(self.directory / "filled.npy", mmap_mode=mode)
+        self.names = np.load(self.directory / "names.npy")
+        self._rows = None
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    @property
+    def dim(self):
+        return self.embeddings.shape[1]
+
+    @staticmethod
+    def create(directory, names, dim: int, embed: str = 'mean'):
+        """
+        Allocate an empty store for a catalog of objects, to be filled in as elections finish.
+
+        :param names: Unique names (or paths) of the objects, one per row.
+        :param dim: Length of every embedding (1024 for 'mean', 1024 * N_voters for 'concat').
+        :param embed: The pooling mode the embeddings come from, kept for reference.
+        :return: The store, opened for writing.
+        """
+        from numpy.lib.format import open_memmap
+
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        open_memmap(directory / "embeddings.npy", mode='w+', dtype=np.float16, shape=(len(names), dim)).flush()
+        np.save(directory / "filled.npy", np.zeros(len(names), dtype=bool))
+        np.save(directory / "names.npy", np.array([str(name) for name in names]))
+        with (directory / EMBEDDINGS_META_FILE).open('w') as file:
+            json.dump({"rows": len(names), "dim": dim, "embed": embed}, file, indent=2)
+
+        logging.info(f"Allocated {len(names)} x {dim} embeddings in {directory}.")
+        return EmbeddingStore(directory, mode='r+')
+
+    def row(self, name):
+        if self._rows is None:
+            self._rows = {str(name): i for i, name in enumerate(self.names)}
+
+        return self._rows[str(name)]
+
+    def __getitem__(self, name):
+        return np.asarray(self.embeddings[self.row(name)], dtype=np.float32)
+
+    def write(self, names, vectors):
+        rows = [self.row(name) for name in names]
+        self.embeddings[rows] = np.asarray(vectors, dtype=np.float16)
+        self.filled[rows] = True
+
+    def flush(self):
+        self.embeddings.flush()
+        self.filled.flush()
+
+    def neighbours(self, name, index, k: int = 10, nprobe: int = 8):
+        """
+        The objects that look most like the given one, e.g. a confirmed dual AGN.
+
+        :param index: An IVFIndex built over this store.
+        :return: A list of (name, cosine similarity), most similar first, without the object itself.
+        """
+        similarities, rows = index.search(self[name], k=k + 1, nprobe=nprobe)
+        own = self.row(name)
+
+        return [(str(self.names[row]), float(similarity))
+                for similarity, row in zip(similarities[0], rows[0]) if row >= 0 and row != own][:k]
+
+
+def _kmeans(x, k: int, iterations: int, rng, spherical: bool = True):
+    """
+    Lloyd's k-means in NumPy. Spherical k-means (cosine) for the coarse quantizer,
+    plain Euclidean k-means for the product quantizer's sub-codebooks.
+    """
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+
+    for _ in range(iterations):
+        if spherical:
+            labels = np.argmax(x @ centroids.T, axis=1)
+        else:
+            distances = (centroids ** 2).sum(axis=1) - 2 * x @ centroids.T
+            labels = np.argmin(distances, axis=1)
+
+        # Per-cluster sums without a one-hot matrix: sort by label and reduce every run
+        order = np.argsort(labels, kind='stable')
+        present, starts, counts = np.unique(labels[order], return_index=True, return_counts=True)
+        sums = np.add.reduceat(x[order], starts, axis=0)
+
+        updated = x[rng.choice(len(x), size=k)].copy()  # Empty clusters are reseeded on random points
+        updated[present] = sums / counts[:, np.newaxis]
+        centroids = _normalized(updated) if spherical else updated
+
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    def __init__(self, centroids, list_offsets, list_rows, norms, vectors=None, codebooks=None, codes=None):
+        """
+        An inverted-file index for cosine similarity search. Rows are bucketed by their
+        nearest coarse centroid, and a query only scores the rows of its nprobe nearest
+        buckets. With a product quantizer, those rows are scored from 1 byte per subspace
+        instead of the full embedding.
+
+        Use IVFIndex.build or IVFIndex.load rather than this constructor.
+        """
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.norms = norms
+        self.vectors = vectors
+        self.codebooks = codebooks
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.list_rows)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @staticmethod
+    def build(vectors, rows=None, n_lists: int = None, pq_subspaces: int = None,
+              iterations: int = 20, sample_size: int = 50000, seed: int = 0):
+        """
+        :param vectors: The [N, D] embedding matrix, e.g. EmbeddingStore.embeddings.
+        :param rows: Which rows to index; defaults to all of them.
+        :param n_lists: Number of coarse buckets; defaults to 4 sqrt(N).
+        :param pq_subspaces: Split every embedding into this many subspaces and keep a
+        1-byte code per subspace (D must be divisible by it). Without it, candidates
+        are scored exactly from the memory-mapped vectors.
+        :param sample_size: How many rows the quantizers are trained on.
+        """
+        rng = np.random.default_rng(seed)
+        rows = np.arange(len(vectors)) if rows is None else np.asarray(rows, dtype=np.int64)
+        n_lists = n_lists or int(np.clip(4 * np.sqrt(len(rows)), 1, len(rows)))
+
+        sample = np.sort(rng.choice(rows, size=min(sample_size, len(rows)), replace=False))
+        training = _normalized(vectors[sample])
+        centroids = _kmeans(training, n_lists, iterations, rng, spherical=True)
+        n_lists = len(centroids)
+
+        codebooks = None
+        if pq_subspaces:
+            if vectors.shape[1] % pq_subspaces:
+                raise RuntimeError(f"{vectors.shape[1]} dimensions can't be split into {pq_subspaces} subspaces.")
+
+            centers = min(256, len(training))
+            codebooks = np.stack([
+                _kmeans(np.ascontiguousarray(sub), centers, iterations, rng, spherical=False)
+                for sub in np.split(training, pq_subspaces, axis=1)
+            ])
+
+        # Assign every row to its bucket (and encode it) block by block
+        assignments = np.empty(len(rows), dtype=np.int32)
+        norms = np.empty(len(rows), dtype=np.float32)
+        codes = np.empty((len(rows), pq_subspaces), dtype=np.uint8) if pq_subspaces else None
+        for start in range(0, len(rows), _BLOCK):
+            block = np.asarray(vectors[rows[start:start + _BLOCK]], dtype=np.float32)
+            norms[start:start + len(block)] = np.linalg.norm(block, axis=1)
+            block = _normalized(block)
+
+            assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+            if codes is not None:
+                for j, sub in enumerate(np.split(block, pq_subspaces, axis=1)):
+                    distances = (codebooks[j] ** 2).sum(axis=1) - 2 * sub @ codebooks[j].T
+                    codes[start:start + len(block), j] = np.argmin(distances, axis=1)
+
+        order = np.argsort(assignments, kind='stable')
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+
+        logging.info(f"Indexed {len(rows)} embeddings into {n_lists} lists"
+                     f"{f' with {pq_subspaces} PQ subspaces' if pq_subspaces else ''}.")
+        return IVFIndex(
+            centroids=centroids, list_offsets=list_offsets, list_rows=rows[order], norms=norms[order],
+            vectors=vectors, codebooks=codebooks, codes=codes[order] if codes is not None else None
+        )
+
+    def save(self, path):
+        arrays = dict(centroids=self.centroids, list_offsets=self.list_offsets,
+                      list_rows=self.list_rows, norms=self.norms)
+        if self.codes is not None:
+            arrays.update(codebooks=self.codebooks, codes=self.codes)
+
+        np.savez(path, **arrays)
+
+    @staticmethod
+    def load(path, vectors=None):
+        """
+        :param vectors: The embedding matrix the index was built over. Only needed for
+        exact scoring (an index without PQ) or re-ranking.
+        """
+        stored = np.load(path)
+        return IVFIndex(
+            centroids=stored['centroids'], list_offsets=stored['list_offsets'],
+            list_rows=stored['list_rows'], norms=stored['norms'], vectors=vectors,
+            codebooks=stored['codebooks'] if 'codebooks' in stored else None,
+            codes=stored['codes'] if 'codes' in stored else None,
+        )
+
+    def _exact_scores(self, query, positions):
+        candidates = np.asarray(self.vectors[self.list_rows[positions]], dtype=np.float32)
+        return candidates @ query / np.maximum(self.norms[positions], 1e-12)
+
+    def search(self, queries, k: int = 10, nprobe: int = 8, rerank: int = 4):
+        """
+        Approximate cosine similarity search.
+
+        :param queries: One embedding [D] or several [M, D].
+        :param nprobe: How many of the nearest buckets to scan; more is slower but more exact.
+        :param rerank: With PQ, re-score the best rerank * k candidates exactly
+        (when the vectors are available). 0 to disable.
+        :return: (similarities, rows), each of shape [M, k], best first. Missing
+        neighbours have row -1 and similarity -inf.
+        """
+        queries = _normalized(np.atleast_2d(queries))
+        nprobe = min(nprobe, self.n_lists)
+
+        similarities = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+        for i, (query, lists) in enumerate(zip(queries, probes)):
+            positions = np.concatenate([
+                np.arange(self.list_offsets[j], self.list_offsets[j + 1]) for j in lists
+            ])
+            if not len(positions):
+                continue
+
+            if self.codes is None:
+                scores = self._exact_scores(query, positions)
+            else:
+                # Asymmetric distance: look up every code's inner product with the query's sub-vectors
+                tables = np.einsum('mcd,md->mc', self.codebooks, np.stack(np.split(query, len(self.codebooks))))
+                scores = tables[np.arange(len(self.codebooks)), self.codes[positions]].sum(axis=1)
+
+                if rerank and self.vectors is not None:
+                    shortlist = np.argsort(-scores)[:rerank * k]
+                    positions, scores = positions[shortlist], self._exact_scores(query, positions[shortlist])
+
+            best = np.argsort(-scores)[:k]
+            similarities[i, :len(best)] = scores[best]
+            rows[i, :len(best)] = self.list_rows[positions[best]]
+
+        return similarities, rows
@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 import numpy as np
 import logging
-from utils import discover_devices, arsinh_normalize
+from utils import discover_devices, arsinh_normalize, center_square, dihedral_views, NUM_DIHEDRAL_VIEWS, span, timed
 
 from .cnn import DRAGON
 
@@ -25,31 +25,70 @@ class DRAGONModel:
         self.model = self.model.to(self.device)
 
         logging.info(f"Loading state dict...")
-        if self.device == 'cpu':
-            self.model.load_state_dict(torch.load(model_path, map_location='cpu'))
-        else:
-            self.model.load_state_dict(torch.load(model_path))
+        with span('torch.load'):
+            if self.device == 'cpu':
+                self.model.load_state_dict(torch.load(model_path, map_location='cpu'))
+            else:
+                self.model.load_state_dict(torch.load(model_path))
 
-    def predict(self, datum: np.ndarray):
+    @timed('DRAGONModel.predict')
+    def predict_proba(self, datum: np.ndarray, tta: bool = False, return_features: bool = False):
         """
-        Predict a label for a single image.
-        :param datum: A single grayscale image of shape [192, 192] as a numpy array.
+        Compute the softmax class probabilities for one image or a stack of images.
+
+        :param datum: A single grayscale image of shape [H, W] or a batch of them
+        of shape [B, H, W] as a numpy array.
+        :param tta: If True, use test-time augmentation: all 8 dihedral views of every
+        image are classified in one batched forward pass and their probabilities averaged.
+        Rectangular images are center-cropped to a square first.
+        :param return_features: Also return the penultimate-layer embeddings from the same pass.
+        :return: A numpy array of shape [B, num_classes], and with return_features
+        the embeddings of shape [B, 1024] (averaged over the views with tta).
         """
-        logging.info("Prediction...")
         self.model.eval()
 
         # Convert numpy array to PyTorch tensor
-        datum = torch.from_numpy(datum).float()  # ensure float type
+        datum = torch.from_numpy(np.asarray(datum)).float()  # ensure float type
+
+        # With TTA, rectangular cutouts are cropped to a square, so all 8 dihedral views have
+        # the same shape. Without it they go in whole (the trunk still ends at 2x2 for 96x97).
+        if tta:
+            datum = center_square(datum)
         datum = arsinh_normalize(datum)
 
-        # Reshape: [H, W] -> [1, 1, H, W] (Batch x Channel x Height x Width)
-        datum = datum.unsqueeze(0).unsqueeze(0)
+        # Reshape: [H, W] -> [1, 1, H, W] or [B, H, W] -> [B, 1, H, W] (Batch x Channel x Height x Width)
+        if datum.dim() == 2:
+            datum = datum.unsqueeze(0)
+        datum = datum.unsqueeze(1)
+        batch_size = datum.shape[0]
+
+        if tta:
+            datum = dihedral_views(datum)
 
         with torch.no_grad():
             datum = datum.to(self.device)
-            outputs = self.model(datum)
+            outputs, features = self.model(datum, return_features=True)
             outputs = nn.functional.softmax(outputs, dim=1)
 
+        # Average the per-view probabilities back down to one row per image
+        if tta:
+            outputs = outputs.view(batch_size, NUM_DIHEDRAL_VIEWS, -1).mean(dim=1)
+            features = features.view(batch_size, NUM_DIHEDRAL_VIEWS, -1).mean(dim=1)
+
+        if return_features:
+            return outputs.cpu().numpy(), features.cpu().numpy()
+
+        return outputs.cpu().numpy()
+
+    def predict(self, datum: np.ndarray, tta: bool = False):
+        """
+        Predict a label for a single image.
+        :param datum: A single grayscale image of shape [192, 192] as a numpy array.
+        :param tta: Whether to average the prediction over the 8 dihedral views of the image.
+        """
+        logging.info("Prediction...")
+        outputs = torch.from_numpy(self.predict_proba(datum=datum, tta=tta))
+
         values, indices = torch.topk(outputs, 2, dim=1)
 
         predicted_confs, predicted_labels = torch.max(outputs, 1)
@@ -60,4 +99,3 @@ class DRAGONModel:
                 predicted_confs.cpu().numpy(),
                 second_predicted_labels.cpu().numpy(),
                 second_predicted_confs.cpu().numpy())
-
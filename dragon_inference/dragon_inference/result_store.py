@@ -0,0 +1,177 @@
+import numpy as np
+import hashlib
+import sqlite3
+import threading
+import logging
+import json
+import time
+import os
+
+# Checkpoint path -> ((size, mtime), sha256), so a checkpoint is only hashed again when it changes on disk.
+_checkpoint_hashes = dict()
+
+# SQLite caps the number of host parameters in one statement, so bulk lookups are chunked.
+_LOOKUP_CHUNK = 500
+
+
+def image_content_hash(image: np.ndarray):
+    """
+    Hash the bytes of a cutout, together with its shape and dtype, so that the
+    same pixels always map to the same key regardless of where the file came from.
+    """
+    image = np.ascontiguousarray(image)
+
+    digest = hashlib.sha256()
+    digest.update(f"{image.dtype.str}{image.shape}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def checkpoint_hash(path):
+    """
+    The SHA-256 of a checkpoint file, memoized on the file's size and modification time.
+    """
+    stat = os.stat(path)
+    signature = (stat.st_size, stat.st_mtime_ns)
+
+    cached = _checkpoint_hashes.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+
+    _checkpoint_hashes[path] = (signature, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def model_set_fingerprint(model_paths):
+    """
+    A fingerprint of the whole Congress: any retrained, added or removed checkpoint changes it.
+    Voters are identified by file name and content, so moving the model directory does not.
+    """
+    digest = hashlib.sha256()
+    for path in sorted(model_paths, key=os.path.basename):
+        digest.update(f"{os.path.basename(path)}:{checkpoint_hash(path)};".encode())
+
+    return digest.hexdigest()
+
+
+def model_dir_fingerprint(model_dir):
+    """The fingerprint of the .pt checkpoints in a model directory, as DRAGONEnsemble would load them."""
+    return model_set_fingerprint([os.path.join(model_dir, path) for path in os.listdir(model_dir) if path.endswith('.pt')])
+
+
+class PredictionStore:
+    def __init__(self, db_path='predictions.sqlite'):
+        """
+        A persistent cache of Congressional elections, keyed by the content hash of the
+        cutout and the fingerprint of the model set. Each entry keeps the full per-voter
+        softmax votes and the certified result, so a stored election can also be
+        re-certified under another aggregation policy without inference.
+
+        :param db_path: Where the SQLite database lives. It is created if needed.
+        """
+        self.db_path = str(db_path)
+
+        # Streamlit serves sessions from several threads, so share one connection behind a lock.
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS predictions (
+                    image_hash TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    tta INTEGER NOT NULL,
+                    num_voters INTEGER NOT NULL,
+                    num_classes INTEGER NOT NULL,
+                    votes BLOB NOT NULL,
+                    result TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    PRIMARY KEY (image_hash, fingerprint, tta)
+                )
+            """)
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+    @staticmethod
+    def _decode(row):
+        num_voters, num_classes, votes, result = row
+        result = json.loads(result)
+        result['votes'] = np.frombuffer(votes, dtype=np.float32).reshape(num_voters, num_classes)
+
+        return result
+
+    def get(self, image_hash: str, fingerprint: str, tta: bool = False):
+        """
+        :return: The stored election (with its "votes" array), or None if it has not been seen.
+        """
+        return self.get_many([image_hash], fingerprint=fingerprint, tta=tta).get(image_hash)
+
+    def get_many(self, image_hashes, fingerprint: str, tta: bool = False):
+        """
+        Look up many cutouts at once, for batch jobs.
+
+        :return: A dictionary of image hash -> stored election, for the hashes that were found.
+        """
+        image_hashes = list(dict.fromkeys(image_hashes))
+        found = dict()
+
+        with self._lock:
+            for i in range(0, len(image_hashes), _LOOKUP_CHUNK):
+                chunk = image_hashes[i:i + _LOOKUP_CHUNK]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._connection.execute(
+                    f"SELECT image_hash, num_voters, num_classes, votes, result FROM predictions "
+                    f"WHERE fingerprint = ? AND tta = ? AND image_hash IN ({placeholders})",
+                    [fingerprint, int(tta), *chunk]
+                )
+                for image_hash, *row in rows:
+                    found[image_hash] = self._decode(row)
+
+        return found
+
+    def put(self, image_hash: str, fingerprint: str, result: dict, tta: bool = False):
+        self.put_many([(image_hash, result)], fingerprint=fingerprint, tta=tta)
+
+    def put_many(self, entries, fingerprint: str, tta: bool = False):
+        """
+        :param entries: An iterable of (image hash, election result) pairs. Every result
+        must contain its "votes" array.
+        """
+        rows = []
+        now = time.time()
+        for image_hash, result in entries:
+            votes = np.ascontiguousarray(result['votes'], dtype=np.float32)
+            certified = {key: value for key, value in result.items() if key != 'votes'}
+            rows.append((image_hash, fingerprint, int(tta), votes.shape[0], votes.shape[1],
+                         votes.tobytes(), json.dumps(certified), now))
+
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def purge_stale(self, fingerprint: str):
+        """
+        Invalidate every election that was not run by the current model set.
+
+        :return: The number of entries removed.
+        """
+        with self._lock, self._connection:
+            removed = self._connection.execute(
+                "DELETE FROM predictions WHERE fingerprint != ?", (fingerprint,)
+            ).rowcount
+
+        logging.info(f"Purged {removed} stale predictions from {self.db_path}.")
+        return removed
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
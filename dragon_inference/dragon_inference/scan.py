@@ -0,0 +1,310 @@
+"""
+Fully-convolutional DRAGON scan over whole coadd patches, for dual AGN candidates
+without a prior catalog.
+
+Run from the dragon_inference directory:
+
+    python -m dragon_inference.scan --model-dir models --output scan.npz --candidates candidates.jsonl patch.fits
+"""
+import argparse
+import json
+import logging
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from utils import arsinh_normalize, timed, report_progress
+from .aggregation import aggregate
+from .cnn import DRAGON
+from .congress import DRAGONEnsemble
+
+# The trunk downsamples by 2 x 2 x 2 x 2 x 2, so neighbouring cells of the output map
+# are the windows 32 pixels apart.
+SCAN_STRIDE = 32
+
+# Every 3x3 convolution widens the receptive field; added up over the trunk that is
+# 55 pixels on each side. Tiles read this much context around their windows (rounded
+# up to a multiple of the stride, to keep the pooling grid aligned), so tiling gives
+# exactly the same map as one pass over the whole patch.
+SCAN_HALO = 64
+
+DUAL_AGN_CLASS = 5
+
+
+class ConvolutionalDRAGON(nn.Module):
+    def __init__(self, dragon: DRAGON):
+        """
+        The same network as DRAGON, with the fully connected head recast as convolutions:
+        fc1 sees the 512 x 2 x 2 trunk output of a window, so it is a 2x2 convolution,
+        and fc2 becomes a 1x1 convolution. Run over a large image, the trunk is computed
+        once and every overlapping window reuses it.
+
+        :param dragon: A trained DRAGON (e.g. DRAGONModel.model.module). The weights are shared, not copied.
+        """
+        super(ConvolutionalDRAGON, self).__init__()
+        self.cutout_size = dragon.cutout_size
+        self.num_classes = dragon.num_classes
+
+        self.trunk = nn.Sequential(
+            dragon.layer1, dragon.layer2, dragon.layer3, dragon.layer4,
+            dragon.layer5, dragon.layer6, dragon.layer7, dragon.layer8,
+        )
+
+        # Flattening [512, 2, 2] is channel-major, which is exactly the conv weight layout
+        self.fc1 = nn.Conv2d(512, dragon.fc1.out_features, kernel_size=2)
+        self.fc1.weight = nn.Parameter(dragon.fc1.weight.view(dragon.fc1.out_features, 512, 2, 2))
+        self.fc1.bias = dragon.fc1.bias
+
+        self.fc2 = nn.Conv2d(dragon.fc2.in_features, dragon.fc2.out_features, kernel_size=1)
+        self.fc2.weight = nn.Parameter(dragon.fc2.weight.view(dragon.fc2.out_features, dragon.fc2.in_features, 1, 1))
+        self.fc2.bias = dragon.fc2.bias
+
+    def forward(self, x):
+        """
+        :param x: Normalized images of shape [B, 1, H, W].
+        :return: Logit maps of shape [B, num_classes, (H - 88) // 32 + 1, (W - 88) // 32 + 1].
+        """
+        return self.fc2(self.fc1(self.trunk(x)))
+
+
+def _grid_size(length: int, window: int, stride: int):
+    return (length - window) // stride + 1
+
+
+class DRAGONScanner:
+    def __init__(self, model_dir='models', tile_size: int = 1024, shifts: int = 1, aggregation='hard'):
+        """
+        Scan large images with every member of the Congress.
+
+        :param model_dir: The directory containing the Congress checkpoints.
+        :param tile_size: Side of the square tiles (in pixels, without the halo) that are
+        read and classified at a time. Memory use scales with its square, not with the patch.
+        :param shifts: Also scan the image shifted by fractions of the 32 pixel stride, for
+        a map sampled every 32 / shifts pixels (at shifts ** 2 times the cost).
+        :param aggregation: How the voters are combined into the voted class map (see AGGREGATION_MODES).
+        """
+        if SCAN_STRIDE % shifts:
+            raise RuntimeError(f"The number of shifts must divide the stride of {SCAN_STRIDE} pixels.")
+
+        self.ensemble = DRAGONEnsemble(model_dir=model_dir, aggregation=aggregation)
+        self.tile_size = max(tile_size // SCAN_STRIDE, 1) * SCAN_STRIDE
+        self.shifts = shifts
+
+        # DRAGONModel wraps every network in DataParallel
+        self.voters, self.device = [], 'cpu'
+        for model in self.ensemble.model_dict.values():
+            self.voters.append(ConvolutionalDRAGON(model.model.module).to(model.device).eval())
+            self.device = model.device
+
+        self.window = self.voters[0].cutout_size if self.voters else 94
+        self.num_classes = self.voters[0].num_classes if self.voters else 0
+
+    @property
+    def stride(self):
+        """Pixels between neighbouring cells of the output maps."""
+        return SCAN_STRIDE // self.shifts
+
+    def _scan_tile(self, image, y0, x0, i0, i1, j0, j1):
+        """
+        Classify the windows (y0 + 32 i, x0 + 32 j) for i0 <= i < i1 and j0 <= j < j1.
+
+        :return: Softmax maps of every voter, of shape [i1 - i0, j1 - j0, N_voters, num_classes].
+        """
+        height, width = image.shape[0] - y0, image.shape[1] - x0
+
+        # Read the tile with its halo, clipped to the image but always on the pooling grid
+        top = max(i0 * SCAN_STRIDE - SCAN_HALO, 0)
+        left = max(j0 * SCAN_STRIDE - SCAN_HALO, 0)
+        bottom = min((i1 - 1) * SCAN_STRIDE + self.window + SCAN_HALO, height)
+        right = min((j1 - 1) * SCAN_STRIDE + self.window + SCAN_HALO, width)
+
+        tile = np.asarray(image[y0 + top:y0 + bottom, x0 + left:x0 + right], dtype=np.float32)
+        tile = arsinh_normalize(torch.from_numpy(tile))[None, None].to(self.device)
+
+        rows = slice(i0 - top // SCAN_STRIDE, i1 - top // SCAN_STRIDE)
+        cols = slice(j0 - left // SCAN_STRIDE, j1 - left // SCAN_STRIDE)
+
+        votes = []
+        with torch.no_grad():
+            for voter in self.voters:
+                logits = voter(tile)[0, :, rows, cols]
+                votes.append(nn.functional.softmax(logits, dim=0).permute(1, 2, 0).cpu().numpy())
+
+        return np.stack(votes, axis=2)
+
+    def _scan_grid(self, image, y0: int, x0: int):
+        """
+        One fully-convolutional pass over image[y0:, x0:], tile by tile.
+
+        :return: Votes of shape [rows, cols, N_voters, num_classes].
+        """
+        rows = _grid_size(image.shape[0] - y0, self.window, SCAN_STRIDE)
+        cols = _grid_size(image.shape[1] - x0, self.window, SCAN_STRIDE)
+        votes = np.empty((max(rows, 0), max(cols, 0), len(self.voters), self.num_classes), dtype=np.float32)
+
+        cells = self.tile_size // SCAN_STRIDE
+        for i0 in range(0, rows, cells):
+            for j0 in range(0, cols, cells):
+                i1, j1 = min(i0 + cells, rows), min(j0 + cells, cols)
+                votes[i0:i1, j0:j1] = self._scan_tile(image, y0, x0, i0, i1, j0, j1)
+
+        return votes
+
+    @timed('DRAGONScanner.scan')
+    def scan(self, image, aggregation=None):
+        """
+        :param image: A 2D image, e.g. the (memory-mapped) data of a coadd patch. Only
+        one tile of it is read into memory at a time.
+        :param aggregation: Overrides the scanner's aggregation mode.
+        :return: A dictionary of maps over the window grid, where cell (i, j) is the
+        window whose top-left pixel is (i * stride, j * stride):
+            probabilities       [num_classes, rows, cols], averaged over the voters
+            voted_class         [rows, cols], -1 where the election is too close to call
+            num_voters          [rows, cols]
+            average_confidence  [rows, cols]
+        along with the stride and window size in pixels.
+
+        The scores are not equal to the votes on the same windows cut out one at a time.
+        Every convolution pads 'same', so a lone cutout is zero-padded at its border, while
+        the scan sees the real neighbouring pixels there; no cell of the 2x2 trunk output
+        of a window escapes that border. benchmarks/scan_benchmark.py measures the difference.
+        """
+        if not self.voters:
+            raise RuntimeError("No DRAGON models found to scan with.")
+
+        rows = _grid_size(image.shape[0], self.window, self.stride)
+        cols = _grid_size(image.shape[1], self.window, self.stride)
+        if rows < 1 or cols < 1:
+            raise RuntimeError(f"The image must be at least {self.window} pixels on each side.")
+
+        votes = np.empty((rows, cols, len(self.voters), self.num_classes), dtype=np.float32)
+        passes = [(a, b) for a in range(self.shifts) for b in range(self.shifts)]
+        for n, (a, b) in enumerate(passes):
+            # Shifted passes fill the cells between the ones of the unshifted pass
+            shifted = self._scan_grid(image, a * self.stride, b * self.stride)
+            votes[a::self.shifts, b::self.shifts] = shifted[:len(range(a, rows, self.shifts)),
+                                                            :len(range(b, cols, self.shifts))]
+            report_progress((n + 1) / len(passes), f"{n + 1}/{len(passes)} scan passes done")
+
+        aggregation = self.ensemble.aggregation if aggregation is None else aggregation
+        temperatures, weights = None, None
+        if self.ensemble.calibration is not None and aggregation in ('weighted', 'temperature'):
+            temperatures, weights = self.ensemble.calibration.for_voters(self.ensemble.voters)
+
+        certified = aggregate(votes.reshape(rows * cols, *votes.shape[2:]), mode=aggregation,
+                              weights=weights, temperatures=temperatures)
+
+        return {
+            "probabilities": votes.mean(axis=2).transpose(2, 0, 1),
+            "voted_class": certified["voted_class"].reshape(rows, cols),
+            "num_voters": certified["num_voters"].reshape(rows, cols),
+            "average_confidence": certified["average_confidence"].reshape(rows, cols),
+            "stride": self.stride,
+            "window": self.window,
+            "aggregation": aggregation,
+        }
+
+    def scan_patch(self, path, extension: int = 1, aggregation=None):
+        """
+        Scan a coadd patch straight from disk. The patch is memory-mapped (or read by
+        section if it is tile-compressed), so multi-GB patches never sit in RAM whole.
+
+        :return: The maps of scan(), plus the patch header for find_peaks.
+        """
+        from astropy.io import fits
+
+        with fits.open(path, memmap=True) as hdul:
+            hdu = hdul[extension]
+            image = hdu.section if isinstance(hdu, fits.CompImageHDU) else hdu.data
+
+            result = self.scan(image, aggregation=aggregation)
+            result["header"] = hdu.header.copy()
+
+        return result
+
+
+def find_peaks(result, target_class: int = DUAL_AGN_CLASS, threshold: float = 0.5,
+               min_distance: int = 1, header=None):
+    """
+    Extract candidates from a scan: cells whose probability of the target class is above
+    the threshold and the largest within min_distance cells.
+
+    :param result: The output of DRAGONScanner.scan (or scan_patch).
+    :param target_class: The class to look for; Dual AGN by default.
+    :param header: A WCS header to also give every candidate's RA/Dec; defaults to the patch header.
+    :return: A list of candidates, most probable first, each with the pixel position of
+    its window center, its probability, and the class the Congress voted for there.
+    """
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    probability = result["probabilities"][target_class]
+    size = 2 * min_distance + 1
+    padded = np.pad(probability, min_distance, constant_values=-np.inf)
+    neighbourhood = sliding_window_view(padded, (size, size)).max(axis=(-1, -2))
+
+    ys, xs = np.nonzero((probability >= threshold) & (probability == neighbourhood))
+    order = np.argsort(-probability[ys, xs])
+    ys, xs = ys[order], xs[order]
+
+    # Cell (i, j) is the window whose top-left pixel is (i * stride, j * stride)
+    centers_x = xs * result["stride"] + (result["window"] - 1) / 2
+    centers_y = ys * result["stride"] + (result["window"] - 1) / 2
+
+    candidates = [{
+        "x": float(x),
+        "y": float(y),
+        "probability": float(probability[i, j]),
+        "voted_class": int(result["voted_class"][i, j]),
+        "num_voters": int(result["num_voters"][i, j]),
+    } for x, y, i, j in zip(centers_x, centers_y, ys, xs)]
+
+    header = result.get("header") if header is None else header
+    if header is not None and candidates:
+        from astropy.wcs import WCS
+
+        ra, dec = WCS(header).celestial.pixel_to_world_values(centers_x, centers_y)
+        for candidate, candidate_ra, candidate_dec in zip(candidates, np.atleast_1d(ra), np.atleast_1d(dec)):
+            candidate["ra"], candidate["dec"] = float(candidate_ra), float(candidate_dec)
+
+    return candidates
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan coadd patches for dual AGN candidates with the Congress.")
+    parser.add_argument('patches', nargs='+', help="Coadd patch FITS files.")
+    parser.add_argument('--model-dir', default='models')
+    parser.add_argument('--extension', type=int, default=1)
+    parser.add_argument('--tile-size', type=int, default=1024)
+    parser.add_argument('--shifts', type=int, default=1)
+    parser.add_argument('--aggregation', default='hard')
+    parser.add_argument('--target-class', type=int, default=DUAL_AGN_CLASS)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--output', default=None, help="Write the maps of every patch to this .npz.")
+    parser.add_argument('--candidates', default='candidates.jsonl')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    scanner = DRAGONScanner(model_dir=args.model_dir, tile_size=args.tile_size,
+                            shifts=args.shifts, aggregation=args.aggregation)
+
+    maps = dict()
+    with open(args.candidates, 'w') as file:
+        for i, path in enumerate(args.patches):
+            result = scanner.scan_patch(path, extension=args.extension)
+            candidates = find_peaks(result, target_class=args.target_class, threshold=args.threshold)
+            logging.info(f"{path}: {len(candidates)} candidates above {args.threshold}.")
+
+            for candidate in candidates:
+                file.write(json.dumps({"patch": str(path), **candidate}) + "\n")
+
+            maps[f"probabilities_{i}"] = result["probabilities"]
+            maps[f"voted_class_{i}"] = result["voted_class"]
+
+    if args.output is not None:
+        np.savez_compressed(args.output, patches=np.array(args.patches), **maps)
+
+
+if __name__ == '__main__':
+    main()
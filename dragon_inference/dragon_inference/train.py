@@ -0,0 +1,405 @@
+"""
+CPU training of Congress voters. Labeled cutouts are first converted once into
+pre-normalized, memory-mapped shards, so the training loop never touches FITS or
+recomputes the arsinh stretch. Every voter then trains in its own process on its own
+bootstrap sample of the shards (bagging), fed by a multi-worker DataLoader, and the
+final checkpoints are written in exactly the format DRAGONEnsemble loads.
+
+Run from the dragon_inference directory:
+
+    python -m dragon_inference.train shards --labels labeled_cutouts.csv --output shards/
+    python -m dragon_inference.train fit --shards shards/ --output new_models/ --voters 7 --epochs 10
+    python -m dragon_inference.train fit --shards shards/ --output new_models/ --init-from models/ --lr 1e-4
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+
+from utils import configure_threads, center_square
+from .cnn import DRAGON
+
+SHARDS_META_FILE = 'shards.json'
+
+# Training state is kept next to the final checkpoints, under a suffix DRAGONEnsemble doesn't pick up.
+CHECKPOINT_SUFFIX = '.ckpt'
+
+
+def prepare_cutout(image, cutout_size: int = 96):
+    """
+    Frame a cutout as DRAGONModel.predict_proba does with TTA (a center-crop to the
+    square of its shorter side, so the dihedral augmentations keep its shape) and apply
+    the same arsinh stretch, in NumPy.
+
+    :param cutout_size: The side the framed cutout must have. Cutouts framed to any
+    other size raise ValueError, since the network never sees them rescaled.
+    """
+    prepared = center_square(np.asarray(image, dtype=np.float32))
+    if prepared.shape != (cutout_size, cutout_size):
+        raise ValueError(f"A {np.shape(image)[0]}x{np.shape(image)[1]} cutout frames to "
+                         f"{prepared.shape[0]}x{prepared.shape[1]}, not {cutout_size}x{cutout_size}.")
+
+    with np.errstate(invalid='ignore', over='ignore'):
+        normalized = np.arcsinh(prepared)
+    normalized[np.isnan(normalized)] = 0
+    normalized[np.isinf(normalized)] = 255
+    return normalized
+
+
+def _write_shard(path, files, labels, cutout_size, extension):
+    """Worker side of build_shards: read, normalize and write one shard."""
+    from astropy.io import fits
+    from numpy.lib.format import open_memmap
+
+    images = open_memmap(f"{path}.images.npy", mode='w+', dtype=np.float32,
+                         shape=(len(files), cutout_size, cutout_size))
+    kept = np.ones(len(files), dtype=bool)
+    for i, file in enumerate(files):
+        try:
+            images[i] = prepare_cutout(fits.getdata(file, ext=extension), cutout_size)
+        except ValueError as e:
+            logging.warning(f"Skipping cutout {file}: {e}")
+            kept[i] = False
+        except Exception as e:
+            logging.warning(f"Skipping unreadable cutout {file}: {e}")
+            kept[i] = False
+
+    images.flush()
+    np.save(f"{path}.labels.npy", np.where(kept, labels, -1).astype(np.int64))
+    return Path(path).name, len(files), int(kept.sum())
+
+
+def build_shards(labels_csv, output_dir, cutout_size: int = 96, shard_size: int = 4096,
+                 extension: int = 1, workers: int = None):
+    """
+    Convert labeled cutouts into memory-mapped training shards.
+
+    :param labels_csv: A header-less CSV of `path,label` rows (see load_labeled_cutouts).
+    Relative paths are resolved against the CSV's directory.
+    :param output_dir: Where the shards and their index are written.
+    :param cutout_size: The side of the framed cutouts; 96 for the usual 96x97 DAS cutouts.
+    Cutouts that frame to another size are skipped.
+    :param shard_size: Cutouts per shard.
+    :param workers: Processes reading FITS files; defaults to one per core.
+    :return: The number of usable cutouts.
+    """
+    import pandas as pd
+
+    labels_csv, output_dir = Path(labels_csv), Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    labeled_df = pd.read_csv(labels_csv, header=None)
+    files = [str(path if Path(path).is_absolute() else labels_csv.parent / path) for path in labeled_df[0]]
+    labels = labeled_df[1].to_numpy(dtype=np.int64)
+
+    chunks = range(0, len(files), shard_size)
+    logging.info(f"Writing {len(files)} cutouts into {len(chunks)} shards in {output_dir}...")
+
+    shards = []
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        futures = [
+            pool.submit(_write_shard, output_dir / f"shard_{i // shard_size:05d}",
+                        files[i:i + shard_size], labels[i:i + shard_size], cutout_size, extension)
+            for i in chunks
+        ]
+        for future in futures:
+            shards.append(future.result())
+
+    meta = {
+        "cutout_size": cutout_size,
+        "normalization": 'arsinh',
+        "num_classes": int(labels.max()) + 1 if len(labels) else 0,
+        "shards": [{"name": name, "rows": rows} for name, rows, _ in shards],
+    }
+    with (output_dir / SHARDS_META_FILE).open('w') as file:
+        json.dump(meta, file, indent=2)
+
+    usable = sum(kept for _, _, kept in shards)
+    logging.info(f"{usable}/{len(files)} cutouts are usable for training.")
+    return usable
+
+
+class ShardDataset(torch.utils.data.Dataset):
+    def __init__(self, shard_dir, augment: bool = True):
+        """
+        The cutouts of a shard directory, read straight out of the memory-mapped shards.
+        Only file names are pickled into DataLoader workers; every worker maps the
+        shards itself on first use.
+
+        :param augment: Apply a random dihedral transformation (rotation and flip) to every cutout.
+        """
+        self.shard_dir = Path(shard_dir)
+        with (self.shard_dir / SHARDS_META_FILE).open() as file:
+            self.meta = json.load(file)
+
+        self.cutout_size = self.meta['cutout_size']
+        self.augment = augment
+        self.offsets = np.concatenate([[0], np.cumsum([shard['rows'] for shard in self.meta['shards']])])
+        self.labels = np.concatenate([
+            np.load(self.shard_dir / f"{shard['name']}.labels.npy") for shard in self.meta['shards']
+        ]) if self.meta['shards'] else np.empty(0, dtype=np.int64)
+        self._images = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def usable(self):
+        """Indices of the cutouts that could be read."""
+        return np.flatnonzero(self.labels >= 0)
+
+    def _shard_images(self, shard):
+        if self._images is None:
+            self._images = [None] * len(self.meta['shards'])
+        if self._images[shard] is None:
+            name = self.meta['shards'][shard]['name']
+            self._images[shard] = np.load(self.shard_dir / f"{name}.images.npy", mmap_mode='r')
+
+        return self._images[shard]
+
+    def __getitem__(self, index):
+        shard = int(np.searchsorted(self.offsets, index, side='right')) - 1
+        image = np.array(self._shard_images(shard)[index - self.offsets[shard]])
+
+        if self.augment:
+            image = np.rot90(image, k=np.random.randint(4))
+            if np.random.randint(2):
+                image = image[:, ::-1]
+
+        return torch.from_numpy(np.ascontiguousarray(image)).unsqueeze(0), int(self.labels[index])
+
+    def __getstate__(self):
+        # Memory maps don't travel to DataLoader workers; they reopen them instead
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+
+def _worker_seed(worker_id):
+    """Give every DataLoader worker its own augmentation stream, derived from the torch seed."""
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+
+
+def _epoch_order(bag, seed: int, epoch: int):
+    """The (reproducible) order the bag is visited in one epoch, so a resumed run sees the same batches."""
+    return np.random.default_rng([seed, epoch]).permutation(bag)
+
+
+def _strip_data_parallel(state_dict):
+    return {key[len('module.'):] if key.startswith('module.') else key: value for key, value in state_dict.items()}
+
+
+def _save_atomically(obj, path: Path):
+    partial = path.with_name(path.name + '.part')
+    torch.save(obj, partial)
+    os.replace(partial, path)
+
+
+def train_voter(shard_dir, output_path, seed: int, epochs: int = 10, batch_size: int = 64, lr: float = 1e-3,
+                weight_decay: float = 1e-4, threads: int = 1, loader_workers: int = 2,
+                checkpoint_every: int = 500, init_from=None, bootstrap: bool = True):
+    """
+    Train one voter on a bootstrap sample of the shards. Training state is checkpointed
+    every `checkpoint_every` steps and at the end of every epoch, and a restarted run
+    resumes from it.
+
+    :param output_path: The final .pt file, a DataParallel-style state dict that DRAGONEnsemble loads as is.
+    :param seed: Seeds the bootstrap sample, the batch order, the initialization and the augmentation.
+    :param threads: PyTorch intra-op threads of this voter.
+    :param loader_workers: DataLoader processes feeding this voter.
+    :param init_from: A checkpoint to fine-tune from instead of a random initialization.
+    :param bootstrap: Train on a bootstrap resample of the data (bagging) rather than all of it.
+    :return: The path of the final checkpoint.
+    """
+    output_path = Path(output_path)
+    checkpoint_path = output_path.with_suffix(CHECKPOINT_SUFFIX)
+    configure_threads(threads)
+    torch.manual_seed(seed)
+
+    dataset = ShardDataset(shard_dir)
+    usable = dataset.usable
+    rng = np.random.default_rng(seed)
+    bag = rng.choice(usable, size=len(usable), replace=True) if bootstrap else usable
+    out_of_bag = np.setdiff1d(usable, bag)
+
+    model = DRAGON(cutout_size=dataset.cutout_size)
+    if dataset.meta['num_classes'] > model.num_classes:
+        raise RuntimeError(f"The shards have {dataset.meta['num_classes']} classes, but DRAGON has {model.num_classes}.")
+    if init_from is not None:
+        model.load_state_dict(_strip_data_parallel(torch.load(init_from, map_location='cpu')))
+
+    optimizer = torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=weight_decay)
+    criterion = nn.CrossEntropyLoss()
+
+    epoch, step = 0, 0
+    if checkpoint_path.is_file():
+        state = torch.load(checkpoint_path, map_location='cpu')
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        epoch, step = state['epoch'], state['step']
+        logging.info(f"Voter {seed}: resuming at epoch {epoch}, step {step}.")
+
+    def checkpoint(epoch, step):
+        _save_atomically({"model": model.state_dict(), "optimizer": optimizer.state_dict(),
+                          "epoch": epoch, "step": step, "seed": seed}, checkpoint_path)
+
+    while epoch < epochs:
+        # Skip the batches a resumed run has already trained on
+        order = _epoch_order(bag, seed, epoch)[step * batch_size:]
+        loader = torch.utils.data.DataLoader(
+            dataset, batch_size=batch_size, sampler=order.tolist(), num_workers=loader_workers,
+            worker_init_fn=_worker_seed, drop_last=False,
+            **({'prefetch_factor': 4} if loader_workers else {}),
+        )
+
+        model.train()
+        start, waiting, seen, loss_sum = time.perf_counter(), 0.0, 0, 0.0
+        fetched = time.perf_counter()
+        for images, labels in loader:
+            waiting += time.perf_counter() - fetched
+
+            optimizer.zero_grad(set_to_none=True)
+            loss = criterion(model(images), labels)
+            loss.backward()
+            optimizer.step()
+
+            seen += len(labels)
+            loss_sum += loss.item() * len(labels)
+            step += 1
+            if checkpoint_every and step % checkpoint_every == 0:
+                checkpoint(epoch, step)
+
+            fetched = time.perf_counter()
+
+        elapsed = time.perf_counter() - start
+        epoch, step = epoch + 1, 0
+        checkpoint(epoch, step)
+
+        # A large share of time spent waiting on the loader means it needs more workers
+        logging.info(f"Voter {seed}: epoch {epoch}/{epochs}, loss {loss_sum / max(seen, 1):.4f}, "
+                     f"{seen / elapsed:.0f} cutouts/s, {100 * waiting / elapsed:.0f}% waiting for data.")
+
+    accuracy = evaluate(model, dataset, out_of_bag, batch_size=batch_size * 4) if len(out_of_bag) else None
+    if accuracy is not None:
+        logging.info(f"Voter {seed}: out-of-bag accuracy {accuracy:.3f} on {len(out_of_bag)} cutouts.")
+
+    # DRAGONModel wraps the network in DataParallel before loading, so the keys need the same prefix.
+    _save_atomically({f"module.{key}": value for key, value in model.state_dict().items()}, output_path)
+    checkpoint_path.unlink()
+    return output_path
+
+
+def evaluate(model, dataset, indices, batch_size: int = 256):
+    """:return: The accuracy of a model on the given cutouts of a ShardDataset, without augmentation."""
+    augment, dataset.augment = dataset.augment, False
+    model.eval()
+
+    correct = 0
+    with torch.no_grad():
+        for start in range(0, len(indices), batch_size):
+            images, labels = zip(*(dataset[int(i)] for i in indices[start:start + batch_size]))
+            predictions = model(torch.stack(images)).argmax(dim=1)
+            correct += int((predictions == torch.tensor(labels)).sum())
+
+    dataset.augment = augment
+    return correct / len(indices)
+
+
+def train_congress(shard_dir, output_dir, voters: int = 7, processes: int = None, loader_workers: int = 2,
+                   seed: int = 0, init_from=None, **kwargs):
+    """
+    Train a Congress of bagged voters concurrently, one process per voter. The cores
+    are split between the voters' training threads and their DataLoader workers.
+
+    :param output_dir: Where the voters' .pt files are written (dragon_bag_<seed>.pt).
+    :param voters: Number of voters to train; voter i is seeded with seed + i.
+    :param processes: Voters training at the same time; defaults to all of them, as
+    far as the cores allow.
+    :param init_from: A model directory to fine-tune from; voter i starts from its i-th
+    checkpoint (cycling through them if there are fewer).
+    :param kwargs: Passed on to train_voter (epochs, batch_size, lr, ...).
+    :return: The paths of the trained checkpoints.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    cores = os.cpu_count() or 1
+    processes = processes or max(min(voters, cores // (loader_workers + 1)), 1)
+    threads = max(cores // processes - loader_workers, 1)
+
+    starting_points = [None] * voters
+    if init_from is not None:
+        checkpoints = sorted(Path(init_from).glob('*.pt'))
+        if not checkpoints:
+            raise RuntimeError(f"No checkpoints to fine-tune from in {init_from}.")
+        starting_points = [checkpoints[i % len(checkpoints)] for i in range(voters)]
+
+    logging.info(f"Training {voters} voters, {processes} at a time with {threads} threads "
+                 f"and {loader_workers} loader workers each...")
+
+    context = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+        futures = [
+            pool.submit(train_voter, shard_dir, output_dir / f"dragon_bag_{seed + i}.pt", seed + i,
+                        threads=threads, loader_workers=loader_workers, init_from=starting_points[i], **kwargs)
+            for i in range(voters)
+        ]
+
+        paths = []
+        for future in as_completed(futures):
+            paths.append(future.result())
+            logging.info(f"Finished {paths[-1]} ({len(paths)}/{voters}).")
+
+    return sorted(paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train Congress voters on CPU.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    shards = commands.add_parser('shards', help="Convert labeled cutouts into training shards.")
+    shards.add_argument('--labels', required=True, help="Header-less CSV of `path,label` rows.")
+    shards.add_argument('--output', required=True)
+    shards.add_argument('--cutout-size', type=int, default=96)
+    shards.add_argument('--shard-size', type=int, default=4096)
+    shards.add_argument('--workers', type=int, default=None)
+
+    fit = commands.add_parser('fit', help="Train bagged voters on the shards.")
+    fit.add_argument('--shards', required=True)
+    fit.add_argument('--output', required=True, help="Directory for the new .pt files.")
+    fit.add_argument('--voters', type=int, default=7)
+    fit.add_argument('--processes', type=int, default=None)
+    fit.add_argument('--loader-workers', type=int, default=2)
+    fit.add_argument('--epochs', type=int, default=10)
+    fit.add_argument('--batch-size', type=int, default=64)
+    fit.add_argument('--lr', type=float, default=1e-3)
+    fit.add_argument('--checkpoint-every', type=int, default=500)
+    fit.add_argument('--seed', type=int, default=0)
+    fit.add_argument('--init-from', default=None, help="Model directory to fine-tune from.")
+    fit.add_argument('--no-bootstrap', action='store_true', help="Train every voter on all of the data.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    if args.command == 'shards':
+        build_shards(args.labels, args.output, cutout_size=args.cutout_size,
+                     shard_size=args.shard_size, workers=args.workers)
+    else:
+        train_congress(
+            args.shards, args.output, voters=args.voters, processes=args.processes,
+            loader_workers=args.loader_workers, seed=args.seed, init_from=args.init_from,
+            epochs=args.epochs, batch_size=args.batch_size, lr=args.lr,
+            checkpoint_every=args.checkpoint_every, bootstrap=not args.no_bootstrap,
+        )
+
+
+if __name__ == '__main__':
+    main()
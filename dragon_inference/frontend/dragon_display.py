@@ -1,22 +1,47 @@
 from hsc_downloader import HSCDownloader
 from dragon_analysis import DRAGONAnalysis, CentroidPoint
-from centroid_marker import CentroidMarker
+from dragon_inference import AGGREGATION_MODES, PredictionStore, image_content_hash
 from galaxy_inference import GalaxyInference
-from utils import go_to_page, go_back
-from utils import load_fits, implot
+from utils import go_to_page, go_back, patch_torch_for_streamlit
+from utils import implot, span, export_json, export_prometheus, get_fits_store, get_job_queue
 
 from pathlib import Path
 from st_bridge import bridge
 
 import streamlit as st
+import logging
 import os
-import matplotlib.pyplot as plt
-import pandas as pd
-import astropy.units as u
+from collections import deque
 
-import mpld3
 import streamlit.components.v1 as components
 
+# matplotlib, pandas, mpld3 and astropy are imported by the pages that use them, so
+# that the Login page doesn't pay for the whole scientific stack.
+
+
+# One prediction store per server process, shared by every session.
+@st.cache_resource
+def get_prediction_store(db_path: str = 'predictions.sqlite'):
+    return PredictionStore(db_path=db_path)
+
+
+@st.cache_data
+def load_labels(labels_path: str = 'frontend/labels.csv'):
+    import pandas as pd
+
+    # Read CSV without a header
+    labels_df = pd.read_csv(labels_path, header=None)
+    return dict(zip(labels_df[0], labels_df[1]))
+
+
+def _classify(image, tta, aggregation, store):
+    """Background job: assemble the Congress and run the election."""
+    patch_torch_for_streamlit()
+
+    # Creating a DRAGON predictor object
+    predictor = DRAGONAnalysis(model_dir='models', tta=tta, aggregation=aggregation, store=store)
+    return predictor.run(image=image)
+
 
 # Frontend server, effectively served by API requests to the backend (frontend/dragon_display.py)
 class DRAGONDisplay:
@@ -41,6 +66,18 @@ class DRAGONDisplay:
             st.session_state.centroid_coordinates = []
         if 'fits' not in st.session_state:
             st.session_state['fits'] = None
+        if 'spectrum_future' not in st.session_state:
+            st.session_state['spectrum_future'] = None
+
+        # Background jobs this session is waiting on (see utils.JobQueue)
+        if 'download_job' not in st.session_state:
+            st.session_state['download_job'] = None
+        if 'classify_job' not in st.session_state:
+            st.session_state['classify_job'] = None
+
+        # Memoized page stages: name -> (inputs, output)
+        if 'stages' not in st.session_state:
+            st.session_state['stages'] = dict()
 
         # Button State
         if 'toggle_dragon' not in st.session_state:
@@ -50,6 +87,78 @@ class DRAGONDisplay:
         if 'inference_state' not in st.session_state:
             st.session_state['inference_state'] = 'Centroids'
 
+        # Stage timings of the most recent script runs (only filled when profiling is enabled)
+        if 'traces' not in st.session_state:
+            st.session_state['traces'] = deque(maxlen=5)
+
+    def display_timings_sidebar(self):
+        """
+        Sidebar panel with the per-stage timings of the last few requests in this
+        session, plus the process-wide histograms for download and what the shared FITS
+        store currently holds.
+        """
+        with st.sidebar:
+            st.subheader("Stage Timings")
+
+            import pandas as pd
+
+            traces = [trace for trace in st.session_state['traces'] if len(trace)]
+            if not traces:
+                st.caption("No timed stages yet.")
+
+            for trace in reversed(traces):
+                total = sum(stage['duration_s'] for stage in trace)
+                with st.expander(f"{trace.label}: {total * 1e3:.1f} ms", expanded=(trace is traces[-1])):
+                    st.dataframe(pd.DataFrame([{
+                        "Stage": stage['stage'],
+                        "Start (ms)": round(stage['start_s'] * 1e3, 2),
+                        "Duration (ms)": round(stage['duration_s'] * 1e3, 2),
+                    } for stage in trace]), hide_index=True)
+
+            st.download_button("Histograms (JSON)", export_json(), file_name="dragon_timings.json")
+            st.download_button("Histograms (Prometheus)", export_prometheus(), file_name="dragon_timings.prom")
+
+            st.subheader("FITS Store")
+            stats = get_fits_store().stats()
+            st.caption(f"{stats['resident_bytes'] / 1024 ** 2:.2f} MiB resident of "
+                       f"{stats['max_resident_bytes'] / 1024 ** 2:.0f} MiB budget")
+            if stats['objects']:
+                st.dataframe(pd.DataFrame([{
+                    "Object": Path(entry['path']).name,
+                    "HDU": entry['extension'],
+                    "Sessions": entry['refs'],
+                    "KiB": round(entry['bytes'] / 1024, 1),
+                } for entry in stats['objects']]), hide_index=True)
+
+            st.subheader("Jobs")
+            jobs = get_job_queue().stats()
+            if not jobs['in_flight'] and not jobs['recent']:
+                st.caption("No background jobs yet.")
+            else:
+                st.dataframe(pd.DataFrame([{
+                    "Job": job['label'],
+                    "Status": job['status'],
+                    "Progress": f"{job['progress']:.0%}",
+                    "Sessions": job['subscribers'],
+                } for job in jobs['in_flight'] + jobs['recent']]), hide_index=True)
+
+    @st.fragment(run_every=0.5)
+    def _display_job_progress(self, job_key: str):
+        """
+        Poll a background job without rerunning the page. Once it finishes, the whole page
+        reruns so it can pick up the result.
+        """
+        job = st.session_state[job_key]
+        if job is None:
+            return
+
+        if job.done():
+            st.rerun()
+
+        st.progress(job.progress, text=f"{job.label}: {job.message}")
+        if job.subscribers > 1:
+            st.caption(f"Shared with {job.subscribers - 1} other request(s) for the same object.")
+
     def display_login_GUI(self):
         with st.form("LoginGUI"):
             st.subheader('Login')
@@ -91,26 +200,52 @@ class DRAGONDisplay:
 
         # Only after the form are we allowed to do this.
         if submitted:
-            with st.status("Downloading from HSC..."):
-                file_path = downloader.cutout_query_sdss(sdss_name=sdss_name)
-                st.session_state['sdss_name'] = sdss_name
-                if file_path is not None:
-                    st.session_state['file'] = file_path
-                    st.write(f"File written to {file_path}...") # TODO: alter functionality
+            # The spectrum is only needed on the last page, so fetch it while the cutout downloads.
+            st.session_state['spectrum_future'] = downloader.prefetch_spectrum(sdss_name=sdss_name)
+
+            # The download runs in the background, so reruns don't restart it
+            st.session_state['sdss_name'] = sdss_name
+            st.session_state['download_job'] = get_job_queue().submit(
+                ('download', sdss_name), downloader.cutout_query_sdss, sdss_name,
+                label=f"Cutout of {sdss_name}"
+            )
+
+        job = st.session_state['download_job']
+        if job is not None and job.done():
+            st.session_state['download_job'] = None
 
-                    go_to_page('Image')
+            file_path = job.result()
+            if file_path is not None:
+                st.session_state['file'] = file_path
+                st.write(f"File written to {file_path}...") # TODO: alter functionality
 
+                go_to_page('Image')
+        elif job is not None:
+            self._display_job_progress('download_job')
+
+
+    def _get_fits(self, extension: int = 1):
+        """
+        The session only keeps a handle into the process-wide FITS store, so concurrent
+        users looking at the same object share a single read-only copy of it.
+        """
+        key = 'fits' if extension == 1 else f'fits_{extension}'
+        handle = st.session_state.get(key)
+
+        # A new object was downloaded since the handle was taken
+        if handle is None or handle.path != str(Path(st.session_state['file']).resolve()):
+            if handle is not None:
+                handle.release()
+
+            handle = get_fits_store().acquire(st.session_state['file'], extension=extension)
+            st.session_state[key] = handle
+
+        return handle
 
     def _get_hsc_image(self):
         # Final interactive interface
-        if st.session_state['fits'] is None:
-            header, data = load_fits(file_path=st.session_state['file'], extension=1)
-            st.session_state['fits'] = {
-                "header": header,
-                "data": data
-            }
-        else:
-            header, data = st.session_state['fits']['header'], st.session_state['fits']['data']
+        fits_handle = self._get_fits(extension=1)
+        header, data = fits_handle.header, fits_handle.data
 
         fig, ax = implot(
             image=data,
@@ -124,16 +259,37 @@ class DRAGONDisplay:
 
         return fig, ax
 
+    def _stage(self, name, inputs, compute):
+        """
+        Every widget interaction reruns the whole script, so the steps of a page are memoized
+        on their actual inputs, and a rerun only recomputes the stages whose inputs changed.
+
+        :param name: Name of the stage.
+        :param inputs: Hashable inputs of the stage (file, centroids, radii...).
+        :param compute: Called without arguments to compute the stage when its inputs changed.
+        """
+        stages = st.session_state['stages']
+        if name not in stages or stages[name][0] != inputs:
+            stages[name] = (inputs, compute())
+
+        return stages[name][1]
+
+    def _centroid_inputs(self):
+        return st.session_state['file'], tuple(
+            (point['x'], point['y']) for point in st.session_state.centroid_coordinates
+        )
+
     def _init_centroids(self):
-        # Split into the two coordinates and convert!
-        c1, c2 = st.session_state.centroid_coordinates
-        c1, c2 = CentroidPoint(c1), CentroidPoint(c2)
+        def convert():
+            # Split into the two coordinates and convert!
+            c1, c2 = st.session_state.centroid_coordinates
+            c1, c2 = CentroidPoint(c1), CentroidPoint(c2)
 
-        # This should already be cached, so should take minimal time.
-        header, data = load_fits(file_path=st.session_state['file'], extension=1)
-        c1, c2 = c1.convert_WCS(wcs_header=header), c2.convert_WCS(wcs_header=header)
+            # This is held in the shared FITS store, so should take minimal time.
+            header = self._get_fits(extension=1).header
+            return c1.convert_WCS(wcs_header=header), c2.convert_WCS(wcs_header=header)
 
-        return c1, c2
+        return self._stage('centroids', self._centroid_inputs(), convert)
 
 
     def display_image_GUI(self):
@@ -164,28 +320,55 @@ class DRAGONDisplay:
                 ],
             )
 
+            use_tta = st.checkbox(
+                "Average each DRAGON vote over all rotations and flips of the image (test-time augmentation).",
+                value=False
+            )
+            aggregation = st.selectbox(
+                "Vote aggregation",
+                AGGREGATION_MODES,
+                help="'hard' is the original majority vote. 'weighted' and 'temperature' need a fitted calibration."
+            )
+
             submitted = st.form_submit_button(label="Submit", icon=None, disabled=False, use_container_width=False)
 
         # Upon submission
         if submitted:
             st.session_state['toggle_dragon'] = ( use_dragon == 'Yes.' )
-            with st.status("Running DRAGON..."):
-                # This should already be cached, so should take minimal time.
-                header, data = load_fits(file_path=st.session_state['file'], extension=1)
-                st.session_state['fits'] = {
-                    "header": header,
-                    "data": data
-                }
-
-                # Creating a DRAGON predictor object
-                predictor = DRAGONAnalysis(model_dir='models')
-                st.session_state['classification'] = predictor.run(image=data)
+
+            # This is held in the shared FITS store, so should take minimal time.
+            data = self._get_fits(extension=1).data
+
+            # Objects that have been classified before (in any session) come straight from the store.
+            store = get_prediction_store()
+            classification = DRAGONAnalysis.lookup(
+                image=data, store=store, model_dir='models', tta=use_tta, aggregation=aggregation
+            )
+
+            if classification is not None:
+                st.session_state['classification'] = classification
+                go_to_page('Inference')
+
+            # Otherwise the election runs in the background, shared with anyone classifying the same cutout
+            st.session_state['classify_job'] = get_job_queue().submit(
+                ('classify', image_content_hash(data), use_tta, aggregation),
+                _classify, data.copy(), use_tta, aggregation, store,
+                label=f"DRAGON election on {Path(st.session_state['file']).stem}"
+            )
+
+        job = st.session_state['classify_job']
+        if job is not None and job.done():
+            st.session_state['classify_job'] = None
+            st.session_state['classification'] = job.result()
 
             go_to_page('Inference')
+        elif job is not None:
+            self._display_job_progress('classify_job')
 
         # Display the image itself
         fig, ax = self._get_hsc_image()
-        st.pyplot(fig)
+        with span('render'):
+            st.pyplot(fig)
 
 
     def _display_centroid_detector(self):
@@ -202,12 +385,16 @@ class DRAGONDisplay:
                    "points will suffice. Your selected points will be marked in :red[**red**] "
                    "and will be saved and **automatically disappear** upon selection of _two_ points.")
 
-        # Read CSV without a header
-        labels_df = pd.read_csv("frontend/labels.csv", header=None)
-        labels = dict(zip(labels_df[0], labels_df[1]))
+        import mpld3
+        from centroid_marker import CentroidMarker
+
+        labels = load_labels()
 
         # Unpacking prediction from DRAGON
-        pred_class, num_voters, total_voters, avg_confidence = st.session_state["classification"].values()
+        classification = st.session_state["classification"]
+        pred_class, num_voters, total_voters, avg_confidence = (
+            classification[key] for key in ("voted_class", "num_voters", "total_voters", "average_confidence")
+        )
 
         st.write(f"{num_voters}/{total_voters} DRAGON models predict that the object "
                  f"is a **{labels[pred_class]}** with {(avg_confidence * 100):.3f}% probability.")
@@ -237,10 +424,13 @@ class DRAGONDisplay:
         mpld3.plugins.connect(fig, mpld3.plugins.MousePosition())
         mpld3.plugins.connect(fig, CentroidMarker())
 
-        fig_html = mpld3.fig_to_html(fig)
-        components.html(fig_html, height=1000)
+        with span('render'):
+            fig_html = mpld3.fig_to_html(fig)
+            components.html(fig_html, height=1000)
 
     def _plot_spectrum(self, spec):
+        import matplotlib.pyplot as plt
+
         data = spec[1].data
         wavelength = 10 ** data['loglam']
         flux = data['flux']
@@ -255,41 +445,51 @@ class DRAGONDisplay:
         st.pyplot(fig)
 
 
+    def _get_spectrum(self):
+        """
+        Hand over the spectrum prefetched on the Cutout page. If the prefetch never
+        started (e.g. the page was reloaded), fall back to the on-disk spectrum cache.
+        A fetch that fails shows a warning, and the page goes on without a spectrum.
+        """
+        future = st.session_state.get('spectrum_future')
+        if future is None:
+            downloader = HSCDownloader(user=st.session_state['user'], password=st.session_state['password'])
+            future = downloader.prefetch_spectrum(st.session_state['sdss_name'])
+            st.session_state['spectrum_future'] = future
+
+        try:
+            return future.result()
+        except ValueError:
+            return None
+        except Exception as e:
+            # SDSS unreachable, a dropped connection, or nothing recorded for a replaying transport.
+            # The failed fetch is forgotten, so the next rerun tries again.
+            logging.warning(f"Could not fetch the spectrum of {st.session_state['sdss_name']}: {e}")
+            st.warning(f"The spectrum could not be fetched: {e}")
+            st.session_state['spectrum_future'] = None
+            return None
+
     # Private helper method used in the subsequent method
     def _display_inference_graphs(self):
+        import astropy.units as u
+
         # Initialize centroid detection module
         st.subheader("Inference Results")
 
         c1, c2 = self._init_centroids()
-        radius1 = st.slider(f'Radius of Centroid 1 at {c1} (Pixels)', min_value=1, max_value=10, value=5, step=1)
-        radius2 = st.slider(f'Radius of Centroid 2 at {c1} (Pixels)', min_value=1, max_value=10, value=5, step=1)
 
         with st.status("Calculating separations..."):
             st.write(f"The centroids chosen are at {c1}, {c2}.")
 
-            sep = DRAGONAnalysis.separation(c1, c2)
-            sep = sep.to(u.arcsec)
-
-        with st.status("Calculating magnitudes..."):
-            header0, _ = load_fits(file_path=st.session_state['file'], extension=0)
-            fluxmag_0 = header0['FLUXMAG0']
-
-            header, data = st.session_state['fits']['header'], st.session_state['fits']['data']
-            mag_dict = DRAGONAnalysis.calculate_magnitudes(
-                image=data,
-                center_coords=[c1.extract_point(), c2.extract_point()],
-                radii=[radius1, radius2],
-                fluxmag_0=fluxmag_0
+            sep = self._stage(
+                'separation', self._centroid_inputs(),
+                lambda: DRAGONAnalysis.separation(c1, c2).to(u.arcsec)
             )
 
-            # Just for extra measure.
-            st.write(mag_dict)
-
         with st.status("Attempting to fetch spectrum...") as status:
             st.write(f"Fetching SDSS name {st.session_state['sdss_name']}...")
 
-            downloader = HSCDownloader(user=st.session_state['user'], password=st.session_state['password'])
-            spectrum = downloader.query_spectrum(st.session_state['sdss_name'])
+            spectrum = self._get_spectrum()
 
             if spectrum is None:
                 status.update(
@@ -300,17 +500,96 @@ class DRAGONDisplay:
                     label="Download complete!", state="complete", expanded=False
                 )
 
+        # The radius sliders only rerun this fragment, not the whole page
+        self._display_photometry(c1, c2, sep)
+
+        # Plot spectrum if it exists
+        if not spectrum:
+            return None
+
+        self._plot_spectrum(spectrum)
+
+    def _get_variance(self):
+        """The variance plane of the cutout, or None if it doesn't have one."""
+        try:
+            return self._get_fits(extension=3).data
+        except IndexError:
+            return None
+
+    @staticmethod
+    def _error_text(mag_dict, key):
+        error = mag_dict.get(f"{key}_err")
+        return f" ± {error:.2g}" if error is not None else ""
+
+    @st.fragment
+    def _display_photometry(self, c1, c2, sep):
+        import matplotlib.pyplot as plt
+
+        # Apertures overlap for close pairs, so the two sources can be deblended with a joint PSF fit instead
+        method = st.radio("Photometry", ("Aperture", "PSF fit"), horizontal=True)
+        if method == "Aperture":
+            radius1 = st.slider(f'Radius of Centroid 1 at {c1} (Pixels)', min_value=1, max_value=10, value=5, step=1)
+            radius2 = st.slider(f'Radius of Centroid 2 at {c2} (Pixels)', min_value=1, max_value=10, value=5, step=1)
+
+        # Errors from 1000 noise realizations and centroid jitter; cheap, since they're all one matrix product
+        with_errors = st.checkbox("Monte Carlo uncertainties", value=False)
+        realizations = 1000 if with_errors else None
+
+        with st.status("Calculating magnitudes..."):
+            fluxmag_0 = self._stage(
+                'fluxmag_0', st.session_state['file'],
+                lambda: self._get_fits(extension=0).header['FLUXMAG0']
+            )
+
+            if method == "Aperture":
+                mag_dict = self._stage(
+                    'magnitudes', (*self._centroid_inputs(), radius1, radius2, realizations),
+                    lambda: DRAGONAnalysis.calculate_magnitudes(
+                        image=self._get_fits(extension=1).data,
+                        center_coords=[c1.extract_point(), c2.extract_point()],
+                        radii=[radius1, radius2],
+                        fluxmag_0=fluxmag_0,
+                        realizations=realizations,
+                        variance=self._get_variance() if realizations else None
+                    )
+                )
+            else:
+                mag_dict = self._stage(
+                    'psf_magnitudes', self._centroid_inputs(),
+                    lambda: DRAGONAnalysis.calculate_psf_magnitudes(
+                        image=self._get_fits(extension=1).data,
+                        center_coords=[c1.extract_point(), c2.extract_point()],
+                        fluxmag_0=fluxmag_0,
+                        variance=self._get_variance()
+                    )
+                )
+
+            separation_error = ""
+            if with_errors:
+                separation = self._stage(
+                    'separation_uncertainty', self._centroid_inputs(),
+                    lambda: DRAGONAnalysis.separation_uncertainty(
+                        c1, c2, wcs_header=self._get_fits(extension=1).header, realizations=realizations
+                    )
+                )
+                separation_error = self._error_text(separation, 'separation_arcsec') + " arcsec"
+
+            # Just for extra measure.
+            st.write(mag_dict)
+
         # Unpacking prediction from DRAGON (again)
-        labels_df = pd.read_csv("frontend/labels.csv", header=None)
-        labels = dict(zip(labels_df[0], labels_df[1]))
-        pred_class, num_voters, total_voters, avg_confidence = st.session_state["classification"].values()
+        labels = load_labels()
+        classification = st.session_state["classification"]
+        pred_class, num_voters, total_voters, avg_confidence = (
+            classification[key] for key in ("voted_class", "num_voters", "total_voters", "average_confidence")
+        )
 
         st.markdown(f"""
         ### Projected Angular Separation and Magnitude Difference
 
-        - **Angular Separation:** {sep:.3g}
-        - **Magnitude Difference:** {mag_dict['diff']:.4g}  
-        - **Flux Ratio:** {mag_dict['flux_ratio']:.4g}
+        - **Angular Separation:** {sep:.3g}{separation_error}
+        - **Magnitude Difference:** {mag_dict['diff']:.4g}{self._error_text(mag_dict, 'diff')}
+        - **Flux Ratio:** {mag_dict['flux_ratio']:.4g}{self._error_text(mag_dict, 'flux_ratio')}
         - **Classification**: {labels[pred_class]}, {(avg_confidence * 100):.3f}% probability.
         """)
 
@@ -323,13 +602,8 @@ class DRAGONDisplay:
         mag_dict['aperture2'].plot(color='white', lw=2, label='Photometry Aperture 2')
 
         plt.legend()
-        st.pyplot(fig)
-
-        # Plot spectrum if it exists
-        if not spectrum:
-            return None
-
-        self._plot_spectrum(spectrum)
+        with span('render'):
+            st.pyplot(fig)
 
 
     def display_inference_results(self):
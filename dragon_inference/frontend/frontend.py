@@ -1,13 +1,10 @@
 import streamlit as st
 from dragon_display import DRAGONDisplay
-from utils import go_back, go_to_page
+from utils import go_back, go_to_page, profiling_enabled, start_trace
 import logging
 
-import os
-import torch
-
-# Required to allow PyTorch to work with Streamlit.
-torch.classes.__path__ = [os.path.join(torch.__path__[0], torch.classes.__file__)]
+# torch is no longer imported here: the Image page loads it (and applies the Streamlit
+# torch.classes workaround, see utils.patch_torch_for_streamlit) right before an election.
 
 # Initial Methods
 if 'page' not in st.session_state:
@@ -21,6 +18,11 @@ st.button('Previous Page', on_click=go_back, disabled=( st.session_state['page']
 # Initializing DRAGON Display class
 dragon_frontend = DRAGONDisplay()
 
+# With DRAGON_PROFILE set, show the previous runs' stage timings and time this one.
+if profiling_enabled():
+    dragon_frontend.display_timings_sidebar()
+    st.session_state['traces'].append(start_trace(label=st.session_state['page']))
+
 # Switch statement for pages
 if st.session_state['page'] == 'Login':
     dragon_frontend.display_login_GUI()
@@ -1 +1,4 @@
-from .downloader import *
\ No newline at end of file
+from .downloader import *
+from .local_coadds import *
+from .spectrum_store import *
+from .transport import *
\ No newline at end of file
@@ -1,22 +1,93 @@
-import requests
 from pathlib import Path
-from astroquery.sdss import SDSS
-from astropy.coordinates import SkyCoord
-import astropy.units as u
 import logging
+import time
+import os
+
+from utils import timed, verify_fits_file, get_job_queue, report_progress
+from .transport import get_transport
+
+# Name resolution is shared by the cutout and spectrum queries, so remember it per process.
+_resolved_names = dict()
+
+
+class IncompleteDownload(Exception):
+    """The connection ended before the whole file arrived; the download can be resumed."""
+
+
+# Bounds of the adaptive read size while streaming downloads.
+_MIN_CHUNK = 16 * 1024
+_MAX_CHUNK = 4 * 1024 * 1024
+
+
+def _adaptive_chunks(raw, chunk_size: int = 64 * 1024):
+    """
+    Read a raw response stream with a chunk size that grows while reads return quickly
+    and shrinks on a slow link, instead of a fixed 8 KiB.
+    """
+    while True:
+        start = time.perf_counter()
+        chunk = raw.read(chunk_size, decode_content=True)
+        if not chunk:
+            return
+
+        yield chunk
+
+        elapsed = time.perf_counter() - start
+        if elapsed < 0.05 and len(chunk) == chunk_size:
+            chunk_size = min(chunk_size * 2, _MAX_CHUNK)
+        elif elapsed > 1.0:
+            chunk_size = max(chunk_size // 2, _MIN_CHUNK)
+
+
+def _expected_length(response, offset: int):
+    """
+    The final size of the file being downloaded, from Content-Range for a resumed
+    download or Content-Length otherwise. None if the server doesn't say, or if the body
+    is content-encoded (then the header counts compressed bytes).
+    """
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range and not content_range.endswith('/*'):
+        return int(content_range.rsplit('/', 1)[1])
+
+    content_length = response.headers.get('Content-Length')
+    return offset + int(content_length) if content_length is not None else None
 
 
 class HSCDownloader:
-    def __init__(self, user: str, password: str, pwd: Path = Path.cwd()):
+    def __init__(self, user: str, password: str, pwd: Path = Path.cwd(), spectrum_store=None, transport=None):
         """
         This class handles requests and queries to the HSC telescope database.
+
+        :param spectrum_store: An optional SpectrumStore that every queried spectrum is
+        also added to, for batched line measurements across the catalog.
+        :param transport: The Transport that HSC and SDSS requests go through, to record
+        or replay them. Defaults to the process-wide one (see get_transport).
         """
         self.user = user
         self.password = password
         self.pwd = pwd
+        self.spectrum_store = spectrum_store
+        self.transport = transport if transport is not None else get_transport()
 
 
+    @timed('_query_sdss_name')
     def _query_sdss_name(self, sdss_name: str):
+        if sdss_name in _resolved_names:
+            return _resolved_names[sdss_name]
+
+        ra, dec = self.transport.resolve(sdss_name, lambda: self._resolve_sdss_name(sdss_name))
+        _resolved_names[sdss_name] = (ra, dec)
+        return ra, dec
+
+    def _resolve_sdss_name(self, sdss_name: str):
+        # astroquery and astropy.coordinates are slow to import, so only pay for them on download.
+        from astroquery.sdss import SDSS
+        from astropy.coordinates import SkyCoord
+        import astropy.units as u
+
         # Try resolving the name as an object
         try:
             pos = SkyCoord.from_name(sdss_name)
@@ -63,12 +134,10 @@ class HSCDownloader:
 
         return None  # If everything fails, return None
 
-    def _cutout_post(self, ra: float, dec: float, obj_name: str = "default") -> Path:
-        s = requests.Session()
-        s.auth = (self.user, self.password)
-
-        base_url = "https://hsc-release.mtk.nao.ac.jp/das_cutout/pdr3/cgi-bin/cutout"
-        params = {
+    @staticmethod
+    def cutout_request(ra: float, dec: float) -> dict:
+        """The query parameters of the DAS cutout of an object."""
+        return {
             "ra": ra,
             "dec": dec,
             "sw": "8asec",
@@ -80,23 +149,90 @@ class HSCDownloader:
             "rerun": "pdr3_wide"
         }
 
+    @timed('_cutout_post')
+    def _cutout_post(self, ra: float, dec: float, obj_name: str = "default") -> Path:
+        base_url = "https://hsc-release.mtk.nao.ac.jp/das_cutout/pdr3/cgi-bin/cutout"
+        params = self.cutout_request(ra=ra, dec=dec)
+
         filename = self.pwd / f"{obj_name}.fits"
 
-        # If already a file, no need to do anything!
+        # If already a file, no need to do anything! (As long as it isn't a truncated leftover.)
         if Path(filename).is_file():
-            return filename
+            try:
+                verify_fits_file(filename)
+                return filename
+            except OSError as e:
+                logging.warning(f"Discarding invalid cutout {filename}: {e}")
+                filename.unlink()
 
-        response = s.get(base_url, params=params, auth=s.auth, stream=True, timeout=30)
-        response.raise_for_status()
+        def download(filename):
+            import requests
 
-        with filename.open('wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
+            s = requests.Session()
+            s.auth = (self.user, self.password)
+            return self._stream_to_file(s, base_url, params, filename)
 
-        return filename
+        return self.transport.download('cutout', params, filename, download)
+
+    def _stream_to_file(self, session, url: str, params: dict, filename: Path, max_retries: int = 5) -> Path:
+        """
+        Stream a download into `<filename>.part`, resuming with HTTP Range requests after a
+        dropped connection. The file only gets its real name (by an atomic rename) once its
+        length matches Content-Length and it passes the FITS integrity checks.
+        """
+        import requests
+
+        partial = filename.with_suffix('.fits.part')
+        for attempt in range(max_retries):
+            offset = partial.stat().st_size if partial.exists() else 0
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+            try:
+                with session.get(url, params=params, auth=session.auth, headers=headers,
+                                 stream=True, timeout=30) as response:
+                    if response.status_code == 416:
+                        # Our partial file is at least as long as the resource, so start over
+                        partial.unlink()
+                        continue
+                    response.raise_for_status()
+
+                    # A server that ignores the Range header sends the whole file again
+                    resumed = offset and response.status_code == 206
+                    expected = _expected_length(response, offset if resumed else 0)
+
+                    with partial.open('ab' if resumed else 'wb') as file:
+                        for chunk in _adaptive_chunks(response.raw):
+                            file.write(chunk)
+                            if expected:
+                                report_progress(file.tell() / expected, f"Downloaded {file.tell() // 1024} KiB")
+
+                size = partial.stat().st_size
+                if expected is not None and size != expected:
+                    raise IncompleteDownload(f"Received {size} of {expected} bytes.")
+
+                try:
+                    verify_fits_file(partial)
+                except OSError:
+                    # Complete but corrupt, so resuming would not help
+                    partial.unlink()
+                    raise
+
+                os.replace(partial, filename)
+                return filename
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError, IncompleteDownload) as e:
+                # Only a dropped or short transfer is worth resuming; HTTP errors (bad
+                # credentials, no such cutout) and corrupt files propagate right away
+                wait = min(2 ** attempt, 30)
+                logging.warning(f"Download of {filename.name} interrupted ({e}); retrying in {wait}s...")
+                time.sleep(wait)
+
+        raise RuntimeError(f"Could not download {filename.name} after {max_retries} attempts.")
 
     # Manual SQL query in the SDSS database.
     def _manual_SQL_query(self, query: str):
+        from astroquery.sdss import SDSS
+
         res = SDSS.query_sql(query, timeout=120)
         res = res.to_pandas()
 
@@ -105,17 +241,79 @@ class HSCDownloader:
 
         return res
 
+    def spectrum_path(self, sdss_name: str) -> Path:
+        """Where the spectrum of an object is cached on disk."""
+        return self.pwd / 'spectra' / f"{sdss_name}.fits"
+
     # Just get the spectrum in SDSS if it exists.
+    @timed('query_spectrum')
     def query_spectrum(self, sdss_name: str):
+        """
+        :param sdss_name: The desired SDSS name of the galaxy
+        :return: The SDSS spectrum as an HDUList. Spectra (and the absence of one) are
+        cached on disk per object, so only the first query touches the network.
+        """
+        from astropy.io import fits
+
+        path = self.spectrum_path(sdss_name)
+        missing_marker = path.with_suffix('.none')
+
+        if path.is_file():
+            with fits.open(path) as cached:
+                spectrum = fits.HDUList([hdu.copy() for hdu in cached])
+
+            self._store_spectrum(sdss_name, spectrum)
+            return spectrum
+        if missing_marker.is_file():
+            raise ValueError(f"No spectrum found near {sdss_name} (cached).")
+
         ra, dec = self._query_sdss_name(sdss_name)
+        spectrum = self.transport.spectrum(
+            {'ra': ra, 'dec': dec, 'radius': '8asec'}, lambda: self._nearest_spectrum(ra, dec)
+        )
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if spectrum is None:
+            missing_marker.touch()
+            raise ValueError(f"No spectrum found near {sdss_name} (RA: {ra}, Dec: {dec})")
+
+        # Write it atomically, so a crash never leaves half a file
+        partial = path.with_suffix('.fits.part')
+        spectrum.writeto(partial, overwrite=True)
+        os.replace(partial, path)
+
+        self._store_spectrum(sdss_name, spectrum)
+        return spectrum
+
+    def _nearest_spectrum(self, ra: float, dec: float):
+        """:return: The HDUList of the first SDSS spectrum within 8 arcsec, or None."""
+        from astroquery.sdss import SDSS
+        from astropy.coordinates import SkyCoord
+        import astropy.units as u
+
         position = SkyCoord(ra=ra, dec=dec, unit=(u.deg, u.deg), frame='icrs')
 
         # Query the nearest spectrum
         xid = SDSS.query_region(position, radius=8 * u.arcsec, spectro=True)
-
         if xid is None or len(xid) == 0:
-            raise ValueError(f"No spectrum found near {sdss_name} (RA: {ra}, Dec: {dec})")
+            return None
+
+        return SDSS.get_spectra(matches=xid)[0]
+
+    def _store_spectrum(self, sdss_name: str, spectrum):
+        if self.spectrum_store is not None and sdss_name not in self.spectrum_store:
+            self.spectrum_store.add_hdul(sdss_name, spectrum)
 
-        # Download and return the first spectrum
-        spectra = SDSS.get_spectra(matches=xid)
-        return spectra[0]
\ No newline at end of file
+    def prefetch_spectrum(self, sdss_name: str):
+        """
+        Start fetching the spectrum in the background, e.g. while the cutout downloads.
+        Prefetching the same object twice (from any session) shares the one fetch, and
+        once it is finished the disk cache takes over.
+
+        :return: A concurrent.futures.Future resolving to the spectrum HDUList. Its
+        result() re-raises ValueError if SDSS has no spectrum for the object.
+        """
+        job = get_job_queue().submit(
+            ('spectrum', sdss_name), self.query_spectrum, sdss_name, label=f"Spectrum of {sdss_name}"
+        )
+        return job.future
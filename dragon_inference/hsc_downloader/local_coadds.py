@@ -0,0 +1,272 @@
+from pathlib import Path
+from collections import OrderedDict
+import threading
+import logging
+import os
+
+import numpy as np
+
+from .downloader import HSCDownloader
+from utils import timed, unit_vectors
+
+# HSC coadds are sampled at 0.168"/pixel; only used if a header has no usable WCS scale.
+HSC_PIXEL_SCALE = 0.168
+
+INDEX_FILE = 'coadd_index.npz'
+
+
+class CoaddIndex:
+    def __init__(self, paths, centers, radii, mtimes):
+        """
+        A spatial index over locally stored coadd patches. Every patch is described by
+        the unit vector of its center and the angular radius of the circle enclosing
+        its footprint (both read from the WCS header), so matching objects to patches
+        is one matrix product.
+
+        :param paths: The patch FITS files.
+        :param centers: [N, 3] unit vectors of the patch centers.
+        :param radii: [N] enclosing radii in radians.
+        :param mtimes: [N] modification times, to notice patches that changed on disk.
+        """
+        self.paths = [str(path) for path in paths]
+        self.centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+        self.radii = np.asarray(radii, dtype=np.float64)
+        self.mtimes = np.asarray(mtimes, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.paths)
+
+    @staticmethod
+    def build(coadd_dir, extension: int = 1, pattern: str = '**/*.fits'):
+        """
+        Read only the headers of every coadd under a directory and index their footprints.
+        """
+        from astropy.io import fits
+        from astropy.wcs import WCS
+
+        paths, centers, radii, mtimes = [], [], [], []
+        for path in sorted(Path(coadd_dir).glob(pattern)):
+            try:
+                header = fits.getheader(path, ext=extension)
+                wcs = WCS(header)
+            except Exception as e:
+                logging.warning(f"Skipping {path}, which has no readable WCS: {e}")
+                continue
+
+            ny, nx = header['NAXIS2'], header['NAXIS1']
+            center = np.array(wcs.pixel_to_world_values((nx - 1) / 2, (ny - 1) / 2))
+            corners = wcs.calc_footprint(axes=(nx, ny))
+
+            center_vector = unit_vectors(*center)
+            corner_vectors = unit_vectors(corners[:, 0], corners[:, 1])
+            radius = np.arccos(np.clip(corner_vectors @ center_vector, -1, 1)).max()
+
+            paths.append(path)
+            centers.append(center_vector)
+            radii.append(radius)
+            mtimes.append(os.path.getmtime(path))
+
+        logging.info(f"Indexed {len(paths)} coadd patches under {coadd_dir}.")
+        return CoaddIndex(paths, np.array(centers), np.array(radii), np.array(mtimes))
+
+    def save(self, path):
+        np.savez(path, paths=np.array(self.paths), centers=self.centers, radii=self.radii, mtimes=self.mtimes)
+
+    @staticmethod
+    def load_or_build(coadd_dir, extension: int = 1, index_path=None):
+        """
+        Load the saved index of a coadd directory, rebuilding it if patches were added,
+        removed or modified since it was written.
+        """
+        index_path = Path(index_path) if index_path is not None else Path(coadd_dir) / INDEX_FILE
+
+        if index_path.is_file():
+            stored = np.load(index_path)
+            index = CoaddIndex(stored['paths'], stored['centers'], stored['radii'], stored['mtimes'])
+
+            current = sorted(str(path) for path in Path(coadd_dir).glob('**/*.fits'))
+            unchanged = current == sorted(index.paths) and all(
+                os.path.getmtime(path) == mtime for path, mtime in zip(index.paths, index.mtimes)
+            )
+            if unchanged:
+                return index
+
+        index = CoaddIndex.build(coadd_dir, extension=extension)
+        index.save(index_path)
+        return index
+
+    def candidates(self, ra, dec):
+        """
+        Vectorized match of objects to the patches whose footprint may contain them.
+
+        :param ra: Right ascensions in degrees, shape [M].
+        :param dec: Declinations in degrees, shape [M].
+        :return: A boolean array of shape [M, N].
+        """
+        vectors = unit_vectors(np.atleast_1d(ra), np.atleast_1d(dec))
+        return vectors @ self.centers.T >= np.cos(self.radii)
+
+
+class LocalCoaddDownloader(HSCDownloader):
+    def __init__(
+            self,
+            coadd_dir,
+            pwd: Path = Path.cwd(),
+            semi_width_arcsec: float = 8.0,
+            extension: int = 1,
+            index_path=None,
+            max_open_patches: int = 32,
+            user: str = '',
+            password: str = '',
+    ):
+        """
+        A drop-in replacement for HSCDownloader that cuts objects out of coadd patches
+        held on local disk instead of asking the HSC DAS cutout service. Names are still
+        resolved through SDSS, and cutouts are written in the same layout as the DAS ones
+        (FLUXMAG0 in the primary header, the image in extension 1).
+
+        :param coadd_dir: Directory containing the coadd patch FITS files.
+        :param semi_width_arcsec: Half the cutout width, like the DAS "sw"/"sh" parameters.
+        :param extension: The HDU holding the image in the coadd files.
+        :param index_path: Where to keep the spatial index; defaults to coadd_dir/coadd_index.npz.
+        :param max_open_patches: How many memory-mapped patches to keep open at once.
+        """
+        super().__init__(user=user, password=password, pwd=pwd)
+        self.coadd_dir = Path(coadd_dir)
+        self.semi_width_arcsec = semi_width_arcsec
+        self.extension = extension
+        self.max_open_patches = max_open_patches
+
+        self.index = CoaddIndex.load_or_build(coadd_dir, extension=extension, index_path=index_path)
+
+        # Patch path -> (HDUList opened with memmap, WCS), least recently used first
+        self._open_patches = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _open_patch(self, path):
+        from astropy.io import fits
+        from astropy.wcs import WCS
+
+        with self._lock:
+            if path in self._open_patches:
+                self._open_patches.move_to_end(path)
+                return self._open_patches[path]
+
+            hdul = fits.open(path, memmap=True, lazy_load_hdus=True)
+            patch = (hdul, WCS(hdul[self.extension].header))
+            self._open_patches[path] = patch
+
+            while len(self._open_patches) > self.max_open_patches:
+                _, (stale, _) = self._open_patches.popitem(last=False)
+                stale.close()
+
+        return patch
+
+    def _semi_width_pixels(self, wcs):
+        from astropy.wcs.utils import proj_plane_pixel_scales
+
+        try:
+            scale = proj_plane_pixel_scales(wcs.celestial).mean() * 3600
+        except Exception:
+            scale = HSC_PIXEL_SCALE
+
+        return int(round(self.semi_width_arcsec / scale))
+
+    def _locate(self, patch_indices, ra, dec):
+        """
+        Among the candidate patches, pick the one in which the object sits furthest from the edge.
+
+        :return: (patch path, x, y) or None if no patch actually contains the object.
+        """
+        best, best_margin = None, -np.inf
+        for i in patch_indices:
+            hdul, wcs = self._open_patch(self.index.paths[i])
+            ny, nx = hdul[self.extension].header['NAXIS2'], hdul[self.extension].header['NAXIS1']
+
+            x, y = wcs.world_to_pixel_values(ra, dec)
+            margin = min(x, y, nx - 1 - x, ny - 1 - y)
+            if margin > best_margin:
+                best, best_margin = (self.index.paths[i], float(x), float(y)), margin
+
+        return best if best_margin >= 0 else None
+
+    def _extract(self, path, x, y):
+        """
+        Slice a cutout centered on pixel (x, y) out of a patch with a memory-mapped section
+        read. Parts of the box that fall off the patch are filled with NaN, so every cutout
+        has the same shape.
+        """
+        hdul, wcs = self._open_patch(path)
+        hdu = hdul[self.extension]
+        ny, nx = hdu.header['NAXIS2'], hdu.header['NAXIS1']
+
+        half = self._semi_width_pixels(wcs)
+        x0, y0 = int(round(x)) - half, int(round(y)) - half
+        x1, y1 = x0 + 2 * half, y0 + 2 * half
+
+        image = np.full((2 * half, 2 * half), np.nan, dtype=np.float32)
+        sx0, sy0, sx1, sy1 = max(x0, 0), max(y0, 0), min(x1, nx), min(y1, ny)
+        image[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = hdu.section[sy0:sy1, sx0:sx1]
+
+        # Shifting the reference pixel keeps the WCS exact, even for boxes hanging off the patch
+        cutout_wcs = wcs.deepcopy()
+        cutout_wcs.wcs.crpix -= np.array([x0, y0])
+        header = cutout_wcs.to_header()
+        return image, header, hdul[0].header.get('FLUXMAG0')
+
+    def _write_cutout(self, filename: Path, image, header, fluxmag_0):
+        from astropy.io import fits
+
+        primary = fits.PrimaryHDU()
+        if fluxmag_0 is not None:
+            primary.header['FLUXMAG0'] = fluxmag_0
+
+        # Write next to the target and rename, so readers never see half a file
+        partial = filename.with_suffix('.fits.part')
+        fits.HDUList([primary, fits.ImageHDU(data=image, header=header)]).writeto(partial, overwrite=True)
+        os.replace(partial, filename)
+
+        return filename
+
+    @timed('local_cutout')
+    def _cutout_post(self, ra: float, dec: float, obj_name: str = "default") -> Path:
+        filename = self.pwd / f"{obj_name}.fits"
+
+        # If already a file, no need to do anything!
+        if filename.is_file():
+            return filename
+
+        candidates = np.flatnonzero(self.index.candidates(ra, dec)[0])
+        located = self._locate(candidates, ra, dec)
+        if located is None:
+            raise RuntimeWarning(f"No local coadd patch covers RA {ra}, Dec {dec}.")
+
+        return self._write_cutout(filename, *self._extract(*located))
+
+    def cutouts(self, ras, decs, obj_names):
+        """
+        Bulk cutout extraction for already resolved positions. Objects are matched to
+        patches in one vectorized step, then processed patch by patch so each patch is
+        memory-mapped once.
+
+        :return: A list with the cutout path of every object, or None where no patch covers it.
+        """
+        ras, decs = np.asarray(ras, dtype=np.float64), np.asarray(decs, dtype=np.float64)
+        matches = self.index.candidates(ras, decs)
+
+        located = [self._locate(np.flatnonzero(matches[i]), ras[i], decs[i]) for i in range(len(ras))]
+        order = sorted((i for i in range(len(ras)) if located[i] is not None), key=lambda i: located[i][0])
+
+        filenames = [None] * len(ras)
+        for i in order:
+            filename = self.pwd / f"{obj_names[i]}.fits"
+            filenames[i] = filename if filename.is_file() else \
+                self._write_cutout(filename, *self._extract(*located[i]))
+
+        return filenames
+
+    def close(self):
+        with self._lock:
+            for hdul, _ in self._open_patches.values():
+                hdul.close()
+            self._open_patches.clear()
@@ -0,0 +1,146 @@
+from pathlib import Path
+import threading
+import logging
+import json
+import os
+
+import numpy as np
+
+SPECTRUM_META_FILE = 'spectra.json'
+
+# Per-pixel columns, each stored as one flat float32 file with every spectrum back to back.
+SPECTRUM_COLUMNS = ('loglam', 'flux', 'ivar')
+
+
+class SpectrumStore:
+    def __init__(self, directory):
+        """
+        A compact columnar cache of SDSS spectra. Rather than one FITS file per object,
+        every per-pixel column (log-wavelength, flux, inverse variance) is a single flat
+        float32 file with all spectra back to back, and spectrum i occupies
+        offsets[i]:offsets[i + 1] of each. The columns are memory-mapped, so batched
+        measurements over thousands of spectra read only what they use.
+
+        :param directory: Where the store lives; it is created if needed.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._columns = None
+
+        meta_path = self.directory / SPECTRUM_META_FILE
+        if meta_path.is_file():
+            with meta_path.open() as file:
+                self.meta = json.load(file)
+        else:
+            self.meta = {"names": [], "offsets": [0], "z": []}
+
+        self._rows = {name: i for i, name in enumerate(self.meta['names'])}
+
+    def __len__(self):
+        return len(self.meta['names'])
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    @property
+    def names(self):
+        return list(self.meta['names'])
+
+    @property
+    def offsets(self):
+        return np.asarray(self.meta['offsets'], dtype=np.int64)
+
+    @property
+    def redshifts(self):
+        return np.asarray(self.meta['z'], dtype=np.float64)
+
+    def row(self, name):
+        return self._rows[name]
+
+    def _column_path(self, column):
+        return self.directory / f"{column}.f32"
+
+    @property
+    def columns(self):
+        """The memory-mapped per-pixel columns, re-opened after every write."""
+        if self._columns is None:
+            self._columns = {
+                column: np.memmap(self._column_path(column), dtype=np.float32, mode='r')
+                if self._column_path(column).is_file() and self.meta['offsets'][-1] else np.empty(0, dtype=np.float32)
+                for column in SPECTRUM_COLUMNS
+            }
+
+        return self._columns
+
+    def add_many(self, names, loglams, fluxes, ivars, redshifts):
+        """
+        Append spectra to the store. Objects already in it are skipped.
+
+        :param names: Object names (e.g. SDSS names).
+        :param loglams: Per spectrum, log10 of the vacuum wavelengths in Angstrom.
+        :param fluxes: Per spectrum, the flux density.
+        :param ivars: Per spectrum, the inverse variance of the flux (0 for masked pixels).
+        :param redshifts: The redshift of every object.
+        """
+        with self._lock:
+            added = 0
+            files = {column: self._column_path(column).open('ab') for column in SPECTRUM_COLUMNS}
+            try:
+                # Drop whatever an interrupted write left past the last committed spectrum
+                for file in files.values():
+                    file.truncate(self.meta['offsets'][-1] * 4)
+
+                for name, loglam, flux, ivar, z in zip(names, loglams, fluxes, ivars, redshifts):
+                    if name in self._rows:
+                        continue
+
+                    for column, values in zip(SPECTRUM_COLUMNS, (loglam, flux, ivar)):
+                        files[column].write(np.asarray(values, dtype=np.float32).tobytes())
+
+                    self._rows[name] = len(self.meta['names'])
+                    self.meta['names'].append(name)
+                    self.meta['offsets'].append(self.meta['offsets'][-1] + len(loglam))
+                    self.meta['z'].append(float(z))
+                    added += 1
+            finally:
+                for file in files.values():
+                    file.close()
+
+            # The columns are only ever appended to, so the index is what commits a write
+            partial = self.directory / f"{SPECTRUM_META_FILE}.part"
+            with partial.open('w') as file:
+                json.dump(self.meta, file)
+            os.replace(partial, self.directory / SPECTRUM_META_FILE)
+            self._columns = None
+
+        if added:
+            logging.info(f"Added {added} spectra to {self.directory}.")
+
+    def add_hdul(self, name, hdul):
+        """Add one SDSS spectrum, as returned by HSCDownloader.query_spectrum."""
+        coadd = hdul[1].data
+        z = hdul[2].data['Z'][0] if len(hdul) > 2 and 'Z' in hdul[2].columns.names else 0.0
+
+        self.add_many([name], [coadd['loglam']], [coadd['flux']], [coadd['ivar']], [z])
+
+    def ingest_directory(self, spectra_dir):
+        """
+        Import the per-object FITS files of the downloader's spectrum cache (spectra/<name>.fits).
+        """
+        from astropy.io import fits
+
+        for path in sorted(Path(spectra_dir).glob('*.fits')):
+            if path.stem in self._rows:
+                continue
+
+            try:
+                with fits.open(path) as hdul:
+                    self.add_hdul(path.stem, hdul)
+            except Exception as e:
+                logging.warning(f"Skipping unreadable spectrum {path}: {e}")
+
+    def __getitem__(self, name):
+        """:return: (loglam, flux, ivar) of one object."""
+        start, stop = self.meta['offsets'][self.row(name)], self.meta['offsets'][self.row(name) + 1]
+        return tuple(np.asarray(self.columns[column][start:stop]) for column in SPECTRUM_COLUMNS)
@@ -0,0 +1,255 @@
+from pathlib import Path
+import threading
+import hashlib
+import logging
+import shutil
+import json
+import time
+import os
+
+from utils import report_progress
+
+# live: talk to HSC and SDSS. record: the same, but every response is also saved to the archive.
+# replay: serve the archive, paced like the network. cache-only: serve the archive at disk speed.
+TRANSPORT_MODES = ('live', 'record', 'replay', 'cache-only')
+
+TRANSPORT_INDEX_FILE = 'transport.json'
+
+# Replayed downloads are written in chunks of this size, so the pacing (and progress) is smooth.
+_REPLAY_CHUNK = 256 * 1024
+
+
+def _request_key(kind: str, request: dict) -> str:
+    """A stable name for a request, from everything that determines its response."""
+    payload = json.dumps([kind, request], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()[:20]
+
+
+class Transport:
+    def __init__(self, mode: str = 'live', archive=None, latency: float = None, bandwidth: float = None):
+        """
+        Every HSC and SDSS request of HSCDownloader goes through a transport. Live, it just
+        calls the network; while recording, every response (name resolutions, cutouts and
+        spectra) is also kept in a local archive, which later runs can replay offline and
+        deterministically.
+
+        :param mode: One of TRANSPORT_MODES.
+        :param archive: The directory responses are recorded to and replayed from.
+        :param latency: When replaying, seconds before every response instead of the
+        recorded timings.
+        :param bandwidth: When replaying, download speed in bytes per second instead of
+        the recorded timings.
+        """
+        if mode not in TRANSPORT_MODES:
+            raise RuntimeError(f"Invalid transport mode specified. Expected one of {TRANSPORT_MODES}.")
+        if mode != 'live' and archive is None:
+            raise RuntimeError(f"The '{mode}' transport needs an archive directory.")
+
+        self.mode = mode
+        self.archive = Path(archive) if archive is not None else None
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._lock = threading.Lock()
+
+        self.index = dict()
+        if self.archive is not None and (self.archive / TRANSPORT_INDEX_FILE).is_file():
+            with (self.archive / TRANSPORT_INDEX_FILE).open() as file:
+                self.index = json.load(file)
+
+    def __repr__(self):
+        return f"Transport(mode={self.mode!r}, archive={str(self.archive)!r})"
+
+    @property
+    def offline(self):
+        return self.mode in ('replay', 'cache-only')
+
+    def _save(self, key: str, entry: dict):
+        with self._lock:
+            self.index[key] = entry
+
+            # Written atomically, so a crash mid-recording never corrupts the archive
+            partial = self.archive / f"{TRANSPORT_INDEX_FILE}.part"
+            with partial.open('w') as file:
+                json.dump(self.index, file, indent=1)
+            os.replace(partial, self.archive / TRANSPORT_INDEX_FILE)
+
+    def _entry(self, kind: str, request: dict):
+        key = _request_key(kind, request)
+        if key not in self.index:
+            raise RuntimeError(f"No recorded {kind} response for {request} in {self.archive}.")
+
+        return self.index[key]
+
+    def _response_time(self, entry: dict):
+        """How long a replayed response takes."""
+        if self.mode == 'cache-only':
+            return 0.0
+        if self.latency is None and self.bandwidth is None:
+            return entry['seconds']
+
+        transfer = entry.get('bytes', 0) / self.bandwidth if self.bandwidth else 0.0
+        return (self.latency or 0.0) + transfer
+
+    # Adding to the archive. Recording does this, but archives can also be assembled by hand.
+
+    def archive_name(self, sdss_name: str, position, seconds: float = 0.0):
+        """:param position: (ra, dec) in degrees, or None if the name can't be resolved."""
+        self.archive.mkdir(parents=True, exist_ok=True)
+        self._save(_request_key('resolve', {'name': sdss_name}), {
+            "kind": 'resolve', "position": None if position is None else [float(v) for v in position],
+            "seconds": seconds,
+        })
+
+    def archive_file(self, kind: str, request: dict, path, seconds: float = 0.0):
+        key = _request_key(kind, request)
+        payload = Path(kind) / f"{key}.fits"
+
+        (self.archive / kind).mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(path, self.archive / payload)
+        self._save(key, {
+            "kind": kind, "request": request, "payload": str(payload),
+            "bytes": (self.archive / payload).stat().st_size, "seconds": seconds,
+        })
+
+    def archive_spectrum(self, request: dict, spectrum, seconds: float = 0.0):
+        """:param spectrum: The spectrum HDUList, or None if SDSS has none for the request."""
+        key = _request_key('spectrum', request)
+        payload = None
+        if spectrum is not None:
+            payload = Path('spectrum') / f"{key}.fits"
+            (self.archive / 'spectrum').mkdir(parents=True, exist_ok=True)
+            spectrum.writeto(self.archive / payload, overwrite=True)
+
+        self._save(key, {
+            "kind": 'spectrum', "request": request, "payload": None if payload is None else str(payload),
+            "bytes": (self.archive / payload).stat().st_size if payload is not None else 0, "seconds": seconds,
+        })
+
+    # The requests themselves. `live` performs the real request and is only called online.
+
+    def resolve(self, sdss_name: str, live):
+        """
+        :param live: Resolves the name over the network; returns (ra, dec) or raises RuntimeWarning.
+        :return: (ra, dec) in degrees.
+        """
+        if self.offline:
+            entry = self._entry('resolve', {'name': sdss_name})
+            time.sleep(self._response_time(entry))
+            if entry['position'] is None:
+                raise RuntimeWarning('No valid objects found with the given name or coordinates.')
+
+            return tuple(entry['position'])
+
+        start = time.perf_counter()
+        try:
+            position = live()
+        except RuntimeWarning:
+            if self.mode == 'record':
+                self.archive_name(sdss_name, None, seconds=time.perf_counter() - start)
+            raise
+
+        if self.mode == 'record':
+            self.archive_name(sdss_name, position, seconds=time.perf_counter() - start)
+        return position
+
+    def download(self, kind: str, request: dict, filename: Path, live):
+        """
+        :param request: Everything that determines the downloaded file, e.g. the query parameters.
+        :param live: Downloads the file to `filename` and returns its path.
+        :return: The path of the downloaded file.
+        """
+        if self.offline:
+            entry = self._entry(kind, request)
+            self._replay_file(self.archive / entry['payload'], filename, self._response_time(entry))
+            return filename
+
+        start = time.perf_counter()
+        path = live(filename)
+        if self.mode == 'record':
+            self.archive_file(kind, request, path, seconds=time.perf_counter() - start)
+
+        return path
+
+    def _replay_file(self, source: Path, filename: Path, seconds: float):
+        """Copy an archived file into place, spreading `seconds` over it like a download would."""
+        size = source.stat().st_size
+        partial = filename.with_suffix('.fits.part')
+        start = time.perf_counter()
+
+        with source.open('rb') as src, partial.open('wb') as dst:
+            while True:
+                chunk = src.read(_REPLAY_CHUNK)
+                if not chunk:
+                    break
+
+                dst.write(chunk)
+                done = dst.tell() / size if size else 1.0
+                report_progress(done, f"Downloaded {dst.tell() // 1024} KiB")
+
+                # Sleep until this much of the file would have arrived
+                time.sleep(max(0.0, start + done * seconds - time.perf_counter()))
+
+        os.replace(partial, filename)
+
+    def spectrum(self, request: dict, live):
+        """
+        :param live: Queries SDSS; returns the spectrum HDUList, or None if there is none.
+        :return: The spectrum HDUList, or None.
+        """
+        if self.offline:
+            from astropy.io import fits
+
+            entry = self._entry('spectrum', request)
+            time.sleep(self._response_time(entry))
+            if entry['payload'] is None:
+                return None
+
+            with fits.open(self.archive / entry['payload']) as archived:
+                return fits.HDUList([hdu.copy() for hdu in archived])
+
+        start = time.perf_counter()
+        spectrum = live()
+        if self.mode == 'record':
+            self.archive_spectrum(request, spectrum, seconds=time.perf_counter() - start)
+
+        return spectrum
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    The Transport used by default by every HSCDownloader of this process. It is
+    configured through the environment, so the app and batch runs can be switched to
+    recording or replaying without code changes:
+
+        DRAGON_TRANSPORT=replay DRAGON_TRANSPORT_ARCHIVE=archive/ DRAGON_TRANSPORT_LATENCY=0.2 \
+        DRAGON_TRANSPORT_BANDWIDTH=2e6 streamlit run frontend/frontend.py
+    """
+    global _transport
+
+    with _transport_lock:
+        if _transport is None:
+            latency = os.environ.get('DRAGON_TRANSPORT_LATENCY')
+            bandwidth = os.environ.get('DRAGON_TRANSPORT_BANDWIDTH')
+
+            _transport = Transport(
+                mode=os.environ.get('DRAGON_TRANSPORT', 'live'),
+                archive=os.environ.get('DRAGON_TRANSPORT_ARCHIVE', 'transport_archive'),
+                latency=float(latency) if latency else None,
+                bandwidth=float(bandwidth) if bandwidth else None,
+            )
+            if _transport.mode != 'live':
+                logging.info(f"HSC and SDSS requests go through {_transport}.")
+
+    return _transport
+
+
+def set_transport(transport):
+    """Replace the process-wide default Transport, e.g. in benchmarks."""
+    global _transport
+
+    with _transport_lock:
+        _transport = transport
\ No newline at end of file
@@ -1,4 +1,8 @@
 from .tensor_utils import *
 from .fits_utils import *
 from .page_utils import *
-from .train_utils import *
\ No newline at end of file
+from .train_utils import *
+from .profiling import *
+from .fits_store import *
+from .job_queue import *
+from .sky_utils import *
\ No newline at end of file
@@ -0,0 +1,166 @@
+from collections import OrderedDict
+from pathlib import Path
+import threading
+import logging
+import weakref
+import time
+
+
+class FITSHandle:
+    def __init__(self, store, key):
+        """
+        A lightweight reference to one HDU held by a FITSStore. This is all a session
+        needs to keep; the header and data live once per process in the store. The
+        reference is released when the handle is released or garbage collected.
+        """
+        self.key = key
+        self.path, self.extension = key
+        self._store = store
+        self._finalizer = weakref.finalize(self, store._release, key)
+
+    @property
+    def header(self):
+        return self._store._get(self.key)['header']
+
+    @property
+    def data(self):
+        return self._store._get(self.key)['data']
+
+    def release(self):
+        self._finalizer()
+
+    def __repr__(self):
+        return f"FITSHandle({self.path}, extension={self.extension})"
+
+
+class FITSStore:
+    def __init__(self, max_resident_bytes: int = 512 * 1024 ** 2):
+        """
+        A process-wide, reference-counted store of FITS HDUs. Data arrays are read-only
+        memory maps, so every session looking at the same object shares one copy (and
+        the OS page cache), instead of one pickled copy per session.
+
+        :param max_resident_bytes: Memory budget. When it is exceeded, the least recently
+        used objects that no session references any more are evicted.
+        """
+        self.max_resident_bytes = max_resident_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _load(path, extension):
+        from astropy.io import fits
+
+        hdul = fits.open(path, memmap=True, mode='readonly')
+        if len(hdul) <= extension:
+            hdul.close()
+            raise IndexError('Extension provided out of bounds.')
+
+        data = hdul[extension].data
+        if data is not None:
+            data = data.view()
+            data.setflags(write=False)
+
+        return {
+            "hdul": hdul,
+            "header": hdul[extension].header,
+            "data": data,
+            "bytes": data.nbytes if data is not None else 0,
+            "refs": 0,
+            "hits": 0,
+            "last_access": time.time(),
+        }
+
+    def acquire(self, file_path, extension: int = 1):
+        """
+        :return: A FITSHandle for the given HDU, loading it if no session holds it yet.
+        """
+        key = (str(Path(file_path).resolve()), extension)
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = self._load(*key)
+
+            entry = self._entries[key]
+            entry['refs'] += 1
+            self._entries.move_to_end(key)
+            self._evict()
+
+        return FITSHandle(self, key)
+
+    def _get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                # Live handles keep their object resident, but reload rather than fail if it went missing
+                entry = self._load(*key)
+                entry['refs'] = 1
+                self._entries[key] = entry
+
+            entry = self._entries[key]
+            entry['hits'] += 1
+            entry['last_access'] = time.time()
+            self._entries.move_to_end(key)
+
+        return entry
+
+    def _release(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries[key]['refs'] = max(self._entries[key]['refs'] - 1, 0)
+                self._evict()
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(entry['bytes'] for entry in self._entries.values())
+
+    def _evict(self):
+        resident = self.resident_bytes()
+        for key in list(self._entries):
+            if resident <= self.max_resident_bytes:
+                break
+
+            entry = self._entries[key]
+            if entry['refs'] == 0:
+                logging.info(f"Evicting {key[0]} [{key[1]}] from the FITS store.")
+                entry['hdul'].close()
+                resident -= entry['bytes']
+                del self._entries[key]
+
+    def trim(self):
+        """Drop every object that no session references, e.g. under memory pressure."""
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry['refs'] == 0]:
+                self._entries.pop(key)['hdul'].close()
+
+    def stats(self):
+        """
+        :return: The resident bytes of the store, and per object its references, size and use.
+        """
+        with self._lock:
+            return {
+                "resident_bytes": sum(entry['bytes'] for entry in self._entries.values()),
+                "max_resident_bytes": self.max_resident_bytes,
+                "objects": [{
+                    "path": path,
+                    "extension": extension,
+                    "refs": entry['refs'],
+                    "bytes": entry['bytes'],
+                    "hits": entry['hits'],
+                    "last_access": entry['last_access'],
+                } for (path, extension), entry in self._entries.items()],
+            }
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_fits_store():
+    """The FITSStore shared by every session of this process."""
+    global _store
+
+    with _store_lock:
+        if _store is None:
+            _store = FITSStore()
+
+    return _store
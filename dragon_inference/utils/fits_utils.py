@@ -1,7 +1,4 @@
-import matplotlib.pyplot as plt
 import numpy as np
-from astropy.io import fits
-from astropy.wcs import WCS
 
 import random
 from pathlib import Path
@@ -9,6 +6,8 @@ from pathlib import Path
 import warnings
 import streamlit as st
 
+from .profiling import span, timed
+
 DEBUG = True
 
 
@@ -26,6 +25,40 @@ def warning_suppression(toggle=True):
     return warn
 
 
+# FITS files are always a whole number of these blocks.
+FITS_BLOCK_SIZE = 2880
+
+
+def verify_fits_file(file_path):
+    """
+    Integrity check for a downloaded FITS file: it must be a non-empty whole number of
+    2880-byte blocks, start with a primary header, and pass its CHECKSUM/DATASUM
+    keywords wherever they are present. Raises an OSError describing the first problem.
+    """
+    from astropy.io import fits
+
+    path = Path(file_path)
+    size = path.stat().st_size
+    if size == 0 or size % FITS_BLOCK_SIZE:
+        raise OSError(f'{path.name} is {size} bytes, which is not a whole number of FITS blocks.')
+
+    with path.open('rb') as file:
+        if not file.read(80).startswith(b'SIMPLE  ='):
+            raise OSError(f'{path.name} does not start with a FITS primary header.')
+
+    # astropy only warns about bad checksums, so promote those warnings to failures
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        with fits.open(path, checksum=True) as hdul:
+            for hdu in hdul:
+                _ = hdu.data  # touching the data forces it (and its DATASUM) to be read
+
+    for warning in caught:
+        message = str(warning.message)
+        if 'checksum' in message.lower() or 'datasum' in message.lower() or 'truncated' in message.lower():
+            raise OSError(f'{path.name} failed verification: {message}')
+
+
 # My first version of load_fits already had some exception hadnling built into it.
 @st.cache_data
 def load_fits(file_path: str = None, extension: int = 0, explore: bool = False):
@@ -51,16 +84,19 @@ def load_fits(file_path: str = None, extension: int = 0, explore: bool = False):
     if not path.exists() or not path.is_file():
         raise OSError('Invalid path provided.')
 
+    from astropy.io import fits
+
     # Opening file
-    hdu = fits.open(file_path)
-    if len(hdu) < extension:
-        hdu.close()  # close the file descriptor so inode is not left open
-        raise IndexError('Extension provided out of bounds.')
+    with span('load_fits'):
+        hdu = fits.open(file_path)
+        if len(hdu) < extension:
+            hdu.close()  # close the file descriptor so inode is not left open
+            raise IndexError('Extension provided out of bounds.')
 
-    header = hdu[extension].header
-    data = hdu[extension].data
+        header = hdu[extension].header
+        data = hdu[extension].data
 
-    hdu.close()
+        hdu.close()
 
     return header, data
 
@@ -71,10 +107,13 @@ def get_fits_image(
         figsize: tuple[int, int] = (15, 13),
         cmap: str = 'gray_r',
         scale: float = 0.5,
-        wcs: WCS = None,
+        wcs: 'WCS' = None,
         grid: bool = False,
         **kwargs
 ):
+    # matplotlib is only needed once something is drawn
+    import matplotlib.pyplot as plt
+
     # Calculating the mean and standard deviation
     mean = np.mean(image)
     sigma = np.std(image)
@@ -111,15 +150,19 @@ def get_fits_image(
 
 
 @warning_suppression(toggle=DEBUG)
+@timed('implot')
 def implot(
         image: np.ndarray,
         figsize: tuple[int, int] = (15, 13),
         cmap: str = 'gray_r',
         scale: float = 0.5,
-        wcs: (WCS or fits.header.Header) = None,
+        wcs: 'WCS or fits.header.Header' = None,
         grid: bool = False,
         **kwargs
 ):
+    from astropy.io import fits
+    from astropy.wcs import WCS
+
     # Additional functionality: if you just import the header
     # object, it will automatically do the conversion for you
     if type(wcs) == fits.header.Header:
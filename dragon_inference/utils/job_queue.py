@@ -0,0 +1,173 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import contextvars
+import threading
+import logging
+import time
+
+# The job that the current worker thread is running, so deep code can report progress.
+_current_job = contextvars.ContextVar('dragon_job', default=None)
+
+
+class Job:
+    def __init__(self, key, label: str = ''):
+        """
+        One background computation (a download, an election...). Sessions asking for the
+        same key while it is in flight all get this same Job, and poll it for progress.
+        """
+        self.key = key
+        self.label = label or str(key)
+        self.progress = 0.0
+        self.message = "Queued"
+        self.subscribers = 1
+
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.future = None
+
+    @property
+    def status(self):
+        if not self.future.done():
+            return 'running' if self.started is not None else 'queued'
+        if self.future.cancelled():
+            return 'cancelled'
+
+        return 'failed' if self.future.exception() is not None else 'done'
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        """Blocks until the job is finished, and re-raises its exception if it failed."""
+        return self.future.result(timeout=timeout)
+
+    def report(self, progress: float, message: str = None):
+        self.progress = min(max(float(progress), 0.0), 1.0)
+        if message is not None:
+            self.message = message
+
+    def to_dict(self):
+        return {
+            "key": str(self.key),
+            "label": self.label,
+            "status": self.status,
+            "progress": self.progress,
+            "message": self.message,
+            "subscribers": self.subscribers,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+    def __repr__(self):
+        return f"Job({self.label}, {self.status}, {self.progress:.0%})"
+
+
+class JobQueue:
+    def __init__(self, max_workers: int = 8):
+        """
+        A process-wide background executor for the slow steps of the app, so the
+        Streamlit script thread only submits work and polls it. Identical jobs that
+        are in flight at the same time (e.g. several users opening the same popular
+        object) share one computation.
+
+        :param max_workers: Number of worker threads. Downloads wait on the network and
+        PyTorch releases the GIL, so threads are enough here.
+        """
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dragon-job')
+        self._in_flight = dict()
+        self._recent = deque(maxlen=32)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _run(job, fn, args, kwargs):
+        token = _current_job.set(job)
+        job.started = time.time()
+        job.message = "Running"
+
+        try:
+            result = fn(*args, **kwargs)
+            job.report(1.0, "Done")
+            return result
+        except Exception as e:
+            job.message = f"Failed: {e}"
+            raise
+        finally:
+            job.finished = time.time()
+            _current_job.reset(token)
+
+    def submit(self, key, fn, *args, label: str = '', **kwargs):
+        """
+        Run fn(*args, **kwargs) in the background, unless a job with the same key is
+        already in flight, in which case that one is shared.
+
+        :param key: Hashable identity of the job, e.g. ('download', sdss_name).
+        :return: The Job to poll.
+        """
+        with self._lock:
+            job = self._in_flight.get(key)
+            if job is not None:
+                job.subscribers += 1
+                return job
+
+            logging.info(f"Queueing job {label or key}...")
+            job = Job(key, label=label)
+            # The job runs in a copy of the submitter's context, so its spans land in the
+            # submitting session's RequestTrace
+            job.future = self._pool.submit(contextvars.copy_context().run, self._run, job, fn, args, kwargs)
+            self._in_flight[key] = job
+
+        # Finished jobs leave the in-flight table (outside the lock, as this may run right away)
+        job.future.add_done_callback(lambda _: self._forget(job))
+        return job
+
+    def _forget(self, job):
+        with self._lock:
+            if self._in_flight.get(job.key) is job:
+                del self._in_flight[job.key]
+            self._recent.append(job)
+
+    def get(self, key):
+        """:return: The in-flight job with this key, or None."""
+        with self._lock:
+            return self._in_flight.get(key)
+
+    def stats(self):
+        """
+        :return: Every job in flight, and the most recently finished ones.
+        """
+        with self._lock:
+            return {
+                "in_flight": [job.to_dict() for job in self._in_flight.values()],
+                "recent": [job.to_dict() for job in reversed(self._recent)],
+            }
+
+
+def current_job():
+    return _current_job.get()
+
+
+def report_progress(progress: float, message: str = None):
+    """
+    Report the progress of the job running in this thread. Outside of a job (e.g. in
+    the batch CLI), this does nothing.
+    """
+    job = _current_job.get()
+    if job is not None:
+        job.report(progress, message)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """The JobQueue shared by every session of this process."""
+    global _queue
+
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+
+    return _queue
@@ -1,4 +1,5 @@
 import streamlit as st
+import os
 
 # We decide to use a stack to track page history. Use stack methods.
 def go_to_page(page_name: str):
@@ -13,4 +14,14 @@ def go_back():
         st.session_state['page_stack'] = ['Login', 'Login']
 
     prev_page = st.session_state['page_stack'].pop()
-    st.session_state['page'] = prev_page
\ No newline at end of file
+    st.session_state['page'] = prev_page
+
+def patch_torch_for_streamlit():
+    """
+    Import torch for the page that needs it. Streamlit's file watcher chokes on
+    torch.classes, so give it a real path as soon as torch is loaded.
+    """
+    import torch
+
+    torch.classes.__path__ = [os.path.join(torch.__path__[0], torch.classes.__file__)]
+    return torch
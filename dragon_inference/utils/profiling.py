@@ -0,0 +1,196 @@
+import contextvars
+import functools
+import threading
+import logging
+import time
+import json
+import os
+import math
+
+# Profiling is off unless DRAGON_PROFILE is set, and then every span is a single flag check.
+_enabled = os.environ.get('DRAGON_PROFILE', '').lower() not in ('', '0', 'false', 'no')
+
+# Histogram bucket upper bounds in seconds, in the spirit of Prometheus' defaults.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+# The stages of the request that is currently being served (one list per Streamlit script run).
+_current_trace = contextvars.ContextVar('dragon_trace', default=None)
+
+
+class StageHistogram:
+    def __init__(self):
+        """
+        Cumulative timing statistics of one stage of the pipeline.
+        """
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, duration: float):
+        self.count += 1
+        self.total += duration
+        self.min = min(self.min, duration)
+        self.max = max(self.max, duration)
+
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum_s": self.total,
+            "mean_s": self.total / self.count if self.count else 0.0,
+            "min_s": self.min if self.count else 0.0,
+            "max_s": self.max,
+            "buckets": {("+Inf" if math.isinf(bound) else str(bound)): n
+                        for bound, n in zip(BUCKETS, self.bucket_counts)},
+        }
+
+
+_histograms = dict()
+_histogram_lock = threading.Lock()
+
+
+def enable_profiling(toggle: bool = True):
+    global _enabled
+    _enabled = toggle
+
+
+def profiling_enabled():
+    return _enabled
+
+
+def reset_profiling():
+    with _histogram_lock:
+        _histograms.clear()
+
+
+def _record(name: str, start: float, duration: float):
+    with _histogram_lock:
+        if name not in _histograms:
+            _histograms[name] = StageHistogram()
+        _histograms[name].observe(duration)
+
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.append({"stage": name, "start_s": start - trace.started, "duration_s": duration})
+
+    logging.info(f"[timing] {name} took {duration * 1e3:.2f} ms")
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _record(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name: str):
+    """
+    Time a block of code as one stage:
+
+        with span('load_fits'):
+            ...
+
+    When profiling is disabled this returns a shared no-op context manager.
+    """
+    return _Span(name) if _enabled else _NULL_SPAN
+
+
+def timed(name: str = None):
+    """
+    Decorator version of span. The stage name defaults to the function's qualified name.
+    """
+    def decorator(func):
+        stage = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+
+            with _Span(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class RequestTrace(list):
+    def __init__(self, label: str = ''):
+        """
+        The ordered stage timings of a single request (e.g. one Streamlit script run).
+        """
+        super().__init__()
+        self.label = label
+        self.started = time.perf_counter()
+
+
+def start_trace(label: str = ''):
+    """
+    Begin collecting the stages of a new request in the current context.
+
+    :return: The RequestTrace that the following spans are appended to.
+    """
+    trace = RequestTrace(label)
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def export_json(indent: int = 2):
+    """Aggregated histograms of every stage, as a JSON document."""
+    with _histogram_lock:
+        stages = {name: histogram.to_dict() for name, histogram in sorted(_histograms.items())}
+
+    return json.dumps({"enabled": _enabled, "stages": stages}, indent=indent)
+
+
+def export_prometheus(metric: str = 'dragon_stage_duration_seconds'):
+    """Aggregated histograms of every stage, in the Prometheus text exposition format."""
+    lines = [
+        f"# HELP {metric} Duration of DRAGON pipeline stages.",
+        f"# TYPE {metric} histogram",
+    ]
+
+    with _histogram_lock:
+        for name, histogram in sorted(_histograms.items()):
+            cumulative = 0
+            for bound, n in zip(BUCKETS, histogram.bucket_counts):
+                cumulative += n
+                le = "+Inf" if math.isinf(bound) else repr(bound)
+                lines.append(f'{metric}_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+
+            lines.append(f'{metric}_sum{{stage="{name}"}} {histogram.total}')
+            lines.append(f'{metric}_count{{stage="{name}"}} {histogram.count}')
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,7 @@
+import numpy as np
+
+
+def unit_vectors(ra, dec):
+    """RA/Dec in degrees -> unit vectors of shape [..., 3]."""
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)], axis=-1)
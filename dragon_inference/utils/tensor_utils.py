@@ -1,8 +1,48 @@
-import torch
+# torch is imported inside the functions, so that `import utils` stays cheap for the Streamlit pages.
 
 def arsinh_normalize(X):
     """Normalize a Torch tensor with arsinh."""
+    import torch
+
     normalized = torch.log(X + (X ** 2 + 1) ** 0.5)
     normalized[torch.isnan(normalized)] = 0  # Replace NaN values with 0
     normalized[torch.isinf(normalized)] = 255
     return normalized
+
+def center_square(X, size: int = None):
+    """
+    Center-crop the last two dimensions of an array or tensor to a square of the
+    shorter side. DAS cutouts are often a pixel wider than tall (e.g. 96x97), and their
+    dihedral views only share a shape once they are square.
+
+    :param size: The side of the square, if smaller than the shorter side.
+    """
+    height, width = X.shape[-2:]
+    size = min(height, width) if size is None else min(height, width, size)
+    top, left = (height - size) // 2, (width - size) // 2
+    return X[..., top:top + size, left:left + size]
+
+# Number of elements in the dihedral group D4 (4 rotations, each optionally flipped)
+NUM_DIHEDRAL_VIEWS = 8
+
+def dihedral_views(X):
+    """
+    Build all 8 dihedral views (rotations by 90 degrees and their mirror images)
+    of a batch of images as a single tensor, so that test-time augmentation
+    only needs one forward pass.
+
+    :param X: A tensor of shape [B, C, H, W]. The images must be square.
+    :return: A tensor of shape [B * 8, C, H, W] where the views of image b
+    occupy rows b * 8 through b * 8 + 7.
+    """
+    if X.shape[-1] != X.shape[-2]:
+        raise RuntimeError("Dihedral views require square images.")
+
+    import torch
+
+    flipped = torch.flip(X, dims=(-1,))
+    views = [torch.rot90(base, k, dims=(-2, -1)) for base in (X, flipped) for k in range(4)]
+
+    # [8, B, C, H, W] -> [B, 8, C, H, W] -> [B * 8, C, H, W]
+    views = torch.stack(views, dim=0).transpose(0, 1)
+    return views.reshape(-1, *X.shape[1:])
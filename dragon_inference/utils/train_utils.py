@@ -1,10 +1,10 @@
-import torch
 import logging
-import torch.multiprocessing as mp
 
 
 def discover_devices():
     """Check for available devices."""
+    import torch
+
     if torch.cuda.is_available():
         n_devices = torch.cuda.device_count()
         devices = (torch.cuda.get_device_name(i) for i in range(n_devices))
@@ -13,3 +13,19 @@ def discover_devices():
     else:
         logging.info("No GPU found; falling back to CPU")
         return "cpu"
+
+
+def configure_threads(intra_op: int, inter_op: int = 1):
+    """
+    Pin the number of threads PyTorch uses in this process. Small cutouts don't scale
+    with intra-op threads, so batch workers run with few threads each instead of
+    letting every process grab every core.
+    """
+    import torch
+
+    torch.set_num_threads(intra_op)
+    try:
+        torch.set_num_interop_threads(inter_op)
+    except RuntimeError:
+        # Can only be set once, before any parallel work has started in this process.
+        logging.info("Inter-op threads were already initialized; leaving them as they are.")